@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''Benchmark the size and dump/load time of the cache file formats.
+
+Usage: cache_format.py [number of jobs]
+
+A synthetic cache containing the requested number of jobs (default: 20000) is
+written and read using each available codec, with the jobs stored both as Job
+instances and in columns (see JobServer.store_columns).  The jobs are
+representative of a typical cache: a few programs, deep and highly repetitive
+paths and a handful of statuses.  Jobs stored in columns are only created when
+first used, which the load time does not include.
+'''
+
+import os
+import sys
+import tempfile
+import time
+
+try:
+    import job_manager
+except ImportError:
+    # Assume standard layout of source package.
+    SCRIPT_DIR = os.path.abspath(os.path.dirname(sys.argv[0]))
+    sys.path.append(os.path.abspath(os.path.join(SCRIPT_DIR, '../lib')))
+    import job_manager
+
+def synthetic_job_servers(njobs):
+    '''Create a dictionary of JobServer instances containing njobs jobs.'''
+    programs = ['hande', 'casino', 'vasp', 'cp2k']
+    statuses = ['running', 'queueing', 'finished', 'analysed']
+    job_servers = dict(localhost=job_manager.JobServer())
+    for i in range(njobs):
+        program = programs[i % len(programs)]
+        # Build strings afresh for each job, as happens when unpickling a cache
+        # built up over many runs of jm.py.
+        job_servers['localhost'].add(dict(
+            job_id='%i.cluster' % (100000+i),
+            program='%s' % (program,),
+            path='/scratch/user/project/%s/system_%i/run_%i' % (program, i % 50, i % 7),
+            input_fname='%s.in' % (program,),
+            output_fname='%s.out' % (program,),
+            status='%s' % (statuses[i % len(statuses)],),
+            submit='submit.%s.pbs' % (program,),
+            comment='sweep over system %i' % (i % 50),
+        ))
+    return job_servers
+
+def main(njobs):
+    cache = os.path.join(tempfile.mkdtemp(), 'bench.cache')
+    print('%-8s %-8s %10s %10s %10s' % ('codec', 'columnar', 'size/kB', 'dump/ms', 'load/ms'))
+    for (codec, columnar) in [(codec, columnar) for codec in job_manager.cache_codecs for columnar in (False, True)]:
+        try:
+            job_cache = job_manager.JobCache(cache, codec=codec, columnar=columnar)
+        except job_manager.UserError:
+            print('%-8s not available' % (codec))
+            continue
+        job_cache.job_servers = synthetic_job_servers(njobs)
+        start = time.time()
+        job_cache.dump()
+        dump_time = time.time() - start
+        size = os.path.getsize(cache)
+        start = time.time()
+        job_cache.load()
+        load_time = time.time() - start
+        job_cache.dump()
+        print('%-8s %-8s %10.1f %10.1f %10.1f' % (codec, columnar, size/1024.0, 1000*dump_time, 1000*load_time))
+        os.remove(cache)
+    os.remove('%s.complete' % (cache))
+    os.rmdir(os.path.dirname(cache))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main(20000)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''Benchmark the startup time of jm.py.
+
+Usage: startup.py [number of jobs] [number of repetitions]
+
+The time taken to import job_manager and the time until jm.py produces its
+first line of output (or exits, for commands which print nothing) are measured
+in fresh python processes, using a synthetic cache containing the requested
+number of jobs (default: 20000).  The median over the repetitions (default: 10)
+is printed.
+'''
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(sys.argv[0]))
+LIB_DIR = os.path.abspath(os.path.join(SCRIPT_DIR, '../lib'))
+JM = os.path.abspath(os.path.join(SCRIPT_DIR, '../bin/jm.py'))
+
+try:
+    import job_manager
+except ImportError:
+    # Assume standard layout of source package.
+    sys.path.append(LIB_DIR)
+    import job_manager
+
+from cache_format import synthetic_job_servers
+
+def median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+def time_to_first_output(command, env):
+    '''Run command and return the time (in seconds) until it first writes a line
+or exits.'''
+    start = time.time()
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    proc.stdout.readline()
+    elapsed = time.time() - start
+    proc.communicate()
+    if proc.returncode != 0:
+        raise Exception('%s failed with exit status %i.' % (' '.join(command), proc.returncode))
+    return elapsed
+
+def main(njobs=20000, repeats=10):
+    tmp_dir = tempfile.mkdtemp()
+    cache = os.path.join(tmp_dir, 'bench.cache')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([LIB_DIR] + [path for path in [env.get('PYTHONPATH')] if path])
+    config = os.path.join(tmp_dir, 'jm.conf')
+
+    job_cache = job_manager.JobCache(cache)
+    job_cache.job_servers = synthetic_job_servers(njobs)
+    job_cache.dump()
+
+    commands = [
+        ('python', [sys.executable, '-c', 'pass']),
+        ('import', [sys.executable, '-c', 'import job_manager']),
+        ('--help', [sys.executable, JM, '--help']),
+        ('add', [sys.executable, JM, '--config', config, '-c', cache, 'add', 'job_id:', '1', 'program:', 'bench', 'path:', tmp_dir]),
+        ('list', [sys.executable, JM, '--config', config, '-c', cache, 'list']),
+        ('list -p', [sys.executable, JM, '--config', config, '-c', cache, 'list', '-p', 'system_1/']),
+    ]
+    print('%d jobs' % (njobs))
+    print('%-8s %10s' % ('command', 'time/ms'))
+    for (name, command) in commands:
+        # Discard the first run, which may compile bytecode.
+        time_to_first_output(command, env)
+        times = [time_to_first_output(command, env) for i in range(repeats)]
+        print('%-8s %10.1f' % (name, 1000*median(times)))
+
+    for fname in os.listdir(tmp_dir):
+        os.remove(os.path.join(tmp_dir, fname))
+    os.rmdir(tmp_dir)
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:3]]
+    main(*args)
@@ -7,17 +7,27 @@ Synopsis
 
     jm.py add [-c | --cache] [-s | --server] <job_description>
 
-    jm.py modify [-c | --cache] [-s | --server] [-i | --index] [-p | --pattern] <job_description>
+    jm.py modify [-c | --cache] [-s | --server] [-i | --index] [-H | --handle] [-p | --pattern] <job_description>
 
-    jm.py delete [-c | --cache] [-s | --server] [-i | --index] [-p | --pattern]
+    jm.py delete [-c | --cache] [-s | --server] [-i | --index] [-H | --handle] [-p | --pattern]
 
-    jm.py list [-c | --cache] [-s | --server] [-p | --pattern] [-t | --terse]
+    jm.py list [-c | --cache ...] [-s | --server] [-p | --pattern] [--under] [-t | --terse] [-a | --archive] [-w | --watch] [--tasks]
+
+    jm.py archive [-c | --cache] [-s | --server] [--age] [--status]
 
     jm.py merge [-c | --cache] <[[user@]remote_host:]remote_cache> [remote_hostname]
 
     jm.py update [-c | --cache]  
 
-    jm.py daemon [-c | --cache]  
+    jm.py daemon [-c | --cache ...] [-b | --batch-system]
+
+    jm.py run [-c | --cache] [-j | --jobs] [<job_description>] [-- command [arguments]]
+
+    jm.py stats [-c | --cache] [-s | --server] [-i | --index] [-H | --handle] [-p | --pattern] [--by] [index ...]
+
+    jm.py export [-c | --cache] [-s | --server] [-p | --pattern] [-a | --archive] [--tasks] [-f | --format]
+
+    jm.py import [-c | --cache] [-s | --server] [-f | --format] [file]
 
 Description
 -----------
@@ -39,18 +49,31 @@ Commands
 
 add
     Add a job running on the specified server with job details given by job
-    description.
+    description.  The job is appended to the cache file without reading the
+    cache (unless --codec is given), so adding a job is quick however large
+    the cache is.
 modify
     Modify the selected job(s) according to the job description fields
-    supplied.  Note that if neither a pattern nor an index is provided then no
-    job is selected to be modified.
-delete
-    Delete the specified jobs.  Note that if neither a pattern nor an index is
+    supplied.  Note that if neither a pattern, an index nor a handle is
     provided then no job is selected to be modified.
+delete
+    Delete the specified jobs.  The jobs are selected before any is deleted,
+    so indices refer to the positions of the jobs before the deletion.  Note
+    that if neither a pattern, an index nor a handle is provided then no job
+    is selected to be deleted.
 list
     List jobs which match the supplied search criteria.  The complete list of
     jobs is printed out if no options are specified.  Only fields of the job
-    description which are not null are printed out.
+    description which are not null are printed out.  Several caches can be
+    listed together, without merging them, by giving --cache multiple times
+    or a glob pattern, in which case the cache file containing each job is
+    printed in the source column.
+archive
+    Move finished, failed and analysed jobs to the archive file, which is stored
+    alongside the cache file.  Archived jobs are no longer loaded by the other
+    commands, which only need to process jobs which are still in progress.
+    The archive can be searched using the **list** command with the --archive
+    option.
 merge
     Merge jobs from the remote_cache file into the current cache.  The remote
     hostname nickname must be specified if the remote cache is actually a local
@@ -61,10 +84,88 @@ update
     Check all jobs on the *localhost* server and update the status of queueing
     or running jobs if they have started running or finished.  The job status
     is checked by searching for the *job_id* using ps, qstat (for PBS-based
-    queueing systems) and llq (for LoadLeveler queueing systems).
+    queueing systems), llq (for LoadLeveler queueing systems) and squeue (for
+    Slurm queueing systems).  Each queueing system is queried once per update
+    and only for the current user's jobs.  If completion markers are set in
+    the configuration file for a program, then the output files of its jobs
+    are also inspected to determine whether the job has finished
+    successfully or failed.
 daemon
-    Run the update command once a minute.  Designed to be run in the background
-    as a daemon-type process.
+    Run the update command regularly and submit pending jobs on the
+    *localhost* server whose dependencies have finished.  The update is run
+    once a minute whilst jobs are active, more frequently whilst jobs are
+    changing status or after the cache has been modified (e.g. by adding
+    jobs) and increasingly rarely, up to the max_poll setting, whilst there
+    are no pending, held, queueing or running jobs.  Pending jobs are
+    submitted using their submit script, either to the queueing system given
+    by --batch-system or, by default, the first queueing system found (qsub,
+    llsubmit or sbatch).  If no queueing system is found, the submit script is
+    run locally using sh.  The job_id of a pending job is a placeholder and is
+    replaced by the job id from the queueing system (or the pid) when the job
+    is submitted.  If a dependency fails, the pending job is marked as failed
+    rather than submitted.  Dependencies which are no longer in the cache are
+    looked up in the archive.  If a dependency is in neither, the pending job
+    is marked as failed and a message is printed to standard error.  Pending jobs are submitted in the order in which
+    they were added and submission is throttled according to the daemon
+    section of the configuration file, so that limits imposed by the queueing
+    system on the number of jobs are not exceeded.  The completion hooks (see
+    below) of jobs which have finished are run in the background, so slow hooks
+    do not delay updating jobs.  Designed to be run in the background as a
+    daemon-type process.  A single daemon can serve several caches (e.g. of
+    different projects): each queueing system is then queried once per update
+    for all jobs of the current user and the result used to update every
+    cache.  The caches are updated concurrently and independently, so a cache
+    which is in use is skipped until the next update without delaying the
+    others.
+run
+    Run a command on the *localhost* server and add it as a job, with the pid
+    of the command as the job_id.  The command follows the job description and
+    is separated from it by --.  If no command is given, then commands are read
+    from standard input, one per line, and run using the shell.  At most
+    --jobs commands are run at once; the remaining commands wait until a
+    running command exits.  The job description is used for each command,
+    except that the job_id is always the pid.  By default, the program is the
+    name of the command and the path is the current directory.  Each command
+    is run in the path of the job and, if output_fname is given, its output is
+    appended to that file.  The job status is set to running when the command
+    starts and to finished (if it exited successfully) or failed (otherwise)
+    when it exits, and the exit status is recorded.  jm.py run returns once
+    all the commands have exited.
+stats
+    If no jobs are selected, summarise how long jobs waited in the queue and
+    ran for.  Jobs (including archived jobs) are grouped by server, program and
+    status (or as given by --by) and the number of jobs, the number of jobs
+    which ended per day and the 50th, 90th and 99th percentiles of the wait and
+    run times are printed.  The time of each change in the status of a job is
+    recorded; a job was submitted when it first became held or queueing,
+    started when it first became running and ended when it first became
+    finished, failed or analysed.  The times of archived jobs are stored in a
+    compact file alongside the archive, so statistics of millions of jobs can
+    be computed quickly.  numpy is used if available.
+
+    Otherwise, summarise the resources used by the selected jobs: CPU time and the
+    average number of cores used, resident memory and data read and written.
+    Jobs can be selected by index (either using --index or directly after the
+    command), by handle or by pattern.  The resources used by running jobs on *localhost*
+    whose job_id is a pid are sampled from /proc (including all processes
+    started by the job) each time the update or daemon commands update the
+    jobs.  A fixed number of samples is stored for each job: once this is
+    reached the samples are thinned so that they span the whole job.  Jobs
+    which appear to have stalled (i.e. recently used almost no CPU time) or
+    whose memory usage is growing substantially are highlighted.
+export
+    Write the selected jobs (all jobs on all servers by default, or archived
+    jobs with --archive) to standard output as JSON objects, one per line, or
+    as CSV (see --format).  Each record contains the hostname and the fields of
+    the job description.  Records are written as jobs are found, rather than
+    after all jobs have been formatted.
+import
+    Add jobs from the file (or standard input if no file or - is given)
+    written by the export command.  Each job is added to the server given by
+    its hostname field, or to the server given by --server if specified.  The
+    cache is locked, read and written only once, however many jobs are
+    imported.  CSV files need only contain the columns which are set; job_id,
+    program and path are required.
 
 Job description
 ---------------
@@ -91,11 +192,22 @@ input_fname
 output_fname
     Filename of the output file.
 status
-    status of job.  Available values are: unknown, held, queueing, running,
-    finished and analysed.  Default: unknown.
+    status of job.  Available values are: pending, unknown, held, queueing,
+    running, finished, failed and analysed.  Default: unknown.  Pending jobs
+    are submitted by the daemon command.
 submit
     File name of the submit script used.  Only relevant for jobs run on
-    clusters with queueing systems.
+    clusters with queueing systems or pending jobs.
+depends
+    job_ids (separated by spaces) of jobs on the same server which must finish
+    before a pending job is submitted.
+tasks
+    Indices of the tasks of a job array (e.g. 1-5000 or 1,3,5-9).  A job array
+    is stored as a single job with the status of each range of tasks, which is
+    updated from the queueing system in one go.  The job_id is the id of the
+    array without any task index (e.g. 1234 or 1234[]).  The status of each
+    range of tasks can also be given (e.g. 1-4000:finished,4001-5000:running).
+    The status of the array is running if any task is running, etc.
 comment
     Comment and notes on the job.
 
@@ -103,13 +215,114 @@ Unless specified above, all elements default to being a null value.
 
 A job must have a *job_id*, *path* and *program* specified.  Other attributes are optional.  Only the attributes to be set or modified need to specified with the add and modify commands.
 
+Configuration
+-------------
+
+Settings are read from a configuration file in INI format, by default
+$HOME/.config/jm/jm.conf.  The daemon section can contain:
+
+max_jobs
+    maximum number of queueing, held and running jobs on *localhost*.  Pending
+    jobs are not submitted whilst this many jobs are in the queueing system.
+    Default: no limit.
+max_queued
+    maximum number of queueing and held jobs on *localhost*.  Default: no
+    limit.
+interval
+    minimum time in seconds between submitting jobs.  Default: 0.
+max_hooks
+    maximum number of completion hooks run at once.  Default: number of
+    processors.
+min_poll
+    minimum time in seconds between updates.  Default: 5.
+max_poll
+    maximum time in seconds between updates when no jobs are active.
+    Default: 600.
+
+The cache section can contain:
+
+text_index
+    if true, the values of all jobs are indexed by the substrings of 3
+    characters they contain, which makes searching for jobs with the --pattern
+    option much faster for caches containing many jobs.  The index is stored in
+    the cache file and is removed if false.  Default: the index is kept if it
+    exists.
+columnar
+    if true, the jobs are stored in the cache file in columns, with each
+    distinct value (e.g. path) stored only once, rather than as individual
+    jobs.  Caches containing very many jobs are then smaller, faster to read
+    and faster to search with the list and export commands.  Default: the
+    existing format of the cache file is kept.
+mapped
+    if true, a read-only copy of the jobs is also written in a fixed binary
+    layout to the same location as the cache file with a .map suffix whenever
+    the cache file is written.  The list command reads the copy using mmap if
+    it is up to date, decoding only the jobs and fields it prints, so listing
+    a few jobs (or only the job ids and statuses with --terse) from a very
+    large cache is fast.  The copy is removed if false.  Default: the copy is
+    kept up to date if it exists.
+
+Each other section is named after a program and can contain:
+
+finished
+    regular expression which is found near the end of the output file of a job
+    which has completed successfully.
+failed
+    regular expression which is found near the end of the output file of a job
+    which has failed.
+hook
+    shell command run by the daemon command when a job of the program
+    finishes, e.g. to analyse the output of the job.  The command is run in the
+    directory of the job with the environment variables JM_JOB_ID,
+    JM_PROGRAM, JM_PATH, JM_INPUT_FNAME and JM_OUTPUT_FNAME set from the job.
+    If the command exits successfully, the status of the job is set to
+    analysed.  The exit status of the command (hook_status), the time it took
+    (hook_time) and the end of its output (hook_output) are recorded with the
+    job.  The command is run only once for each job.
+
+The regular expressions are matched against each line in the last 64KiB of
+the output file.  A job which is no longer running and whose output file does
+not contain the finished marker is considered to have failed.  Output files are
+only read if they have changed since they were last inspected.  For example:
+
+.. code-block:: ini
+
+    [daemon]
+    max_jobs = 200
+    max_queued = 50
+    interval = 1
+
+    [hande]
+    finished = ^ Finished running
+    failed = ^ ERROR|^Traceback
+    hook = analyse_hande.py $JM_OUTPUT_FNAME > analysis.out
+
 Options
 -------
 
 -c, --cache
     Specify the location of the cache file containing data from previous runs.
     The default is $HOME/.cache/jm/jm.cache.  The directory structure for the
-    cache file will be created if necessary.
+    cache file will be created if necessary.  For the **list** and **daemon**
+    commands only, can be specified multiple times and can be a glob pattern
+    (quoted to prevent expansion by the shell) in order to list or update the
+    jobs in several caches.  The list command reads the caches concurrently
+    and without locking.  Whenever the cache is written, a
+    small index of the servers, number of jobs, handles, programs, paths and job
+    ids is also written to the same location with a .complete suffix, which the
+    bash completion script uses to complete the --server, --index, --handle and
+    --pattern options without loading the cache.
+--config
+    Specify the location of the configuration file.  The default is
+    $HOME/.config/jm/jm.conf.  Ignored if the file does not exist.
+-z, --codec
+    Specify the compression codec used to store the cache file.  Available
+    codecs are pickle (uncompressed), zlib, bz2 and lzma.  Compressed caches
+    are smaller and so faster to write to network filesystems and to copy
+    between servers.  The codec of an existing cache file is detected
+    automatically and is kept unless this option is given.  The default for
+    new cache files is pickle.  Ignored by the **list** command, which never
+    writes to the cache file.
 -s, --server
     Specify the server of the job.  The default is the *localhost* server
     except for the **list** command, where the default is all servers.  Can be
@@ -117,14 +330,58 @@ Options
     server in turn.  However, this rarely makes sense for the **add** command.
 -i, --index
     Select a job by its index on the specified server(s).  Can be specified
-    multiple times in order to select multiple jobs.
+    multiple times in order to select multiple jobs.  The index of a job is its
+    position amongst the jobs on its server and so changes when jobs listed
+    before it are deleted.
+-H, --handle
+    Select a job by its handle on the specified server(s).  Can be specified
+    multiple times in order to select multiple jobs.  Each job is given a
+    handle (shown by the **list** command) when it is added, which, unlike its
+    index, never changes and is never reused, so is safe to use in scripts
+    which run alongside other commands.
 -p, --pattern
     Select a job by a given regular expression on the specified server(s).  The
     regular expression is tested against all fields in the job description for
     each job and a job is selected if any of the fields match the regular
     expression.
+--under
+    List only jobs whose path is the given directory or is inside it, e.g. the
+    jobs in a project directory tree.  Only the path of each job is tested, so
+    jobs which merely mention the directory (e.g. in a comment) are not
+    listed, and the paths are compared once normalised (e.g. trailing slashes
+    are ignored), with ~ expanded.  Relative directories are not made absolute:
+    give the directory in the same form as the paths of the jobs.  Can be
+    combined with --pattern.
+-j, --jobs
+    Specify the maximum number of commands to run at once with the **run**
+    command.  The default is the number of processors available.
 -t, --terse
-    Print only the hostname, index, job id and status of each job.
+    Print only the hostname, index, handle, job id and status of each job.
+-a, --archive
+    List jobs in the archive rather than in the cache.  The index of an
+    archived job is its position in the archive.
+--tasks
+    List (or export) each task of a job array on a separate row rather than
+    the ranges of tasks with each status.
+-w, --watch
+    Keep listing jobs whenever the cache changes until interrupted.  Only the
+    rows which have changed are redrawn (or, if the output is not a terminal,
+    printed).  The cache file is watched using inotify where available and
+    polled once a second otherwise, so watching is cheap whilst nothing
+    changes and never blocks other commands.
+-f, --format
+    Format of exported or imported jobs: json (one JSON object per line) or
+    csv.  The default is json.
+--age
+    Archive only jobs which have not been modified for the given number of
+    days.  Default: archive jobs regardless of age.
+--by
+    Group jobs by hostname, program and/or status when computing statistics
+    with the **stats** command.  Can be specified multiple times.  Default:
+    hostname, program and status.
+--status
+    Archive only jobs with the given status.  Can be specified multiple times.
+    Default: finished, failed and analysed.
 
 .. _examples:
 
@@ -155,13 +412,63 @@ Automatically update the status of running jobs
 
     $ jm.py update
 
-Run a daemon process to automatically update the status of running jobs once
-a minute using a non-default cache file.
+Run a calculation, record it as a job and record its exit status when it
+finishes.
+
+.. code-block:: bash
+
+    $ jm.py run program: hande output_fname: hande.out -- hande.x hande.in
+
+Run a set of commands, four at a time.
+
+.. code-block:: bash
+
+    $ ls */run.sh | sed 's/^/sh /' | jm.py run --jobs 4 comment: sweep
+
+Record a Slurm job array of 5000 tasks.  The array is stored and updated as a
+single job.
+
+.. code-block:: bash
+
+    $ jm.py add job_id: 1234 program: hande path: $PWD tasks: 1-5000 status: queueing
+
+Run a daemon process to automatically update the status of running jobs
+using a non-default cache file.
 
 .. code-block:: bash
 
     $ jm.py daemon --cache /path/to/cache
 
+Add a workflow of three jobs: the analysis job is submitted by the daemon once
+both calculations have finished.
+
+.. code-block:: bash
+
+    $ jm.py add job_id: calc1 status: pending path: $PWD/1 program: hande submit: run.pbs
+    $ jm.py add job_id: calc2 status: pending path: $PWD/2 program: hande submit: run.pbs
+    $ jm.py add job_id: ana status: pending path: $PWD program: analyse submit: ana.pbs depends: calc1 calc2
+
+Find how long the jobs of each program wait in the queue and run for on each
+server:
+
+.. code-block:: bash
+
+    $ jm.py stats --by hostname --by program
+
+Check the CPU and memory usage of the job with index 3, e.g. to see whether it
+has stalled or is leaking memory.
+
+.. code-block:: bash
+
+    $ jm.py stats 3
+
+Compress an existing cache file using zlib.  The cache is stored using zlib
+from then on.
+
+.. code-block:: bash
+
+    $ jm.py update --codec zlib
+
 Merge jobs from a remote server into the local job cache:
 
 .. code-block:: bash
@@ -175,12 +482,36 @@ Merge jobs from a remote server into the local job cache:
     possible, copy the remote cache to the local machine and then merge using
     the local copy.
 
+Archive finished, failed and analysed jobs which have not changed for a month and
+then search the archive.
+
+.. code-block:: bash
+
+    $ jm.py archive --age 30
+    $ jm.py list --archive --pattern my_old_calculation
+
 List a subset of jobs.
 
 .. code-block:: bash
 
     $ jm.py list --server remote_server
     $ jm.py list --server localhost
+    $ jm.py list --under /scratch/project/system_1 --pattern running
+
+List the running jobs of everyone in a group, whose caches are readable, without
+merging their caches.
+
+.. code-block:: bash
+
+    $ jm.py list --cache '/home/*/.cache/jm/jm.cache' --pattern running
+
+Export running jobs as CSV for analysis with other tools, and copy all jobs to
+another cache.
+
+.. code-block:: bash
+
+    $ jm.py export --format csv --pattern running > running.csv
+    $ jm.py export | jm.py import --cache other.cache
 
 Delete a job on the remote server.
 
@@ -225,12 +556,12 @@ suggestions for improvements or code contributions.
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+# Modules only used by some subcommands (e.g. subprocess) are imported when
+# needed: jm.py add is run from every submit script, so should start quickly.
 import optparse
 import os
 import re
-import subprocess
 import sys
-import tempfile
 import time
 try:
     import job_manager
@@ -285,6 +616,8 @@ input_fname: input file name
 output_fname: output file name
 status: current status of job.  See JobStatus for defined statuses.
 submit: submit script file name.
+depends: job_ids of jobs which must finish before the job is submitted.
+tasks: indices of the tasks of a job array.
 comment: further information regarding the job.
 
 Values not set default to None.
@@ -299,6 +632,8 @@ Values not set default to None.
                      status=job_manager.JobStatus.unknown,
                      submit=None,
                      comment=None,
+                     depends=None,
+                     tasks=None,
                    )
 
     option = job_desc_list[0][:-1]
@@ -336,21 +671,26 @@ For full usage, see top-level __doc__.
 
     usage = '''
 %prog add [-c | --cache] [-s | --server] <job_description>
-%prog modify [-c | --cache] [-s | --server] [-i | --index] [-p | --pattern] <job_description>
-%prog delete [-c | --cache] [-s | --server] [-i | --index] [-p | --pattern]
-%prog list [-c | --cache] [-s | --server] [-p | --pattern] [-t | --terse]
+%prog modify [-c | --cache] [-s | --server] [-i | --index] [-H | --handle] [-p | --pattern] <job_description>
+%prog delete [-c | --cache] [-s | --server] [-i | --index] [-H | --handle] [-p | --pattern]
+%prog list [-c | --cache ...] [-s | --server] [-p | --pattern] [--under] [-t | --terse] [-a | --archive] [-w | --watch] [--tasks]
+%prog archive [-c | --cache] [-s | --server] [--age] [--status]
 %prog merge [-c | --cache] <[[user@]remote_host:]remote_cache> [remote_hostname]
 %prog update [-c | --cache]
-%prog daemon [-c | --cache]'''
+%prog daemon [-c | --cache ...] [-b | --batch-system]
+%prog run [-c | --cache] [-j | --jobs] [<job_description>] [-- command [arguments]]
+%prog stats [-c | --cache] [-s | --server] [-i | --index] [-H | --handle] [-p | --pattern] [--by] [index ...]
+%prog export [-c | --cache] [-s | --server] [-p | --pattern] [-a | --archive] [--tasks] [-f | --format]
+%prog import [-c | --cache] [-s | --server] [-f | --format] [file]'''
     description = '''Manage and manipulate a set of jobs.
 Options that are not relevant to a command are ignored.  See the man page for
 more details.'''
     epilog='''A job_description consists of
 a series of key: value pairs.  Available keys are job_id, program, path,
-input_fname, output_fname, status, submit and comment.  Allowed status values
-are unknown, held, queueing, running, finished and analysed.  Only job_id,
-program and path are required to add a job and only the attributes to be
-changed are required when modify a job.  Unused attributes are set to null
+input_fname, output_fname, status, submit, comment, depends and tasks.
+Allowed status values are pending, unknown, held, queueing, running, finished,
+failed and analysed.  Only job_id, program and path are required to add a job
+and only the attributes to be changed are required when modify a job.  Unused attributes are set to null
 values.'''
     if sys.version_info[:2] >= (2, 5):
         # have epilog
@@ -364,18 +704,49 @@ values.'''
                                        usage=usage,
                                        description=description,
                                       )
-    parser.add_option('-c', '--cache', default='~/.cache/jm/jm.cache', help='file containing stored job data.  Default: %default.')
+    parser.add_option('-c', '--cache', default=[], action='append', help='file containing stored job data.  Can be specified multiple times or be a glob pattern to list or update jobs in several caches (list and daemon commands only).  Default: ~/.cache/jm/jm.cache.')
+    parser.add_option('--config', default='~/.config/jm/jm.conf', help='configuration file.  Default: %default.')
+    parser.add_option('-z', '--codec', choices=job_manager.cache_codecs, help='compression codec used to store the cache file: %s.  Default: the codec currently used by the cache file (pickle for new cache files).' % (', '.join(job_manager.cache_codecs)))
     parser.add_option('-i', '--index', default=[], action='append', type='int', help='index of desired calculation on the server.  Can be specified multiple times to select multiple jobs.')
+    parser.add_option('-H', '--handle', default=[], action='append', type='int', help='handle of desired calculation on the server, which does not change when other jobs are deleted.  Can be specified multiple times to select multiple jobs.')
     parser.add_option('-s', '--server', default=[], action='append', help='servers of the job.  Can be specified multiple times to select more than one server.  Default: all servers (list command) or localhost (otherwise).')
     parser.add_option('-p', '--pattern', help='Select a job by a given regular expression on the specified server(s).')
+    parser.add_option('--under', help='Select jobs whose path is in the given directory tree.')
+    parser.add_option('-j', '--jobs', type='int', help='maximum number of commands to run at once.  Default: number of processors.')
+    parser.add_option('-b', '--batch-system', choices=[backend.name for backend in job_manager.queue_backends if backend.submit_command('')]+['local'], help='queueing system to which pending jobs are submitted: %s.  local runs the submit script locally.  Default: the first available queueing system or local if none is available.' % (', '.join([backend.name for backend in job_manager.queue_backends if backend.submit_command('')]+['local'])))
     parser.add_option('-t', '--terse', action="store_true", default=False, help="Print only minimal information.")
+    parser.add_option('--tasks', action="store_true", default=False, help="List each task of job arrays separately.")
+    parser.add_option('-w', '--watch', action="store_true", default=False, help="List jobs whenever the cache changes.")
+    parser.add_option('-a', '--archive', action="store_true", default=False, help="List archived jobs.")
+    parser.add_option('--age', type='float', help='Archive only jobs which have not been modified for the given number of days.  Default: archive jobs regardless of age.')
+    parser.add_option('--by', default=[], action='append', choices=['hostname', 'program', 'status'], help='Group jobs by hostname, program and/or status in the statistics.  Can be specified multiple times.  Default: hostname, program and status.')
+    parser.add_option('-f', '--format', default='json', choices=['json', 'csv'], help='format of exported or imported jobs: json (one JSON object per line) or csv.  Default: %default.')
+    parser.add_option('--status', default=[], action='append', help='Archive only jobs with the given status.  Can be specified multiple times.  Default: finished, failed and analysed.')
+
+    # Arguments after -- form the command to be run.
+    if '--' in args:
+        command = args[args.index('--')+1:]
+        args = args[:args.index('--')]
+    else:
+        command = []
 
     (options, args) = parser.parse_args(args)
+    options.command = command
 
     # obtain subcommand
     (subcommand, args) = subcommand_parser(subcommands, args)
 
-    if subcommand != 'list' and len(options.server) == 0:
+    if not options.cache:
+        options.cache = ['~/.cache/jm/jm.cache']
+    if subcommand in ['list', 'daemon']:
+        if len(options.cache) == 1 and not re.search('[*?[]', options.cache[0]):
+            options.cache = options.cache[0]
+    elif len(options.cache) > 1:
+        raise job_manager.UserError('Only the list and daemon commands can use multiple caches.')
+    else:
+        options.cache = options.cache[0]
+
+    if subcommand not in ['list', 'archive', 'stats', 'export', 'import'] and len(options.server) == 0:
         options.server = ['localhost']
 
     # get additional arguments
@@ -384,6 +755,22 @@ values.'''
             raise job_manager.UserError('%s requires a job_desc.' % (subcommand))
         else:
             options.job_desc = job_desc_parser(args)
+    elif subcommand in ['run']:
+        if args:
+            options.job_desc = job_desc_parser(args)
+        else:
+            options.job_desc = {}
+    elif subcommand in ['stats']:
+        try:
+            options.index.extend(int(arg) for arg in args)
+        except ValueError:
+            raise job_manager.UserError('Invalid index: %s.' % (' '.join(args)))
+    elif subcommand in ['import']:
+        if len(options.server) > 1:
+            raise job_manager.UserError('%s accepts only one server.' % (subcommand))
+        if len(args) > 1:
+            raise job_manager.UserError('%s accepts only one file.' % (subcommand))
+        options.import_file = args and args[0] or '-'
     elif subcommand in ['merge']:
         if len(args) == 0:
             raise job_manager.UserError('%s requires a second cache file.' % (subcommand))
@@ -396,6 +783,50 @@ values.'''
 
     return (subcommand, options)
 
+def read_config(fname):
+    '''Read the configuration file.
+
+fname: path to the configuration file.  Ignored if the file does not exist.
+
+Returns the settings for the daemon command and the text_index, columnar and
+mapped settings for the cache.
+
+For full usage, see top-level __doc__.
+'''
+
+    settings = dict(max_jobs=None, max_queued=None, interval=0, max_hooks=None, min_poll=5, max_poll=600, text_index=None, columnar=None, mapped=None)
+    fname = os.path.expanduser(fname)
+    if not os.path.exists(fname):
+        return settings
+    try:
+        import configparser
+    except ImportError:
+        import ConfigParser as configparser
+    config = configparser.RawConfigParser()
+    config.read(fname)
+    if config.has_section('daemon'):
+        for setting in ['max_jobs', 'max_queued', 'max_hooks']:
+            if config.has_option('daemon', setting):
+                settings[setting] = config.getint('daemon', setting)
+        for setting in ['interval', 'min_poll', 'max_poll']:
+            if config.has_option('daemon', setting):
+                settings[setting] = config.getfloat('daemon', setting)
+    for setting in ['text_index', 'columnar', 'mapped']:
+        if config.has_option('cache', setting):
+            settings[setting] = config.getboolean('cache', setting)
+    for program in config.sections():
+        if program in ['daemon', 'cache']:
+            continue
+        markers = dict(finished=None, failed=None)
+        for marker in markers:
+            if config.has_option(program, marker):
+                markers[marker] = config.get(program, marker)
+        if markers['finished'] or markers['failed']:
+            job_manager.register_completion_markers(program, **markers)
+        if config.has_option(program, 'hook'):
+            job_manager.register_completion_hook(program, config.get(program, 'hook'))
+    return settings
+
 ### command-line interface ###
 
 def add(options):
@@ -406,12 +837,18 @@ options: optparse.Values instance as returned by option_parser.
 For full usage, see top-level __doc__.
 '''
     
-    job_cache = job_manager.JobCache(options.cache, load=True)
-    for server in options.server:
-        if server not in job_cache.job_servers:
-            job_cache.add_server(options.server)
-        job_cache.job_servers[server].add(options.job_desc)
-    job_cache.dump()
+    job_cache = job_manager.JobCache(options.cache, codec=options.codec, text_index=options.settings['text_index'], columnar=options.settings['columnar'], mapped=options.settings['mapped'])
+    if options.codec:
+        # The cache must be rewritten with the new codec.
+        with job_cache.transaction():
+            for server in options.server:
+                if server not in job_cache.job_servers:
+                    job_cache.add_server(server)
+                job_cache.job_servers[server].add(options.job_desc)
+    else:
+        # Fast path: append to the cache file without reading it.
+        for server in options.server:
+            job_cache.append(options.job_desc, server)
 
 def delete(options):
     '''Delete a job.
@@ -421,10 +858,10 @@ options: optparse.Values instance as returned by option_parser.
 For full usage, see top-level __doc__.
 '''
 
-    job_cache = job_manager.JobCache(options.cache, load=True)
-    for server in options.server:
-        job_cache.job_servers[server].delete(options.index, options.pattern)
-    job_cache.dump()
+    job_cache = job_manager.JobCache(options.cache, codec=options.codec, text_index=options.settings['text_index'], columnar=options.settings['columnar'], mapped=options.settings['mapped'])
+    with job_cache.transaction():
+        for server in options.server:
+            job_cache.job_servers[server].delete(options.index, options.pattern, options.handle)
 
 def modify(options):
     '''Modify a job.
@@ -434,10 +871,10 @@ options: optparse.Values instance as returned by option_parser.
 For full usage, see top-level __doc__.
 '''
 
-    job_cache = job_manager.JobCache(options.cache, load=True)
-    for server in options.server:
-        job_cache.job_servers[server].modify(options.job_desc, options.index, options.pattern)
-    job_cache.dump()
+    job_cache = job_manager.JobCache(options.cache, codec=options.codec, text_index=options.settings['text_index'], columnar=options.settings['columnar'], mapped=options.settings['mapped'])
+    with job_cache.transaction():
+        for server in options.server:
+            job_cache.job_servers[server].modify(options.job_desc, options.index, options.pattern, options.handle)
 
 def list_jobs(options):
     '''List jobs.
@@ -447,8 +884,86 @@ options: optparse.Values instance as returned by option_parser.
 For full usage, see top-level __doc__.
 '''
 
-    job_cache = job_manager.JobCache(options.cache, load=True)
-    job_cache.pretty_print(options.server, options.pattern, options.terse)
+    if isinstance(options.cache, list):
+        job_cache = job_manager.JobCacheGroup(options.cache)
+    else:
+        job_cache = job_manager.JobCache(options.cache, codec=options.codec, text_index=options.settings['text_index'], columnar=options.settings['columnar'], mapped=options.settings['mapped'])
+    if options.watch:
+        try:
+            watch_jobs(job_cache, options)
+        except KeyboardInterrupt:
+            pass
+    else:
+        mapped = None
+        if isinstance(job_cache, job_manager.JobCache) and not options.archive:
+            mapped = job_cache.open_mapped()
+        if mapped is not None:
+            mapped.pretty_print(options.server, options.pattern, options.terse, options.tasks, options.under)
+        else:
+            load_snapshot(job_cache)
+            job_cache.pretty_print(options.server, options.pattern, options.terse, options.archive, options.tasks, options.under)
+
+def load_snapshot(job_cache):
+    '''Load jobs without locking the cache(s).
+
+job_cache: JobCache or JobCacheGroup instance.
+'''
+
+    if isinstance(job_cache, job_manager.JobCacheGroup):
+        job_cache.load()
+    else:
+        job_cache.load(lock=False)
+
+def watch_jobs(job_cache, options):
+    '''List jobs whenever the cache changes, redrawing only changed rows.
+
+job_cache: JobCache or JobCacheGroup instance.
+options: optparse.Values instance as returned by option_parser.
+
+For full usage, see top-level __doc__.
+'''
+
+    tty = sys.stdout.isatty()
+    lines = []
+    version = None
+    while True:
+        version = job_cache.version()
+        load_snapshot(job_cache)
+        new_lines = job_cache.format_jobs(options.server, options.pattern, options.terse, options.archive, options.tasks, options.under)
+        if len(new_lines) == len(lines) and new_lines[:1] == lines[:1]:
+            # Same table layout: only output the rows which have changed.
+            for (i, line) in enumerate(new_lines):
+                if line != lines[i]:
+                    if tty:
+                        # Move up to the row, redraw it and move back down.
+                        up = len(lines) - i
+                        sys.stdout.write('\033[%iA\r%s\033[K\033[%iB\r' % (up, line, up))
+                    else:
+                        sys.stdout.write('%s\n' % (line))
+        else:
+            if tty:
+                # Clear screen.
+                sys.stdout.write('\033[H\033[2J')
+            for line in new_lines:
+                sys.stdout.write('%s\n' % (line))
+        sys.stdout.flush()
+        lines = new_lines
+        job_cache.wait(version)
+
+def archive(options):
+    '''Archive jobs.
+
+options: optparse.Values instance as returned by option_parser.
+
+For full usage, see top-level __doc__.
+'''
+
+    statuses = options.status or [job_manager.JobStatus.finished, job_manager.JobStatus.failed, job_manager.JobStatus.analysed]
+    max_age = None
+    if options.age is not None:
+        max_age = options.age*24*60*60
+    job_cache = job_manager.JobCache(options.cache, load=True, codec=options.codec, text_index=options.settings['text_index'], columnar=options.settings['columnar'], mapped=options.settings['mapped'])
+    job_cache.archive_jobs(options.server, statuses, max_age)
     job_cache.dump()
 
 def merge(options):
@@ -459,6 +974,9 @@ options: optparse.Values instance as returned by option_parser.
 For full usage, see top-level __doc__.
 '''
 
+    import subprocess
+    import tempfile
+
     tmp_cache = None
     if re.match('.*?(.*?):', options.remote_cache):
         # a cache on a remote server has been provided
@@ -477,37 +995,93 @@ For full usage, see top-level __doc__.
     if not options.remote_server:
         raise job_manager.UserError('No remote_server specified.')
 
-    job_cache = job_manager.JobCache(options.cache, load=True)
-    job_cache_remote = job_manager.JobCache(options.remote_cache, load=True)
+    job_cache = job_manager.JobCache(options.cache, codec=options.codec, text_index=options.settings['text_index'], columnar=options.settings['columnar'], mapped=options.settings['mapped'])
+    job_cache_remote = job_manager.JobCache(options.remote_cache)
+    job_cache_remote.load(lock=False)
 
-    job_cache.merge(job_cache_remote, options.remote_server)
+    with job_cache.transaction():
+        job_cache.merge(job_cache_remote, options.remote_server)
 
-    job_cache.dump()
     if tmp_cache:
         os.remove(tmp_cache.name)
 
 def daemon(options):
-    '''Auto-update status of any queueing or running jobs once a minute.
+    '''Auto-update status of any queueing or running jobs and submit pending jobs.
     
-Designed to run in the background.  Only jobs on the localhost JobServer are updated.
+The time between updates is adapted to the activity of the jobs (see
+job_manager.PollInterval).  Designed to run in the background.  Only jobs on the localhost JobServer are updated.
+
+If several caches are given, the queueing systems are queried once per update
+for all jobs of the current user and the caches are updated concurrently using
+the same queue snapshot.
 
 options: optparse.Values instance as returned by option_parser.
 
 For full usage, see top-level __doc__.
 '''
 
-    job_cache = job_manager.JobCache(options.cache)
+    if isinstance(options.cache, list):
+        # Only used to find and watch the cache files.
+        group = job_manager.JobCacheGroup(options.cache)
+        caches = group.sources
+    else:
+        group = None
+        caches = [options.cache]
+    if options.batch_system == 'local':
+        backend = None
+    elif options.batch_system:
+        backend = [backend for backend in job_manager.queue_backends if backend.name == options.batch_system][0]
+    else:
+        backend = job_manager.find_submit_backend()
+    settings = dict(options.settings)
+    settings.pop('text_index')
+    settings.pop('columnar')
+    settings.pop('mapped')
+    max_hooks = settings.pop('max_hooks')
+    poll = job_manager.PollInterval(settings.pop('min_poll'), settings.pop('max_poll'))
+    daemons = []
+    for cache in caches:
+        job_cache = job_manager.JobCache(cache, codec=options.codec, text_index=options.settings['text_index'], columnar=options.settings['columnar'], mapped=options.settings['mapped'])
+        daemons.append((job_cache, job_manager.Scheduler(job_cache, backend, **settings),
+                        job_manager.HookRunner(job_cache, max_hooks)))
+    if group is None:
+        watched = daemons[0][0]
+        pool = None
+    else:
+        import multiprocessing.pool
+        watched = group
+        pool = multiprocessing.pool.ThreadPool(min(group.threads, len(daemons)))
 
-    while True:
-        time.sleep(60)
+    def cycle(daemon, snapshot=None):
+        (job_cache, scheduler, hooks) = daemon
         try:
-            job_cache.load()
-            job_cache.auto_update()
-            job_cache.dump()
-        except job_manager.LockException:
+            # Don't wait for the lock: other caches would wait too.
+            scheduler.cycle(snapshot=snapshot, max_attempts=1)
+            for (job_id, deps) in sorted(scheduler.unresolved.items()):
+                sys.stderr.write('%s: job %s failed: unknown dependencies: %s.\n' % (job_cache.cache, job_id, ' '.join(sorted(deps))))
+            hooks.cycle(max_attempts=1)
+        except (job_manager.LockException, job_manager.TransactionConflict):
             # quietly skip this update if the cache is in use.
             pass
 
+    changed = False
+    while True:
+        start = time.time()
+        if pool is None:
+            cycle(daemons[0])
+        else:
+            # Query each queueing system once for all caches.
+            snapshot = job_manager.queue_snapshot()
+            pool.map(lambda daemon: cycle(daemon, snapshot), daemons)
+        active = sum(scheduler.active + len(hooks.running) for (job_cache, scheduler, hooks) in daemons)
+        transitions = sum(scheduler.transitions for (job_cache, scheduler, hooks) in daemons)
+        interval = poll.update(active, transitions, changed)
+        # Wake early if another process modifies the cache (e.g. to add
+        # jobs), but never update more often than every min_poll seconds.
+        version = watched.version()
+        changed = watched.wait(version, timeout=interval) != version
+        time.sleep(max(0, start + poll.min_interval - time.time()))
+
 def update(options):
     '''Auto-update status of any queueing or running jobs.
 
@@ -515,10 +1089,180 @@ options: optparse.Values instance as returned by option_parser.
 
 For full usage, see top-level __doc__.
 '''
-    job_cache = job_manager.JobCache(options.cache)
-    job_cache.load()
-    job_cache.auto_update()
-    job_cache.dump()
+    job_cache = job_manager.JobCache(options.cache, codec=options.codec, text_index=options.settings['text_index'], columnar=options.settings['columnar'], mapped=options.settings['mapped'])
+    job_cache.transact(auto_update_localhost)
+
+def run(options):
+    '''Run commands and record them as jobs.
+
+options: optparse.Values instance as returned by option_parser.
+
+For full usage, see top-level __doc__.
+'''
+
+    job_cache = job_manager.JobCache(options.cache, codec=options.codec, text_index=options.settings['text_index'], columnar=options.settings['columnar'], mapped=options.settings['mapped'])
+    executor = job_manager.LocalExecutor(job_cache, options.jobs)
+    job_spec = dict((key, val) for (key, val) in options.job_desc.items() if val and key != 'job_id')
+    if options.command:
+        executor.submit(options.command, job_spec)
+    else:
+        for line in sys.stdin:
+            if line.strip():
+                executor.submit(line.strip(), job_spec)
+    executor.run()
+
+def stats(options):
+    '''Summarise the resources used by jobs or the wait and run times of all jobs.
+
+options: optparse.Values instance as returned by option_parser.
+
+For full usage, see top-level __doc__.
+'''
+
+    job_cache = job_manager.JobCache(options.cache, codec=options.codec, text_index=options.settings['text_index'], columnar=options.settings['columnar'], mapped=options.settings['mapped'])
+    job_cache.load(lock=False)
+    if not (options.index or options.handle or options.pattern):
+        group_by = options.by or ['hostname', 'program', 'status']
+        times = job_cache.job_times(options.server)
+        for line in format_statistics(times.statistics(group_by), group_by):
+            print(line)
+        return
+    for server in options.server or ['localhost']:
+        if server not in job_cache.job_servers:
+            raise job_manager.UserError('Server does not exist: %s.' % (server))
+        jobs = job_cache.job_servers[server].jobs
+        indices = []
+        for index in options.index:
+            if not -len(jobs) <= index < len(jobs):
+                raise job_manager.UserError('No job with index %s on %s.' % (index, server))
+            if index % len(jobs) not in indices:
+                indices.append(index % len(jobs))
+        if options.pattern:
+            indices.extend(index for (index, job) in enumerate(jobs) if job.match(options.pattern) and index not in indices)
+        if options.handle:
+            indices.extend(index for (index, job) in enumerate(jobs) if job.handle in options.handle and index not in indices)
+        for index in indices:
+            for line in format_resources(server, index, jobs[index]):
+                print(line)
+
+def format_statistics(statistics, group_by):
+    '''Format the statistics of the wait and run times of groups of jobs.
+
+statistics: list of dictionaries as returned by job_manager.JobTimes.statistics
+    using the default percentiles.
+group_by: list of columns used to group the jobs.
+
+Returns a list of lines.
+'''
+
+    def duration(seconds):
+        if seconds is None:
+            return '-'
+        (minutes, seconds) = divmod(int(round(seconds)), 60)
+        (hours, minutes) = divmod(minutes, 60)
+        return '%i:%02i:%02i' % (hours, minutes, seconds)
+    header = list(group_by) + ['count', 'jobs/day']
+    for kind in ['wait', 'run']:
+        header.extend('%s p%i' % (kind, percentile) for percentile in (50, 90, 99))
+    rows = []
+    for group in statistics:
+        row = [group[name] for name in group_by]
+        row.append(str(group['count']))
+        if group['throughput'] is None:
+            row.append('-')
+        else:
+            row.append('%.1f' % (group['throughput']))
+        for kind in ['wait', 'run']:
+            row.extend(duration(val) for val in (group[kind] or [None]*3))
+        rows.append(row)
+    lines = []
+    if rows:
+        lengths = [max(len(row[col]) for row in [header]+rows) for col in range(len(header))]
+        fmt = '  '.join('%%-%is' % (length) for length in lengths)
+        lines.append(fmt % tuple(header))
+        lines.append(fmt % tuple('-'*length for length in lengths))
+        lines.extend(fmt % tuple(row) for row in rows)
+    return lines
+
+def format_resources(server, index, job):
+    '''Format the summary of the resources used by a job.
+
+server: hostname of the job.
+index: index of the job.
+job: job_manager.Job instance.
+
+Returns a list of lines.
+'''
+
+    lines = ['%s %i: %s (%s, %s, %s)' % (server, index, job.job_id, job.program, job.path, job.status)]
+    if job.hook_status is not None:
+        lines.append('    hook      exit status %i after %.1f s' % (job.hook_status, job.hook_time))
+        if job.hook_output:
+            lines.append('    hook      %s' % (job.hook_output.splitlines()[-1]))
+    if not job.resources:
+        lines.append('    no resource usage recorded.')
+        return lines
+    summary = job.resources.summary()
+    (hours, seconds) = divmod(summary['elapsed'], 3600)
+    def rate(val, fmt):
+        if val is None:
+            return 'unknown'
+        else:
+            return fmt % (val)
+    lines.extend([
+        '    samples   %i over %i:%02i:%02i (1 sample per %i updates)' % (summary['samples'], hours, seconds//60, seconds%60, job.resources.stride),
+        '    cpu       %.1f s, %s cores on average, %s cores recently' % (summary['cpu'], rate(summary['cpu_rate'], '%.2f'), rate(summary['recent_cpu_rate'], '%.2f')),
+        '    memory    %.1f MiB, peak %.1f MiB, %+.1f MiB over the second half' % (summary['rss'], summary['peak_rss'], summary['rss_growth']),
+        '    read      %.1f MiB, %s MiB/s recently' % (summary['read'], rate(summary['recent_read_rate'], '%.2f')),
+        '    written   %.1f MiB, %s MiB/s recently' % (summary['write'], rate(summary['recent_write_rate'], '%.2f')),
+    ])
+    if job.status == job_manager.JobStatus.running and summary['recent_cpu_rate'] is not None and summary['recent_cpu_rate'] < 0.01:
+        lines.append('    warning: job has recently used almost no CPU time and might have stalled.')
+    if summary['samples'] > 2 and summary['rss_growth'] > 0.25*summary['rss'] and summary['rss_growth'] > 100:
+        lines.append('    warning: memory usage is growing and might be leaking.')
+    return lines
+
+def export_jobs(options):
+    '''Export jobs as JSON lines or CSV.
+
+options: optparse.Values instance as returned by option_parser.
+
+For full usage, see top-level __doc__.
+'''
+
+    job_cache = job_manager.JobCache(options.cache, codec=options.codec, text_index=options.settings['text_index'], columnar=options.settings['columnar'], mapped=options.settings['mapped'])
+    job_cache.load(lock=False)
+    records = job_cache.records(options.server, options.pattern, options.archive, options.tasks)
+    for line in job_manager.format_records(records, options.format):
+        sys.stdout.write(line)
+
+def import_jobs(options):
+    '''Import jobs from JSON lines or CSV.
+
+options: optparse.Values instance as returned by option_parser.
+
+For full usage, see top-level __doc__.
+'''
+
+    if options.import_file == '-':
+        import_f = sys.stdin
+    else:
+        import_f = open(options.import_file)
+    try:
+        job_cache = job_manager.JobCache(options.cache, codec=options.codec, text_index=options.settings['text_index'], columnar=options.settings['columnar'], mapped=options.settings['mapped'])
+        records = job_manager.parse_records(import_f, options.format)
+        hostname = options.server and options.server[0] or None
+        job_cache.import_records(records, hostname)
+    finally:
+        if import_f is not sys.stdin:
+            import_f.close()
+
+def auto_update_localhost(job_servers):
+    '''Auto-update status of any queueing or running jobs on the localhost server.
+
+job_servers: dictionary of JobServer instances, as passed by JobCache.transact.
+'''
+    job_servers['localhost'].auto_update()
 
 ### main ###
 
@@ -535,12 +1279,19 @@ For full usage, see top-level __doc__.
                        modify=modify,
                        delete=delete,
                        list=list_jobs,
+                       archive=archive,
                        merge=merge,
                        daemon=daemon,
                        update=update,
+                       run=run,
+                       stats=stats,
+                       export=export_jobs,
                       )
+    # import is a keyword.
+    subcommands['import'] = import_jobs
 
     (subcommand, options) = option_parser(subcommands.keys(), args)
+    options.settings = read_config(options.config)
 
     if subcommand:
         if subcommand in subcommands:
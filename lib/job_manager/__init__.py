@@ -31,13 +31,45 @@ unless otherwise noted.
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import array
+import bisect
 import copy
+import mmap
+import errno
+import heapq
+import io
+import json
 import os
 import os.path
 import pickle
 import re
+import select
+import struct
 import time
-import subprocess
+import sys
+
+# Modules only used by some operations (e.g. subprocess, numpy) are imported
+# when first needed, so that short-lived commands (e.g. adding a job from a
+# submit script) start quickly.
+
+# numpy module, imported by _numpy.  JobTimes falls back to the array module if
+# numpy is not available.
+numpy = None
+_numpy_imported = False
+
+def _numpy():
+    '''Import numpy if available.
+
+:returns: the numpy module or None if it is not available.
+'''
+    global numpy, _numpy_imported
+    if not _numpy_imported:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_imported = True
+    return numpy
 
 ### Custom exceptions ###
 
@@ -50,19 +82,1093 @@ class LockException(Exception):
     '''Raised if a lock cannot be acquired.'''
     pass
 
+
+class TransactionConflict(Exception):
+    '''Raised if a :class:`Transaction` conflicts with changes made to the cache by another process.'''
+    pass
+
+### Queue backends ###
+
+def _user():
+    '''Find the name of the current user.'''
+    import getpass
+    return getpass.getuser()
+
+class QueueBackend:
+    '''Interface to a system which reports the status of jobs.
+
+To add a queueing system, subclass :class:`QueueBackend`, define
+:meth:`command` and :meth:`parse` and register an instance using
+:func:`register_queue_backend`.  A backend should query for as few jobs as
+possible: only the jobs belonging to the current user or, if cheaper, only the
+jobs of interest.
+
+.. attribute:: name
+
+    name of the queueing system.
+
+.. attribute:: held
+
+    regular expression matching the status of a held job (not used if None).
+
+.. attribute:: queueing
+
+    regular expression matching the status of a queueing job (not used if None).
+
+.. attribute:: running
+
+    regular expression matching the status of a running job (not used if None).
+
+.. attribute:: finished
+
+    regular expression matching the status of a job which has finished but is
+    still reported by the queueing system (not used if None).
+
+If any of :attr:`held`, :attr:`queueing` and :attr:`running` are None then all
+jobs found are assumed to be running.
+'''
+    name = None
+    held = None
+    queueing = None
+    running = None
+    finished = None
+
+    def command(self, job_ids):
+        '''Create the command to query the queueing system.
+
+:type job_ids: list of strings
+:param job_ids: ids of the jobs of interest.  If None, then all jobs
+    belonging to the current user are of interest.
+
+:rtype: list of strings
+:returns: command and arguments to be executed or None if there is nothing to
+    query.
+'''
+        raise NotImplementedError
+
+    def parse(self, output):
+        '''Extract the status of jobs from the output of :meth:`command`.
+
+:param string output: standard output of the command.
+
+:rtype: iterable of (string, string) tuples.
+:returns: job id and status (as reported by the queueing system) of each job.
+'''
+        raise NotImplementedError
+
+    def success(self, returncode):
+        '''Test if the return code of :meth:`command` indicates success.'''
+        return returncode == 0
+
+    def submit_command(self, script):
+        '''Create the command to submit a job to the queueing system.
+
+:param string script: submit script.
+
+:rtype: list of strings
+:returns: command and arguments to be executed or None if jobs cannot be
+    submitted to the queueing system.
+'''
+        return None
+
+    def parse_submit(self, output):
+        '''Extract the job id from the output of :meth:`submit_command`.
+
+:param string output: standard output of the command.
+
+:rtype: string
+:returns: job id or None if the job id is not found.
+'''
+        output = output.strip()
+        if output:
+            return output.split()[0]
+        else:
+            return None
+
+    def submit(self, script, path):
+        '''Submit a job to the queueing system.
+
+:param string script: submit script.
+:param string path: directory from which the job is submitted.
+
+:rtype: string
+:returns: job id assigned by the queueing system.
+'''
+        import subprocess
+        command = self.submit_command(script)
+        if command is None:
+            raise UserError('Cannot submit jobs to %s.' % (self.name))
+        try:
+            submit_popen = subprocess.Popen(command, cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        except OSError:
+            raise UserError('Cannot execute %s: %s.' % (command[0], sys.exc_info()[1]))
+        (output, error) = submit_popen.communicate()
+        job_id = self.parse_submit(output)
+        if submit_popen.returncode != 0 or not job_id:
+            raise UserError('%s returned: %i.  Error: %s' % (command[0], submit_popen.returncode, error.strip()))
+        return job_id
+
+    def status(self, stat):
+        '''Convert a status reported by the queueing system to a :class:`JobStatus`.
+
+:param string stat: status reported by the queueing system.
+
+:rtype: string
+:returns: attribute of :class:`JobStatus` or None if the status is not
+    recognised.
+'''
+        if not (self.held and self.queueing and self.running):
+            # don't know about status.  assume running.
+            return JobStatus.running
+        elif re.match(self.held, stat):
+            return JobStatus.held
+        elif re.match(self.queueing, stat):
+            return JobStatus.queueing
+        elif re.match(self.running, stat):
+            return JobStatus.running
+        elif self.finished and re.match(self.finished, stat):
+            return JobStatus.finished
+        else:
+            return None
+
+    def query(self, job_ids=None):
+        '''Query the queueing system.
+
+:type job_ids: list of strings
+:param job_ids: ids of the jobs of interest.  See :meth:`command`.
+
+:rtype: dictionary
+:returns: status (see :meth:`status`) of each job found, keyed by the job id
+    reported by the queueing system, or None if the queueing system is not
+    available.
+'''
+        import subprocess
+        command = self.command(job_ids)
+        if command is None:
+            return {}
+        try:
+            queue_popen = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        except OSError:
+            # command doesn't exists on this server---skip.
+            return None
+        output = queue_popen.communicate()[0]
+        if not self.success(queue_popen.returncode):
+            return None
+        return dict((job_id, self.status(stat)) for (job_id, stat) in self.parse(output))
+
+
+class ColumnQueueBackend(QueueBackend):
+    '''Queueing system whose output contains one job per line in columns.
+
+.. attribute:: job_column
+
+    column of output which contains the job id field (0-indexed).
+
+.. attribute:: status_column
+
+    column of output which contains the status field (0-indexed).
+
+.. attribute:: row
+
+    regular expression which matches the start of lines containing a job.
+    Other lines (e.g. headers and summaries) are ignored.
+'''
+    job_column = 0
+    status_column = 1
+    row = r'\S'
+
+    def parse(self, output):
+        '''Extract the job id and status columns from each line of output.'''
+        for line in output.splitlines():
+            if re.match(self.row, line):
+                fields = line.split()
+                yield (fields[self.job_column], fields[self.status_column])
+
+
+class PsBackend(ColumnQueueBackend):
+    '''Processes running on the local computer.
+
+Only the processes with the job ids of interest are listed.  All processes are
+assumed to be running.
+'''
+    name = 'ps'
+    row = r'\s*\d'
+
+    def command(self, job_ids):
+        if job_ids is None:
+            return ['ps', '-o', 'pid=', '-o', 'stat=', '-u', _user()]
+        pids = [job_id for job_id in job_ids if job_id.isdigit()]
+        if pids:
+            return ['ps', '-o', 'pid=', '-o', 'stat=', '-p', ','.join(pids)]
+        else:
+            return None
+
+    def success(self, returncode):
+        # ps returns 1 if none of the requested processes exist.
+        return returncode in (0, 1)
+
+
+class PBSBackend(ColumnQueueBackend):
+    '''PBS (and Torque) queueing system.  Only the user's jobs are listed.
+
+The tasks of job arrays are listed individually (e.g. 1234[7].server).
+'''
+    name = 'pbs'
+    row = r'\d'
+    status_column = -2
+    held = 'H'
+    queueing = 'Q'
+    running = 'R|B'
+    finished = 'X'
+
+    def command(self, job_ids):
+        return ['qstat', '-t', '-u', _user()]
+
+    def submit_command(self, script):
+        return ['qsub', script]
+
+
+class LoadLevelerBackend(ColumnQueueBackend):
+    '''LoadLeveler queueing system.  Only the user's jobs are listed.'''
+    name = 'loadleveler'
+    row = r'\S+\.\d+\.\d+\s'
+    status_column = 3
+    held = 'H|NQ|S'
+    queueing = 'I'
+    running = 'R'
+
+    def command(self, job_ids):
+        return ['llq', '-u', _user()]
+
+    def submit_command(self, script):
+        return ['llsubmit', script]
+
+    def parse_submit(self, output):
+        # llsubmit: The job "host.123" has been submitted.
+        match = re.search('"(.*?)"', output)
+        if match:
+            return match.group(1)
+        else:
+            return None
+
+
+class SlurmBackend(ColumnQueueBackend):
+    '''Slurm queueing system.  Only the user's jobs are listed.
+
+Running tasks of job arrays are listed individually (e.g. 1234_7) and pending
+tasks as a range (e.g. 1234_[8-5000]).
+'''
+    name = 'slurm'
+    held = 'S|ST|RH|RQ'
+    queueing = 'PD|CF'
+    running = 'R|CG|SO'
+
+    def command(self, job_ids):
+        return ['squeue', '--noheader', '--user', _user(), '--format', '%i %t']
+
+    def submit_command(self, script):
+        return ['sbatch', '--parsable', script]
+
+    def parse_submit(self, output):
+        # jobid[;cluster]
+        output = output.strip()
+        if output:
+            return output.split(';')[0]
+        else:
+            return None
+
+
+class QueueSnapshot:
+    '''Status of jobs reported by the queueing systems at a given time.
+
+:type statuses: dictionary
+:param statuses: status of each job, keyed by job id, as returned by
+    :meth:`QueueBackend.query`.  Not an attribute.
+
+.. attribute:: statuses
+
+    dictionary of the status of each job found, keyed by the job id reported
+    by the queueing system.
+
+.. attribute:: time
+
+    time (in seconds since the epoch) at which the snapshot was created, i.e.
+    before the queueing systems were queried.
+
+Tasks of job arrays (e.g. 1234[7] or 1234_[8-5000]) are also indexed by the id
+of the array.  See :meth:`find_tasks`.
+'''
+    def __init__(self, statuses=None):
+        self.time = time.time()
+        self.statuses = {}
+        # Queueing systems often append the server name to the job id (e.g.
+        # 1234.server) which the user might not have recorded.
+        self._short_ids = {}
+        # (first, last, status) of tasks found, keyed by array id.
+        self._arrays = {}
+        if statuses:
+            self.update(statuses)
+
+    def __repr__(self):
+        return self.statuses.__repr__()
+
+    def update(self, statuses):
+        '''Add the status of jobs found by a queueing system.
+
+Job statuses reported by later queueing systems take precedence.
+
+:type statuses: dictionary
+:param statuses: see :meth:`QueueBackend.query`.  Ignored if None.
+'''
+        if statuses:
+            self.statuses.update(statuses)
+            for (job_id, status) in statuses.items():
+                self._short_ids[job_id.split('.')[0]] = job_id
+                task = _ARRAY_TASK.match(job_id)
+                if task:
+                    tasks = self._arrays.setdefault(task.group(1), [])
+                    if task.group(2):
+                        tasks.extend((first, last, status) for (first, last) in _parse_task_ranges(task.group(2)))
+                    else:
+                        # The array as a whole: applies to any tasks not listed.
+                        tasks.append((None, None, status))
+
+    def find(self, job_id):
+        '''Find a job in the snapshot.
+
+:type job_id: string or integer
+:param job_id: id of the job.  The id may omit the server name appended to the
+    job id by some queueing systems.
+
+:rtype: string
+:returns: job id as reported by the queueing system or None if the job was not
+    found.
+'''
+        job_id = str(job_id)
+        if job_id in self.statuses:
+            return job_id
+        else:
+            return self._short_ids.get(job_id)
+
+    def find_tasks(self, job_id):
+        '''Find the tasks of a job array in the snapshot.
+
+:type job_id: string or integer
+:param job_id: id of the array (e.g. 1234, 1234[] or 1234[].server).
+
+:rtype: list of (integer, integer, string) tuples
+:returns: first and last task index and status of each range of tasks found,
+    sorted by task index, or None if the array was not found.  If only the
+    array as a whole was found, then a single range covering all tasks is
+    returned.
+'''
+        tasks = self._arrays.get(_array_id(job_id))
+        if tasks is None:
+            return None
+        ranges = sorted((task for task in tasks if task[0] is not None), key=lambda task: task[:2])
+        if not ranges:
+            status = [task[2] for task in tasks][-1]
+            return [(0, sys.maxsize, status)]
+        found = []
+        for (first, last, status) in ranges:
+            if found and first <= found[-1][1]:
+                # overlaps a range from another queueing system.
+                first = found[-1][1] + 1
+            if first <= last:
+                found.append((first, last, status))
+        return found
+
+
+# id of a task in a job array: array id, task indices and optional server, e.g.
+# 1234[7].server (PBS), 1234[].server (PBS, whole array), 1234_7 and
+# 1234_[8-5000%10] (Slurm).
+_ARRAY_TASK = re.compile(r'^([^\[_.]+)(?:\[|_\[?)([0-9,:\-]*)(?:%\d+)?\]?(?:\..*)?$')
+
+def _array_id(job_id):
+    '''Strip task indices and server name from the id of a job array.'''
+    return re.match(r'[^\[_.]*', str(job_id)).group(0)
+
+def _parse_task_ranges(indices):
+    '''Parse a list of task indices (e.g. 1,3-5,8-20:4).
+
+:rtype: list of (integer, integer) tuples
+:returns: first and last index of each range of tasks.
+'''
+    ranges = []
+    for item in indices.split(','):
+        if not item:
+            continue
+        (bounds, sep, step) = item.partition(':')
+        (first, sep, last) = bounds.partition('-')
+        first = int(first)
+        last = int(last or first)
+        if step and int(step) > 1:
+            ranges.extend((index, index) for index in range(first, last+1, int(step)))
+        else:
+            ranges.append((first, last))
+    return ranges
+
+# Registered queueing systems in the order in which they are queried.
+queue_backends = [PsBackend(), PBSBackend(), LoadLevelerBackend(), SlurmBackend()]
+
+def register_queue_backend(backend):
+    '''Register a queueing system to be used by :meth:`Job.auto_update`.
+
+:type backend: :class:`QueueBackend`
+:param backend: queueing system.  Job statuses reported by later backends take
+    precedence over earlier ones.
+'''
+    queue_backends.append(backend)
+
+def find_submit_backend(backends=None):
+    '''Find a queueing system to which jobs can be submitted.
+
+:type backends: list of :class:`QueueBackend` instances
+:param backends: queueing systems to consider.  Default: all registered
+    backends.
+
+:rtype: :class:`QueueBackend`
+:returns: the first queueing system whose submit command is available or None
+    if no such queueing system is available.
+'''
+    if backends is None:
+        backends = queue_backends
+    for backend in backends:
+        command = backend.submit_command('')
+        if command:
+            for directory in os.environ.get('PATH', '').split(os.pathsep):
+                if os.access(os.path.join(directory, command[0]), os.X_OK):
+                    return backend
+    return None
+
+def queue_snapshot(job_ids=None, backends=None):
+    '''Query the queueing systems for the status of jobs.
+
+:type job_ids: list of strings
+:param job_ids: ids of the jobs of interest.  If None, then all jobs belonging
+    to the current user are of interest.
+:type backends: list of :class:`QueueBackend` instances
+:param backends: queueing systems to query.  Default: all registered backends.
+
+:rtype: :class:`QueueSnapshot`
+'''
+    if backends is None:
+        backends = queue_backends
+    snapshot = QueueSnapshot()
+    for backend in backends:
+        snapshot.update(backend.query(job_ids))
+    return snapshot
+
+### Output files ###
+
+# Markers indicating that a program has finished or failed, keyed by program.
+# See register_completion_markers.
+completion_markers = {}
+
+def register_completion_markers(program, finished=None, failed=None):
+    '''Register markers used to detect completion from the output of a program.
+
+See :meth:`Job.scan_output`.
+
+:param string program: name of the program (see :class:`Job`).
+:param string finished: regular expression found near the end of the output
+    file of a job which has completed successfully.
+:param string failed: regular expression found near the end of the output file
+    of a job which has failed.  Takes precedence over finished.
+
+The regular expressions are applied to each line of the output file (i.e. in
+multi-line mode).
+'''
+    markers = dict(finished=None, failed=None)
+    for (name, marker) in (('finished', finished), ('failed', failed)):
+        if marker:
+            markers[name] = re.compile(marker.encode(), re.MULTILINE)
+    completion_markers[program] = markers
+
+### Resource usage ###
+
+class ResourceSamples:
+    '''Samples of the resources used by a job over time.
+
+The samples are stored in fixed-size arrays, so the storage required is
+bounded however long the job runs.  Once the arrays are full, every other
+sample is discarded and subsequently only one sample is kept in every
+:attr:`stride` (which is doubled) samples added, so the samples always span the
+whole job at a resolution which decreases as the job runs.  The most recent
+sample is always kept.
+
+:param integer capacity: maximum number of samples stored.  Should be even.
+
+.. attribute:: start
+
+    time (in seconds since the epoch) of the first sample.
+
+.. attribute:: stride
+
+    number of samples added for each sample stored.
+
+.. attribute:: times
+
+    time of each sample, in seconds since :attr:`start`.
+
+.. attribute:: cpu
+
+    CPU (user and system) time used by the job, in seconds, at each sample.
+
+.. attribute:: rss
+
+    resident memory used by the job, in MiB, at each sample.
+
+.. attribute:: read
+
+    data read from storage by the job, in MiB, at each sample.
+
+.. attribute:: write
+
+    data written to storage by the job, in MiB, at each sample.
+'''
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.start = None
+        self.stride = 1
+        # number of samples added since the last sample was stored.
+        self._added = 0
+        self.times = array.array('I')
+        self.cpu = array.array('f')
+        self.rss = array.array('f')
+        self.read = array.array('f')
+        self.write = array.array('f')
+
+    def __len__(self):
+        return len(self.times)
+
+    def __eq__(self, other):
+        return isinstance(other, ResourceSamples) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _columns(self):
+        return (self.times, self.cpu, self.rss, self.read, self.write)
+
+    def add(self, sample_time, cpu, rss, read, write):
+        '''Add a sample.
+
+:param float sample_time: time (in seconds since the epoch) of the sample.
+:param float cpu: CPU time (in seconds) used by the job.
+:param float rss: resident memory (in bytes) used by the job.
+:param float read: data (in bytes) read from storage by the job.
+:param float write: data (in bytes) written to storage by the job.
+'''
+        if self.start is None:
+            self.start = int(sample_time)
+        sample = (max(int(sample_time) - self.start, 0), cpu, rss/1048576.0, read/1048576.0, write/1048576.0)
+        if self.times and self._added < self.stride:
+            # Replace the most recent sample until a stride has been added.
+            for (column, val) in zip(self._columns(), sample):
+                column[-1] = val
+            self._added += 1
+        else:
+            if len(self.times) >= self.capacity:
+                # Downsample: keep the later sample of each pair.
+                for column in self._columns():
+                    column[:] = column[1::2]
+                self.stride *= 2
+            for (column, val) in zip(self._columns(), sample):
+                column.append(val)
+            self._added = 1
+
+    def summary(self):
+        '''Summarise the samples.
+
+:rtype: dictionary
+:returns: number of samples (samples), elapsed time in seconds (elapsed), CPU
+    time in seconds (cpu), average number of cores used over the whole job
+    (cpu_rate) and between the last two samples (recent_cpu_rate), current
+    and peak resident memory in MiB (rss and peak_rss), change in resident
+    memory in MiB over the second half of the samples (rss_growth), data read
+    and written in MiB (read and write) and the rate of reading and writing in
+    MiB/s between the last two samples (recent_read_rate and
+    recent_write_rate).  Rates are None if there are too few samples.
+'''
+        summary = dict(samples=len(self))
+        if not self.times:
+            return summary
+        elapsed = self.times[-1]
+        summary.update(
+                        elapsed=elapsed,
+                        cpu=self.cpu[-1],
+                        rss=self.rss[-1],
+                        peak_rss=max(self.rss),
+                        rss_growth=self.rss[-1] - self.rss[len(self)//2],
+                        read=self.read[-1],
+                        write=self.write[-1],
+                        cpu_rate=None,
+                        recent_cpu_rate=None,
+                        recent_read_rate=None,
+                        recent_write_rate=None,
+                      )
+        if elapsed > self.times[0]:
+            summary['cpu_rate'] = (self.cpu[-1] - self.cpu[0]) / (elapsed - self.times[0])
+        if len(self) > 1 and elapsed > self.times[-2]:
+            interval = float(elapsed - self.times[-2])
+            summary['recent_cpu_rate'] = (self.cpu[-1] - self.cpu[-2]) / interval
+            summary['recent_read_rate'] = (self.read[-1] - self.read[-2]) / interval
+            summary['recent_write_rate'] = (self.write[-1] - self.write[-2]) / interval
+        return summary
+
+
+def _process_table():
+    '''Read the parent, CPU time and resident memory of the user's processes.
+
+:rtype: dictionary
+:returns: (parent pid, CPU time in seconds, resident memory in bytes) of each
+    process, keyed by pid, or None if /proc is not available.  The CPU time
+    includes that of children which have exited.
+'''
+    try:
+        pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
+    except OSError:
+        return None
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    uid = os.getuid()
+    table = {}
+    for pid in pids:
+        try:
+            stat_f = open('/proc/%s/stat' % (pid))
+            try:
+                if os.fstat(stat_f.fileno()).st_uid != uid:
+                    continue
+                stat = stat_f.read()
+            finally:
+                stat_f.close()
+        except (IOError, OSError):
+            # process has exited.
+            continue
+        # The command name is in parentheses and might contain spaces.
+        fields = stat[stat.rindex(')')+2:].split()
+        cpu = sum(int(field) for field in fields[11:15]) / ticks
+        table[int(pid)] = (int(fields[1]), cpu, int(fields[21])*page_size)
+    return table
+
+def _process_usage(pid, table, children):
+    '''Find the resources used by a process and its descendants.
+
+:param integer pid: process id.
+:param dictionary table: process table as returned by :func:`_process_table`.
+:param dictionary children: list of the children of each process in table,
+    keyed by pid.
+
+:rtype: (float, float, float, float)
+:returns: CPU time in seconds, resident memory in bytes and data read from and
+    written to storage in bytes, or None if the process does not exist.
+'''
+    if pid not in table:
+        return None
+    usage = [0, 0, 0, 0]
+    tree = [pid]
+    while tree:
+        proc = tree.pop()
+        tree.extend(children.get(proc, []))
+        usage[0] += table[proc][1]
+        usage[1] += table[proc][2]
+        try:
+            io_f = open('/proc/%i/io' % (proc))
+            try:
+                for line in io_f:
+                    if line.startswith('read_bytes:'):
+                        usage[2] += int(line.split()[1])
+                    elif line.startswith('write_bytes:'):
+                        usage[3] += int(line.split()[1])
+            finally:
+                io_f.close()
+        except (IOError, OSError):
+            # I/O accounting is not always available.
+            pass
+    return tuple(usage)
+
+### Cache file format ###
+
+# Compression codecs available for cache files.  pickle is the original
+# (uncompressed) format and is the only format without a header.  The other
+# codecs are the names of stdlib modules providing compress and decompress.
+cache_codecs = ('pickle', 'zlib', 'bz2', 'lzma')
+
+# Start of the header line of compressed cache files.  A header cannot be
+# mistaken for the start of a pickle.  The header also gives the size of the
+# compressed data, after which jobs can be appended (see _append_job).
+_CACHE_MAGIC = b'#job_manager cache'
+
+def _codec_module(codec):
+    '''Import the module implementing a cache codec.'''
+    if codec not in cache_codecs or codec == 'pickle':
+        raise UserError('Unknown cache codec: %s.  Available codecs: %s.' % (codec, ', '.join(cache_codecs)))
+    try:
+        return __import__(codec)
+    except ImportError:
+        raise UserError('Cache codec not available in this python installation: %s.' % (codec))
+
+def _intern_strings(job_servers):
+    '''Replace equal strings in job_servers with the same object.
+
+pickle stores an object which occurs multiple times only once, so interning
+the (highly repetitive) paths, programs, statuses, etc. substantially reduces
+the size of the pickle.
+'''
+    table = {}
+    for job_server in job_servers.values():
+        if job_server.columnar:
+            # Values are stored once by JobTable.
+            continue
+        for job in job_server.jobs:
+            attrs = job.__dict__
+            for (attr, val) in attrs.items():
+                if isinstance(val, str):
+                    attrs[attr] = table.setdefault(val, val)
+            if job._text is not None:
+                attrs['_text'] = tuple(table.setdefault(val, val) for val in job._text)
+
+def _store_columns(job_servers, enable):
+    '''Store the jobs of each job server in columns, or not, before dumping.
+
+:type job_servers: dictionary
+:param job_servers: :class:`JobServer` instances keyed by hostname.
+:param boolean enable: see :meth:`JobServer.store_columns`.  Nothing is done if
+    None.
+'''
+    if enable is not None:
+        for job_server in job_servers.values():
+            job_server.store_columns(enable)
+
+def _assign_handles(job_servers):
+    '''Give a handle to each job without one after loading or before dumping.
+
+:type job_servers: dictionary
+:param job_servers: :class:`JobServer` instances keyed by hostname.
+'''
+    for job_server in job_servers.values():
+        job_server.assign_handles()
+
+def _index_text(job_servers, enable):
+    '''Create or remove the text index of each job server before dumping.
+
+:type job_servers: dictionary
+:param job_servers: :class:`JobServer` instances keyed by hostname.
+:param boolean enable: see :meth:`JobServer.index_text`.  Nothing is done if
+    None.
+'''
+    if enable is not None:
+        for job_server in job_servers.values():
+            job_server.index_text(enable)
+
+def _dump_cache(cache, job_servers, codec='pickle', protocol=None):
+    '''Write job_servers to the file cache.
+
+The cache file is replaced atomically, so the cache can be read safely without
+holding the lock.  The completion index (see :func:`_dump_completion_index`)
+is also updated.
+
+:param string cache: path to the cache file.
+:type job_servers: dictionary
+:param job_servers: :class:`JobServer` instances keyed by hostname.
+:param string codec: compression codec.  See :data:`cache_codecs`.
+:param integer protocol: pickle protocol.  Default: highest available protocol
+    for compressed caches and the default protocol otherwise.
+'''
+    tmp_cache = '%s.%i.tmp' % (cache, os.getpid())
+    cache_f = open(tmp_cache, 'wb')
+    try:
+        if codec == 'pickle':
+            if protocol is None:
+                pickle.dump(job_servers, cache_f)
+            else:
+                pickle.dump(job_servers, cache_f, protocol)
+        else:
+            module = _codec_module(codec)
+            if protocol is None:
+                protocol = pickle.HIGHEST_PROTOCOL
+            _intern_strings(job_servers)
+            data = module.compress(pickle.dumps(job_servers, protocol))
+            cache_f.write(_CACHE_MAGIC + (' codec=%s size=%i\n' % (codec, len(data))).encode('ascii'))
+            cache_f.write(data)
+    finally:
+        cache_f.close()
+    os.rename(tmp_cache, cache)
+    _dump_completion_index(cache, job_servers)
+
+def _dump_completion_index(cache, job_servers):
+    '''Write the index of the cache used by bash completion.
+
+The index (cache.complete) is a small plain-text file which can be read by
+the completion script using shell builtins alone, rather than starting python
+and loading the cache on every completion.  It consists of a comment line, the
+tab-separated hostnames, numbers of jobs on each server, ranges (first-last) of
+the handles on each server and numbers of programs, paths and job_ids, followed
+by the (distinct) programs, paths and job_ids, one per line.  The range of
+handles ends with the last handle assigned on the server, so may include
+deleted jobs, and is empty (last < first) if the server has no jobs.
+
+:param string cache: path to the cache file.
+:type job_servers: dictionary
+:param job_servers: :class:`JobServer` instances keyed by hostname.
+'''
+    words = (set(), set(), set())
+    counts = {}
+    handles = {}
+    for (host, job_server) in job_servers.items():
+        table = job_server.__dict__.get('_table')
+        if table is None:
+            counts[host] = len(job_server.jobs)
+            assigned = [job.handle for job in job_server.jobs if job.handle]
+            for job in job_server.jobs:
+                for (word_set, val) in zip(words, (job.program, job.path, job.job_id)):
+                    if val is not None:
+                        word_set.add(str(val))
+        else:
+            # Avoid creating the jobs.
+            counts[host] = len(table)
+            assigned = [handle for handle in table._handles or () if handle]
+            for (word_set, field) in zip(words, ('program', 'path', 'job_id')):
+                word_set.update(str(val) for val in table.values[field] if val is not None)
+        # The next handle is found in the same way when jobs are appended (see
+        # JobServer._new_handle).
+        last = (job_server._next_handle or max(assigned + [0]) + 1) - 1
+        handles[host] = (min(assigned + [last + 1]), last)
+    _write_completion_index(cache, counts, handles, words)
+
+def _write_completion_index(cache, counts, handles, words):
+    '''Write the index of the cache used by bash completion.
+
+See :func:`_dump_completion_index`.
+
+:param string cache: path to the cache file.
+:param dictionary counts: number of jobs on each server, keyed by hostname.
+:param dictionary handles: (first, last) handle on each server, keyed by
+    hostname.
+:type words: tuple of three sets of strings
+:param words: programs, paths and job_ids.
+'''
+    # Tabs and newlines are separators.
+    words = [sorted(word for word in word_set if '\t' not in word and '\n' not in word) for word_set in words]
+    hosts = sorted(counts)
+    lines = [
+              '#job_manager completion index',
+              '\t'.join(['servers'] + hosts),
+              '\t'.join(['counts'] + [str(counts[host]) for host in hosts]),
+              '\t'.join(['handles'] + ['%i-%i' % handles[host] for host in hosts]),
+              '\t'.join(['sizes'] + [str(len(word_list)) for word_list in words]),
+            ]
+    for word_list in words:
+        lines.extend(word_list)
+    index = '%s.complete' % (cache)
+    tmp_index = '%s.%i.tmp' % (index, os.getpid())
+    index_f = open(tmp_index, 'w')
+    try:
+        index_f.write('\n'.join(lines))
+        index_f.write('\n')
+    finally:
+        index_f.close()
+    os.rename(tmp_index, index)
+
+def _append_completion_index(cache, host, job):
+    '''Add a job appended to the cache file to the index used by bash completion.
+
+The lock must be held.  The index is left alone if it does not exist or lacks
+the handles (e.g. as the cache was written by an older version of
+:mod:`job_manager`): it is written when the cache is next dumped.  The job is
+given the next handle on its server, as when the cache file is read (see
+:func:`_loads_cache`).
+
+:param string cache: path to the cache file.
+:param string host: hostname of the server of the job.
+:param job: :class:`Job` instance.
+'''
+    try:
+        index_f = open('%s.complete' % (cache))
+    except IOError:
+        return
+    try:
+        lines = index_f.read().split('\n')
+    finally:
+        index_f.close()
+    if len(lines) < 5 or not lines[3].startswith('handles\t'):
+        return
+    hosts = lines[1].split('\t')[1:]
+    counts = dict(zip(hosts, [int(count) for count in lines[2].split('\t')[1:]]))
+    handles = dict(zip(hosts, [tuple(int(handle) for handle in handle_range.split('-'))
+                               for handle_range in lines[3].split('\t')[1:]]))
+    sizes = [int(size) for size in lines[4].split('\t')[1:]]
+    words = []
+    start = 5
+    for size in sizes:
+        words.append(set(lines[start:start+size]))
+        start += size
+    counts[host] = counts.get(host, 0) + 1
+    (first, last) = handles.get(host, (1, 0))
+    handles[host] = (min(first, last + 1), last + 1)
+    for (word_set, val) in zip(words, (job.program, job.path, job.job_id)):
+        if val is not None:
+            word_set.add(str(val))
+    _write_completion_index(cache, counts, handles, words)
+
+def _cache_version(stat):
+    '''Identify the version of a cache file from the result of os.stat.
+
+Each dump replaces the cache file by a new file, so the inode, size and
+modification time together identify the contents of the cache file.
+'''
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+def _read_cache(cache):
+    '''Read the pickled job_servers from the file cache.
+
+The format of the cache is detected automatically.
+
+:param string cache: path to the cache file.
+
+:rtype: (bytes, string, tuple)
+:returns: pickled :class:`JobServer` instances followed by any pickled jobs
+    appended to the cache file (see :func:`_loads_cache`), the codec used by
+    the cache file and the version of the cache file read.  (None, None, None)
+    is returned if the cache file does not exist.
+'''
+    try:
+        cache_f = open(cache, 'rb')
+    except IOError:
+        if os.path.exists(cache):
+            raise
+        return (None, None, None)
+    try:
+        version = _cache_version(os.fstat(cache_f.fileno()))
+        data = cache_f.read()
+    finally:
+        cache_f.close()
+    if data.startswith(_CACHE_MAGIC):
+        (header, data) = data.split(b'\n', 1)
+        fields = dict(field.split('=', 1) for field in header[len(_CACHE_MAGIC):].decode('ascii').split())
+        codec = fields['codec']
+        if 'size' in fields:
+            size = int(fields['size'])
+            data = _codec_module(codec).decompress(data[:size]) + data[size:]
+        else:
+            data = _codec_module(codec).decompress(data)
+    else:
+        codec = 'pickle'
+    return (data, codec, version)
+
+def _loads_cache(data):
+    '''Unpickle job_servers.
+
+:param bytes data: pickled job_servers, as returned by :func:`_read_cache`.
+
+:rtype: dictionary
+:returns: :class:`JobServer` instances keyed by hostname, including the jobs
+    appended to the cache file by :func:`_append_job`.  Appended jobs are given
+    the next handles on their server in the order they were appended, which is
+    the same for every process reading the file, so the handle of an appended
+    job does not change when the cache is next dumped.  Jobs read from cache
+    files written before handles were introduced are first given handles in
+    the same way.
+'''
+    data_f = io.BytesIO(data)
+    job_servers = pickle.load(data_f)
+    _assign_handles(job_servers)
+    while data_f.tell() < len(data):
+        try:
+            (host, job) = pickle.load(data_f)
+        except (EOFError, pickle.UnpicklingError):
+            # Job being appended whilst the cache file was read.
+            break
+        if host not in job_servers:
+            job_servers[host] = JobServer(host)
+        if job.handle is None:
+            job_servers[host]._new_handle(job)
+        if '_table' in job_servers[host].__dict__:
+            # Keep the jobs in columns (see JobServer.view).
+            job_servers[host]._table.append(job)
+        else:
+            job_servers[host].jobs.append(job)
+    return job_servers
+
+def _append_job(cache, host, job, protocol=None):
+    '''Append a job to the file cache without reading it.
+
+The lock must be held.  Jobs can be appended to uncompressed cache files and to
+compressed cache files whose header gives the size of the compressed data.
+Appended jobs are added to the end of the jobs on their server, and given the
+next handles, when the cache file is read (see :func:`_loads_cache`) and are
+written with the other jobs when the cache is next dumped.  The completion index
+is updated (see :func:`_append_completion_index`).
+
+:param string cache: path to the cache file.
+:param string host: hostname of the server of the job.
+:param job: :class:`Job` instance.
+:param integer protocol: pickle protocol.  Default: the default protocol.
+
+:rtype: boolean
+:returns: True if the job was appended.  False if the cache file does not
+    exist or cannot be appended to.
+'''
+    try:
+        cache_f = open(cache, 'rb')
+    except IOError:
+        return False
+    try:
+        header = cache_f.read(len(_CACHE_MAGIC))
+        if header == _CACHE_MAGIC:
+            header += cache_f.readline()
+    finally:
+        cache_f.close()
+    if not header or (header.startswith(_CACHE_MAGIC) and b' size=' not in header):
+        return False
+    if protocol is None:
+        record = pickle.dumps((host, job))
+    else:
+        record = pickle.dumps((host, job), protocol)
+    # Write the record in one go so readers see all or none of it.
+    cache_fd = os.open(cache, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(cache_fd, record)
+    finally:
+        os.close(cache_fd)
+    _append_completion_index(cache, host, job)
+    return True
+
+def _load_cache(cache):
+    '''Read job_servers from the file cache.
+
+:param string cache: path to the cache file.
+
+:rtype: (dictionary, string, tuple)
+:returns: :class:`JobServer` instances keyed by hostname, the codec used by
+    the cache file and the version of the cache file read.  The
+    :class:`JobServer` instances are None if the cache file does not exist.
+'''
+    (data, codec, version) = _read_cache(cache)
+    if data is None:
+        return (None, None, None)
+    else:
+        return (_loads_cache(data), codec, version)
+
 ### Cache classes ###
 
 class JobStatus:
     '''enum-esque class for specifying the status of a job.
 
 Defined statuses:'''
+    pending = 'pending'
     unknown = 'unknown'
     held = 'held'
     queueing = 'queueing'
     running = 'running'
     finished = 'finished'
+    failed = 'failed'
     analysed = 'analysed'
 
+# Statuses of jobs which are inspected by Job.auto_update.
+_ACTIVE_STATUSES = (JobStatus.unknown, JobStatus.held, JobStatus.queueing, JobStatus.running)
+
 
 class Job:
     '''Store of information regarding a calculation job.
@@ -77,11 +1183,41 @@ class Job:
     defined statuses.  This must be an attribute of :class:`JobStatus`.
 :param string submit: submit script file name.
 :param string comment: further information regarding the job.
+:param string depends: job_ids (separated by spaces) of jobs on the same
+    server which must finish before this job can be submitted.  See
+    :class:`Scheduler`.
+:param integer exit_status: exit status of the job.  Only known for jobs
+    launched by :class:`LocalExecutor`.  A negative value -N indicates the
+    job was terminated by signal N.
+:param integer hook_status: exit status of the completion hook of the job.
+    See :class:`HookRunner`.
+:param float hook_time: time (in seconds) taken by the completion hook.
+:param string hook_output: end of the output of the completion hook.
 
 Only job_id, program and path are required.  All other attributes are optional.
 Not all attributes are always applicable.
+
+.. attribute:: transitions
+
+    tuple of (status, time) pairs recording each change in the status of the
+    job and the time (in seconds since the epoch) at which it happened.  See
+    :meth:`set_status` and :meth:`times`.
+
+.. attribute:: resources
+
+    :class:`ResourceSamples` instance containing the resources used by the job
+    whilst running or None if the resources have not been sampled.  See
+    :meth:`JobServer.sample_resources`.
+
+.. attribute:: handle
+
+    positive integer which identifies the job amongst the jobs on its server
+    or None if the job has not yet been added to a server.  Unlike the index of
+    the job in :attr:`JobServer.jobs`, the handle does not change when other
+    jobs are deleted.  See :meth:`JobServer.add`.
 '''
-    def __init__(self, job_id, program, path, input_fname=None, output_fname=None, status=None, submit=None, comment=None):
+    def __init__(self, job_id, program, path, input_fname=None, output_fname=None, status=None, submit=None, comment=None, depends=None, exit_status=None,
+                 hook_status=None, hook_time=None, hook_output=None):
         self.job_id = job_id
         self.program = program
         self.path = path
@@ -90,15 +1226,45 @@ Not all attributes are always applicable.
         self.status = status
         self.submit = submit
         self.comment = comment
+        self.depends = depends
+        self.exit_status = exit_status
+        self.hook_status = hook_status
+        self.hook_time = hook_time
+        self.hook_output = hook_output
         # time since epoch job entry was modified.  useful for merging job caches.
         self._timestamp = time.gmtime()
 
         if not self.status:
             self.status = JobStatus.unknown
+        self.transitions = ((self.status, int(time.time())),)
+
+    # ((size, modification time), result) of the output file when it was last
+    # scanned by scan_output.  Class attribute so jobs in old caches have it.
+    _output_scan = None
+    # Jobs in old caches have no dependencies, exit status, completion hook
+    # results or resource samples.
+    depends = None
+    exit_status = None
+    hook_status = None
+    hook_time = None
+    hook_output = None
+    resources = None
+    transitions = ()
+    # Given by JobServer when the job is added or read from the cache file.
+    handle = None
+    # Values of the job spec stored by TextIndex.add.
+    _text = None
 
     def __repr__(self):
         return (self.job_id, self.path, self.input_fname, self.output_fname, self.status, self.submit, self.comment).__repr__()
 
+    def _changed(self):
+        '''Record that the job spec has changed, so the job is indexed again.
+
+See :class:`TextIndex`.  Called by every method which changes the job spec.
+'''
+        self.__dict__.pop('_text', None)
+
     def mtime(self):
         '''Inspect the timestamp of the job.
 
@@ -107,7 +1273,46 @@ Not all attributes are always applicable.
 '''
         return self._timestamp
 
-    def auto_update(self):
+    def set_status(self, status):
+        '''Change the status of the job, recording the time of the transition.
+
+The modification time of the job is only updated if the status changes.
+
+:param string status: new status.  See :class:`JobStatus`.
+'''
+        if status != self.status:
+            self.status = status
+            self._changed()
+            # Replace rather than modify: the tuple may be shared with other
+            # copies of the job (e.g. see Transaction).
+            self.transitions = self.transitions + ((status, int(time.time())),)
+            self._timestamp = time.gmtime()
+
+    def times(self):
+        '''Find when the job was submitted, started and ended.
+
+The times are found from :attr:`transitions`: the job was submitted when it
+first became held or queueing, started when it first became running and ended
+when it first became finished, failed or analysed.
+
+:rtype: (integer, integer, integer)
+:returns: time (in seconds since the epoch) the job was submitted, started and
+    ended.  Each time is None if unknown.
+'''
+        (submitted, started, ended) = (None, None, None)
+        for (status, transition_time) in self.transitions:
+            if status in (JobStatus.held, JobStatus.queueing):
+                if submitted is None:
+                    submitted = transition_time
+            elif status == JobStatus.running:
+                if started is None:
+                    started = transition_time
+            elif status in (JobStatus.finished, JobStatus.failed, JobStatus.analysed):
+                if ended is None:
+                    ended = transition_time
+        return (submitted, started, ended)
+
+    def auto_update(self, snapshot=None):
         '''Update job status attribute automatically.
 
 This inspects the output from ps and any queueing system to discover if the
@@ -116,71 +1321,87 @@ Note that this assumes the job is running on the local computer.  Warning: if
 this condition is not met, then the job status will be incorrectly updated to
 finished.
 
-Currently only aware of the PBS and LoadLeveler queueing systems.
+The queueing systems queried are given by the registered :class:`QueueBackend`
+instances (see :func:`register_queue_backend`).
 
 Only jobs which are currently held, queueing or running are updated.
+
+:type snapshot: :class:`QueueSnapshot`
+:param snapshot: status of the jobs reported by the queueing systems.  If None,
+    then the queueing systems are queried for the status of this job alone.
 '''
-        # Check the queueing systems.
-        # To add a queueing system, add a dictionary to the list.
-        queues = [
-            dict(
-                command=["ps", "aux"],  # command to list all jobs
-                job_column=1,  # column of output which contains the job id field (0-indexed).
-                status_column=7,  # column of output which contains the status field.
-                held=None,  # string which indicates a held status (not used if None).
-                queueing=None,  # string which indicates a queueing status (not used if None).
-                running=None,  # string which indicates a running status (not used if None).
-            ),
-            dict(
-                command=["qstat"],
-                job_column=0,
-                status_column=4,
-                held='H',
-                queueing='Q',
-                running='R',
-            ),
-            dict(
-                command=["llq"],
-                job_column=0,
-                status_column=3,
-                held='H|NQ|S',
-                queueing='I',
-                running='R',
-            ),
-        ]
-
-        if self.status in (JobStatus.unknown, JobStatus.held, JobStatus.queueing, JobStatus.running):
-
-            found_job = False
-            for queue in queues:
-                try:
-                    queue_popen = subprocess.Popen(queue['command'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    output = queue_popen.communicate()[0]
-                    if queue_popen.returncode == 0:
-                        for line in output.splitlines():
-                            job_id = line.split()[queue['job_column']]
-                            stat = line.split()[queue['status_column']]
-                            if re.match(str(self.job_id), job_id):
-                                # found job, update status
-                                found_job = True
-                                if not (queue['held'] and queue['queueing'] and queue['running']):
-                                    # don't know about status.  assume running.
-                                    self.status = JobStatus.running
-                                elif queue['held'] and re.match(queue['held'], stat):
-                                    self.status = JobStatus.held
-                                elif queue['queueing'] and re.match(queue['queueing'], stat):
-                                    self.status = JobStatus.queueing
-                                elif queue['running'] and re.match(queue['running'], stat):
-                                    self.status = JobStatus.running
-                                self._timestamp = time.gmtime()
-                                break
-                except OSError:
-                    # command doesn't exists on this server---skip.
-                    pass
-            if not found_job:
+        if self.status in _ACTIVE_STATUSES:
+            if snapshot is None:
+                snapshot = queue_snapshot([str(self.job_id)])
+            queue_id = snapshot.find(self.job_id)
+            if queue_id is None:
                 # Couldn't find job, assume it has finished.
-                self.status = JobStatus.finished
-                self._timestamp = time.gmtime()
+                status = JobStatus.finished
+            else:
+                # found job, update status
+                status = snapshot.statuses[queue_id] or self.status
+            # Only records a modification if something has changed, so mtime
+            # can be used to find jobs which have changed.
+            self.set_status(status)
+
+    def scan_output(self, tail=65536):
+        '''Update job status attribute from the contents of the output file.
+
+The last tail bytes of the output file are memory-mapped and searched for the
+markers registered for the program (see :func:`register_completion_markers`).
+If the failed marker is found, the status is set to failed.  If the finished
+marker is found, the status is set to finished.  If neither is found, a job
+which is finished (i.e. no longer found by :meth:`auto_update`) is set to
+failed if a finished marker is registered for the program.
+
+The output file is only read if its size or modification time have changed
+since it was last scanned.  Only jobs which are held, queueing, running or
+finished are updated.
+
+:param integer tail: number of bytes at the end of the output file to search.
+
+:rtype: boolean
+:returns: True if the status of the job was changed.
+'''
+        markers = completion_markers.get(self.program)
+        if not markers or not self.output_fname or \
+           self.status not in _ACTIVE_STATUSES + (JobStatus.finished,):
+            return False
+        fname = os.path.join(self.path, self.output_fname)
+        try:
+            stat = os.stat(fname)
+            stat = (stat.st_size, stat.st_mtime)
+        except OSError:
+            stat = None
+        if self._output_scan and self._output_scan[0] == stat:
+            result = self._output_scan[1]
+        else:
+            result = None
+            if stat and stat[0] > 0:
+                output_f = open(fname, 'rb')
+                try:
+                    # mmap offsets must be a multiple of the allocation granularity.
+                    offset = max(stat[0] - tail, 0)
+                    offset -= offset % mmap.ALLOCATIONGRANULARITY
+                    output = mmap.mmap(output_f.fileno(), stat[0] - offset, access=mmap.ACCESS_READ, offset=offset)
+                    try:
+                        if markers['failed'] and markers['failed'].search(output):
+                            result = JobStatus.failed
+                        elif markers['finished'] and markers['finished'].search(output):
+                            result = JobStatus.finished
+                    finally:
+                        output.close()
+                finally:
+                    output_f.close()
+            self._output_scan = (stat, result)
+        if not result and self.status == JobStatus.finished and markers['finished']:
+            # job has stopped without completing.
+            result = JobStatus.failed
+        if result and result != self.status:
+            self.set_status(result)
+            return True
+        else:
+            return False
 
     def modify(self, job_spec):
         '''Modify the job description.
@@ -192,7 +1413,11 @@ Only jobs which are currently held, queueing or running are updated.
 '''
         for (attr, val) in job_spec.items():
             if val:
-                setattr(self, attr, val)
+                if attr == 'status':
+                    self.set_status(val)
+                else:
+                    setattr(self, attr, val)
+        self._changed()
         self._timestamp = time.gmtime()
 
     def match(self, pattern):
@@ -206,8 +1431,8 @@ Only jobs which are currently held, queueing or running are updated.
 '''
         matched = False
         if pattern:
-            for attr in ['job_id', 'program', 'path', 'input_fname', 'output_fname', 'status', 'submit', 'comment']:
-                if re.search(pattern, str(getattr(self, attr))):
+            for val in self.job_spec().values():
+                if re.search(pattern, str(val)):
                     matched = True
         else:
             matched = True
@@ -228,8 +1453,232 @@ Only jobs which are currently held, queueing or running are updated.
                      status=self.status,
                      submit=self.submit,
                      comment=self.comment,
+                     depends=self.depends,
+                     exit_status=self.exit_status,
+                     hook_status=self.hook_status,
+                     hook_time=self.hook_time,
+                     hook_output=self.hook_output,
                    )
 
+    def task_counts(self):
+        '''Count the tasks of the job with each status.
+
+:rtype: dictionary
+:returns: number of tasks, keyed by status.  A job which is not an array has a
+    single task.
+'''
+        return {self.status: 1}
+
+
+# Order of precedence used to summarise the status of tasks in a job array.
+_ARRAY_STATUSES = (JobStatus.running, JobStatus.queueing, JobStatus.held, JobStatus.unknown,
+                   JobStatus.pending, JobStatus.failed, JobStatus.finished, JobStatus.analysed)
+
+def _parse_tasks(tasks, status):
+    '''Parse a range-encoded list of tasks (see :meth:`JobArray.job_spec`).
+
+:param string tasks: comma-separated ranges of tasks, e.g. 1-10 or
+    1-4:finished,5-10:running.
+:param string status: status of ranges for which no status is given.
+
+:rtype: list of (integer, integer, string) tuples
+:returns: first and last index and status of each range of tasks.
+'''
+    runs = []
+    for item in tasks.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        (indices, sep, task_status) = item.partition(':')
+        for (first, last) in _parse_task_ranges(indices):
+            runs.append((first, last, task_status or status))
+    return _merge_tasks(runs)
+
+def _format_tasks(runs):
+    '''Range-encode a list of tasks.  Inverse of :func:`_parse_tasks`.'''
+    items = []
+    for (first, last, status) in runs:
+        if first == last:
+            items.append('%i:%s' % (first, status))
+        else:
+            items.append('%i-%i:%s' % (first, last, status))
+    return ','.join(items)
+
+def _merge_tasks(runs):
+    '''Sort ranges of tasks and merge adjacent ranges with the same status.'''
+    merged = []
+    for (first, last, status) in sorted(runs, key=lambda run: run[:2]):
+        if merged and merged[-1][2] == status and merged[-1][1] + 1 >= first:
+            merged[-1] = (merged[-1][0], max(last, merged[-1][1]), status)
+        else:
+            merged.append((first, last, status))
+    return merged
+
+def _overlay_tasks(runs, found, missing):
+    '''Update the status of active ranges of tasks from a queue snapshot.
+
+:type runs: list of (integer, integer, string) tuples
+:param runs: current ranges of tasks.
+:type found: list of (integer, integer, string) tuples
+:param found: sorted, non-overlapping ranges of tasks found in the snapshot
+    (see :meth:`QueueSnapshot.find_tasks`).  A status of None leaves the
+    status unchanged.
+:param string missing: status of active tasks not in found.
+
+:rtype: list of (integer, integer, string) tuples
+:returns: updated ranges of tasks.
+'''
+    starts = [first for (first, last, status) in found]
+    updated = []
+    for (first, last, status) in runs:
+        if status not in _ACTIVE_STATUSES:
+            updated.append((first, last, status))
+            continue
+        i = max(bisect.bisect_right(starts, first) - 1, 0)
+        index = first
+        while index <= last:
+            while i < len(found) and found[i][1] < index:
+                i += 1
+            if i == len(found) or found[i][0] > last:
+                updated.append((index, last, missing))
+                break
+            (found_first, found_last, found_status) = found[i]
+            if found_first > index:
+                updated.append((index, found_first-1, missing))
+                index = found_first
+            end = min(found_last, last)
+            updated.append((index, end, found_status or status))
+            index = end + 1
+    return _merge_tasks(updated)
+
+
+class JobArray(Job):
+    '''Array of similar tasks submitted to a queueing system as a single job.
+
+A job array is stored as one :class:`Job` together with the status of ranges
+of tasks, so that an array of thousands of tasks takes little more space, and
+is updated as quickly, as a single job.  The tasks are only expanded into
+individual jobs when requested (see :meth:`task_specs`).
+
+:param string tasks: indices of the tasks as comma-separated ranges (e.g.
+    1-5000), optionally with the status of each range (e.g.
+    1-4000:finished,4001-5000:running).  Ranges without a status take the
+    status of the array.  Not an attribute.
+
+All other parameters are as for :class:`Job`.  The job_id is the id of the
+array in the queueing system without any task index (e.g. 1234 or 1234[]).
+The status of the array is a summary of the status of its tasks: the array is
+running if any task is running, etc.
+
+.. attribute:: tasks
+
+    list of (first index, last index, status) tuples of each range of tasks.
+'''
+    def __init__(self, job_id, program, path, tasks, **kwargs):
+        Job.__init__(self, job_id, program, path, **kwargs)
+        self.tasks = _parse_tasks(tasks, self.status)
+        self.set_status(self._summary())
+
+    def _summary(self):
+        '''Summarise the status of the tasks.'''
+        counts = self.task_counts()
+        for status in _ARRAY_STATUSES:
+            if status in counts:
+                return status
+        return JobStatus.unknown
+
+    def auto_update(self, snapshot=None):
+        '''Update the status of the tasks automatically.
+
+All tasks are updated from the same queue snapshot: tasks which are held,
+queueing or running and are not found are assumed to have finished.  See
+:meth:`Job.auto_update`.
+'''
+        if self.status in _ACTIVE_STATUSES:
+            if snapshot is None:
+                snapshot = queue_snapshot([str(self.job_id)])
+            tasks = _overlay_tasks(self.tasks, snapshot.find_tasks(self.job_id) or [], JobStatus.finished)
+            if tasks != self.tasks:
+                self.tasks = tasks
+                self._changed()
+                self.set_status(self._summary())
+                self._timestamp = time.gmtime()
+
+    def scan_output(self, tail=65536):
+        '''Output files of job arrays are not inspected.'''
+        return False
+
+    def modify(self, job_spec):
+        '''Modify the job description.
+
+Setting the status sets the status of all tasks.  See :meth:`Job.modify`.
+'''
+        job_spec = dict(job_spec)
+        tasks = job_spec.pop('tasks', None)
+        Job.modify(self, job_spec)
+        if job_spec.get('status'):
+            self.tasks = _merge_tasks((first, last, self.status) for (first, last, status) in self.tasks)
+        if tasks:
+            self.tasks = _parse_tasks(tasks, self.status)
+        self.set_status(self._summary())
+
+    def job_spec(self):
+        '''Inspect the job.
+
+:rtype: dictionary
+:returns: dictionary (a *job spec*) of the job attributes.  The tasks are
+    range-encoded with the status of each range.
+'''
+        job_spec = Job.job_spec(self)
+        job_spec['tasks'] = _format_tasks(self.tasks)
+        return job_spec
+
+    def task_counts(self):
+        counts = {}
+        for (first, last, status) in self.tasks:
+            counts[status] = counts.get(status, 0) + last - first + 1
+        return counts
+
+    def task_specs(self):
+        '''Expand the array into its individual tasks.
+
+:rtype: generator of dictionaries
+:returns: job spec (see :meth:`Job.job_spec`) of each task.  The job_id of a
+    task is job_id[index].
+'''
+        return _task_specs(Job.job_spec(self), self.tasks)
+
+def _task_specs(job_spec, tasks):
+    '''Expand a job array into its individual tasks.
+
+:param dictionary job_spec: job spec of the array (without the tasks).
+:type tasks: list of (integer, integer, string) tuples
+:param tasks: see :attr:`JobArray.tasks`.
+
+:rtype: generator of dictionaries
+:returns: job spec of each task.  See :meth:`JobArray.task_specs`.
+'''
+    job_id = str(job_spec['job_id']).replace('[]', '')
+    for (first, last, status) in tasks:
+        for index in range(first, last+1):
+            task_spec = dict(job_spec)
+            task_spec.update(job_id='%s[%i]' % (job_id, index), status=status)
+            yield task_spec
+
+def _new_job(job_spec):
+    '''Create a job from a job spec.
+
+:param dictionary job_spec: see :meth:`JobServer.add`.
+
+:rtype: :class:`Job`
+:returns: the job, which is a :class:`JobArray` if the tasks field is given.
+'''
+    job_spec = dict(job_spec)
+    if job_spec.get('tasks'):
+        return JobArray(**job_spec)
+    else:
+        job_spec.pop('tasks', None)
+        return Job(**job_spec)
 
 class JobServer:
     '''Store set of :class:`Job` instances running on a server/computer.
@@ -241,7 +1690,26 @@ class JobServer:
 .. attribute:: jobs
 
     list of :class:`Job` instances which are running on the server.
+
+.. attribute:: text_index
+
+    :class:`TextIndex` instance used to search :attr:`jobs`, or None if the
+    jobs are not indexed.  See :meth:`index_text`.
+
+.. attribute:: columnar
+
+    if true, :attr:`jobs` are stored in a :class:`JobTable` when pickled.  See
+    :meth:`store_columns`.
 '''
+    # Servers in old caches are not indexed and store Job instances.
+    text_index = None
+    columnar = False
+    # Next handle to assign (see assign_handles): found from the jobs if None.
+    _next_handle = None
+    # PathIndex of the jobs, created by select_under and discarded when jobs
+    # are removed or their path changed.  Not stored.
+    _path_index = None
+
     def __init__(self, hostname='localhost'):
         self.hostname = hostname
         self.jobs = []
@@ -249,61 +1717,354 @@ class JobServer:
     def __repr__(self):
         return (self.hostname, self.jobs).__repr__()
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_path_index', None)
+        if self.columnar and 'jobs' in state:
+            state['_table'] = JobTable(state.pop('jobs'))
+        return state
+
+    def __getattr__(self, attr):
+        # Jobs unpickled from a JobTable are only created when first needed
+        # (see view).
+        if attr == 'jobs' and '_table' in self.__dict__:
+            self.jobs = self.__dict__.pop('_table').jobs()
+            return self.jobs
+        raise AttributeError(attr)
+
     def add(self, job_spec):
         '''Add a :class:`Job` to the list of jobs running on the server.
 
+The job is given the next handle (see :attr:`Job.handle`).  Handles are never
+reused, even once the job has been deleted.
+
 :type job_spec: dictionary
 :param job_spec: job to be added.  See :class:`Job` and :meth:`Job.job_spec`
-    for possible fields and format.
+    for possible fields and format.  A :class:`JobArray` is added if the
+    tasks field is given.
 '''
-        self.jobs.append(Job(**job_spec))
+        self.jobs.append(_new_job(job_spec))
+        self._new_handle(self.jobs[-1])
+        if self.text_index is not None:
+            self.text_index.add(self.jobs[-1])
+        if self._path_index is not None:
+            self._path_index.update(self.jobs)
+
+    def _new_handle(self, job):
+        '''Give a job the next handle.'''
+        if self._next_handle is None:
+            table = self.__dict__.get('_table')
+            if table is not None:
+                # Don't create the jobs.
+                handles = list(table._handles or ())
+            else:
+                handles = [job.handle or 0 for job in self.jobs]
+            self._next_handle = max(handles + [0]) + 1
+        job.handle = self._next_handle
+        self._next_handle += 1
+
+    def assign_handles(self):
+        '''Give a handle to each job which doesn't have one.
+
+Jobs only lack a handle if they were added in a :class:`Transaction` which was
+merged with changes made by another process.  This is done whenever the cache
+file is read or written.
+'''
+        table = self.__dict__.get('_table')
+        if table is not None and table._handles is not None and 0 not in table._handles:
+            # All handled: don't create the jobs.
+            return
+        for job in self.jobs:
+            if job.handle is None:
+                self._new_handle(job)
+
+    def index_text(self, enable=True):
+        '''Create or remove the trigram index of :attr:`jobs`.
 
-    def auto_update(self):
+The index is stored with the job server and is kept up to date as jobs are
+added, modified and searched.  It speeds up searching large numbers of jobs
+(see :meth:`search`) at the cost of a larger cache file.
+
+:param boolean enable: create the index if it doesn't exist.  Otherwise the
+    index is removed.
+'''
+        if enable and self.text_index is None:
+            self.text_index = TextIndex()
+            self.text_index.build(self.jobs)
+        elif not enable and self.text_index is not None:
+            self.text_index = None
+            for job in self.jobs:
+                job.__dict__.pop('_text', None)
+
+    def store_columns(self, enable=True):
+        '''Store :attr:`jobs` in a :class:`JobTable` when pickled.
+
+A server containing very many jobs is then much smaller in memory and faster
+to read from the cache file.  The :class:`Job` instances are only created when
+:attr:`jobs` is first used, which is not necessary to find jobs using
+:meth:`view`.
+
+:param boolean enable: store jobs in columns.  Otherwise jobs are stored as
+    :class:`Job` instances.
+'''
+        if not enable:
+            # Create the jobs.
+            self.jobs
+        self.columnar = enable
+
+    def view(self, pattern=None, under=None):
+        '''Find the jobs which match the supplied pattern for inspection.
+
+If the jobs were read from a :class:`JobTable` and :attr:`jobs` has not yet
+been used, then the jobs are searched column-wise (see
+:meth:`JobTable.search`) and :class:`Job` instances are created only for the
+jobs found.  Otherwise this is the same as :meth:`search` (or
+:meth:`select_under`).  Changes to the jobs returned are not necessarily saved:
+use :meth:`search` to modify jobs.
+
+:param string pattern: regular expression.  See :meth:`search`.
+:param string under: directory.  If not None, only jobs in the directory tree
+    are found.  See :meth:`select_under`.
+
+:rtype: list of (integer, :class:`Job`) tuples
+:returns: index and job of each job which matches the pattern.
+'''
+        table = self.__dict__.get('_table')
+        if table is None:
+            if under is None:
+                return self.search(pattern)
+            found = self._under(under)
+            if pattern:
+                found = [(index, job) for (index, job) in found if job.match(pattern)]
+            return found
+        elif under is None:
+            rows = table.search(pattern)
+        else:
+            rows = table.under(under)
+            if pattern:
+                matched = set(table.search(pattern))
+                rows = [row for row in rows if row in matched]
+        return [(row, table.job(row)) for row in rows]
+
+    def auto_update(self, snapshot=None):
         '''Automatically update the job status of all :attr:`jobs`.
 
-Only performed on the localhost :class:`JobServer`.  See also :meth:`Job.auto_update`.
+Only performed on the localhost :class:`JobServer`.  Each queueing system is
+queried once (see :func:`queue_snapshot`) for all held, queueing and running
+jobs.  The output files are then inspected using :meth:`scan_output` if any
+completion markers are registered and the resources used by running jobs are
+sampled using :meth:`sample_resources`.  See also :meth:`Job.auto_update`.
+
+:type snapshot: :class:`QueueSnapshot`
+:param snapshot: status of all jobs of the current user, e.g. shared between
+    several caches.  If None, the queueing systems are queried.  Jobs modified
+    since the snapshot was created are not updated, as they may have been
+    submitted after the queueing systems were queried.
 '''
         if self.hostname == 'localhost':
-            for job in self.jobs:
-                job.auto_update()
+            active = [job for job in self.jobs if job.status in _ACTIVE_STATUSES]
+            if snapshot is not None:
+                import calendar
+                since = int(snapshot.time)
+                active = [job for job in active if calendar.timegm(job.mtime()) < since]
+            elif active:
+                # Query each queueing system once for all jobs rather than once
+                # per job.
+                snapshot = queue_snapshot([str(job.job_id) for job in active])
+            for job in active:
+                job.auto_update(snapshot)
+            if completion_markers:
+                self.scan_output()
+            self.sample_resources()
         else:
             print('Not auto-updating jobs on host %s' % (self.hostname))
 
+    def sample_resources(self, capacity=64):
+        '''Sample the resources used by running jobs.
+
+The CPU time, resident memory and I/O of each running job (including all its
+descendant processes) are read from /proc and added to the
+:attr:`Job.resources` of the job.  As for :meth:`Job.auto_update`, the job_id
+of a job running on the localhost server is assumed to be its pid.  Only jobs
+whose process belongs to the current user are sampled.  Sampling does not
+change the modification time of a job.
+
+:param integer capacity: number of samples stored for each job.  See
+    :class:`ResourceSamples`.
+
+:rtype: integer
+:returns: number of jobs sampled.
+'''
+        jobs = [job for job in self.jobs if job.status == JobStatus.running and
+                str(job.job_id).isdigit() and not isinstance(job, JobArray)]
+        if not jobs:
+            return 0
+        table = _process_table()
+        if table is None:
+            return 0
+        children = {}
+        for (pid, (parent, cpu, rss)) in table.items():
+            children.setdefault(parent, []).append(pid)
+        now = time.time()
+        sampled = 0
+        for job in jobs:
+            usage = _process_usage(int(job.job_id), table, children)
+            if usage:
+                if job.resources is None:
+                    job.resources = ResourceSamples(capacity)
+                job.resources.add(now, *usage)
+                sampled += 1
+        return sampled
+
+    def scan_output(self, threads=8, tail=65536):
+        '''Update the status of :attr:`jobs` from their output files.
+
+The output files are scanned concurrently.  Jobs whose status cannot change as
+a result (e.g. finished jobs whose completion has already been confirmed) are
+not scanned.  See :meth:`Job.scan_output`.
+
+:param integer threads: number of threads used to scan output files.
+:param integer tail: number of bytes at the end of each output file to search.
+
+:rtype: integer
+:returns: number of jobs whose status changed.
+'''
+        import multiprocessing.pool
+        jobs = []
+        for job in self.jobs:
+            if job.program in completion_markers and job.output_fname and \
+               (job.status in _ACTIVE_STATUSES or
+                (job.status == JobStatus.finished and
+                 not (job._output_scan and job._output_scan[1] == JobStatus.finished))):
+                jobs.append(job)
+        if len(jobs) > 1 and threads > 1:
+            pool = multiprocessing.pool.ThreadPool(min(threads, len(jobs)))
+            try:
+                changed = pool.map(lambda job: job.scan_output(tail), jobs)
+            finally:
+                pool.close()
+        else:
+            changed = [job.scan_output(tail) for job in jobs]
+        return sum(changed)
+
+    def search(self, pattern):
+        '''Find the jobs which match the supplied pattern.
+
+If :attr:`text_index` exists, only jobs which contain the literal parts of the
+pattern are tested using the pattern.  Jobs which have changed since they were
+indexed are indexed again.
+
+:param string pattern: regular expression.  Jobs are tested as in
+    :meth:`Job.match`.  If pattern is None then all jobs are returned.
+
+:rtype: list of (integer, :class:`Job`) tuples
+:returns: index and job of each job which matches the pattern.
+'''
+        if not pattern:
+            return list(enumerate(self.jobs))
+        if self.text_index is None:
+            return [(index, job) for (index, job) in enumerate(self.jobs) if job.match(pattern)]
+        if self.text_index.stale():
+            self.text_index.build(self.jobs)
+        search = re.compile(pattern).search
+        candidates = self.text_index.candidates(pattern)
+        found = []
+        for (index, job) in enumerate(self.jobs):
+            text = job._text
+            if text is None:
+                # New values are not in the candidates: test the job directly.
+                text = self.text_index.add(job)
+            elif candidates is not None and candidates.isdisjoint(text):
+                continue
+            for val in text:
+                if search(val):
+                    found.append((index, job))
+                    break
+        return found
+
     def select(self, pattern):
         '''Select a subset of jobs from the server which match the supplied pattern.
 
 :type pattern: string
-:param pattern: regular expression.  All :attr:`jobs` are tested (using :meth:`Job.match`)
+:param pattern: regular expression.  All :attr:`jobs` are tested (using :meth:`search`)
     against the pattern and the list of matching jobs is returned.  If pattern is
     None then all jobs are returned.
 '''
-        selected_jobs = []
-        for job in self.jobs:
-            if job.match(pattern):
-                selected_jobs.append(job)
-        return selected_jobs
+        return [job for (index, job) in self.search(pattern)]
+
+    def _selected(self, indices=None, pattern=None, handles=None):
+        '''Find the indices of the jobs selected by index, pattern or handle.
+
+See :meth:`delete` for the arguments.
 
-    def delete(self, indices=None, pattern=None):
+:rtype: set of integers
+:returns: (non-negative) indices of the selected jobs in :attr:`jobs`.
+
+:raises: :class:`UserError` if an index is out of range.
+'''
+        njobs = len(self.jobs)
+        selected = set()
+        for index in indices or ():
+            if not -njobs <= index < njobs:
+                raise UserError('No job with index %s on %s.' % (index, self.hostname))
+            selected.add(index % njobs)
+        if pattern:
+            selected.update(index for (index, job) in self.search(pattern))
+        if handles:
+            handles = set(handles)
+            selected.update(index for (index, job) in enumerate(self.jobs) if job.handle in handles)
+        return selected
+
+    def _under(self, directory):
+        '''Find the index and job of each job in a directory tree.'''
+        if self._path_index is None or not self._path_index.update(self.jobs):
+            self._path_index = PathIndex(self.jobs)
+        return [(index, self.jobs[index]) for index in self._path_index.under(directory)]
+
+    def select_under(self, directory):
+        '''Select the jobs in a directory tree.
+
+Unlike selecting jobs by a pattern (see :meth:`select`), only the path of each
+job is tested.  The jobs are found using a :class:`PathIndex`, which is created
+when first needed and then kept up to date as jobs are added, so each query
+takes time proportional to the number of jobs found.
+
+:param string directory: directory.  Jobs whose path is the directory or is
+    inside it are selected.  Paths are compared once normalised (e.g. trailing
+    slashes are ignored) but are not made absolute.
+
+:rtype: list of :class:`Job` instances
+'''
+        return [job for (index, job) in self._under(directory)]
+
+    def delete(self, indices=None, pattern=None, handles=None):
         '''Delete a selected subset of :attr:`jobs`.
 
+The jobs are selected before any are deleted and removed in a single pass, so
+the indices refer to the positions of jobs before the deletion.
+
 :type indices: iterable of integers
 :param indices: indices of :class:`Job` instances in the :attr:`jobs` list to
     delete.  Not used if None or empty.
 :param string pattern: regular expression.  The :attr:`jobs` are which match
-    the pattern (found using :meth:`select`) are deleted.  Not used if None.
+    the pattern (found using :meth:`search`) are deleted.  Not used if None.
+:type handles: iterable of integers
+:param handles: handles (see :attr:`Job.handle`) of the jobs to delete.  Not
+    used if None or empty.
+
+:raises: :class:`UserError` if an index is out of range, in which case no jobs
+    are deleted.
 '''
-        if indices:
-            deleted = 0
-            for index in indices:
-                self.jobs.pop(index-deleted)
-                deleted += 1
-        if pattern:
-            for job in self.select(pattern):
-                self.jobs.remove(job)
+        selected = self._selected(indices, pattern, handles)
+        if selected:
+            self.jobs = [job for (index, job) in enumerate(self.jobs) if index not in selected]
+            self._path_index = None
 
-    def modify(self, job_spec, indices=None, pattern=None):
+    def modify(self, job_spec, indices=None, pattern=None, handles=None):
         '''Modify a selected subset of :attr:`jobs` using :meth:`Job.modify`.
 
+Each selected job is modified once, even if it is selected more than once.
+
 :type job_spec: dictionary
 :param job_spec: fields of job to be modified.  See :class:`Job` and
     :meth:`Job.job_spec` for possible fields and format.
@@ -311,15 +2072,18 @@ Only performed on the localhost :class:`JobServer`.  See also :meth:`Job.auto_up
 :param indices: indices of :class:`Job` instances in the :attr:`jobs` list to
     modify.  Not used if None or empty.
 :param string pattern: regular expression.  The :attr:`jobs` are which match
-    the pattern (found using :meth:`select`) are modified.  Not used if None.
+    the pattern (found using :meth:`search`) are modified.  Not used if None.
+:type handles: iterable of integers
+:param handles: handles (see :attr:`Job.handle`) of the jobs to modify.  Not
+    used if None or empty.
+
+:raises: :class:`UserError` if an index is out of range, in which case no jobs
+    are modified.
 '''
-        if indices:
-            for index in indices:
-                self.jobs[index].modify(job_spec)
-        if pattern:
-            for (index, job) in enumerate(self.jobs):
-                if job.match(pattern):
-                    self.jobs[index].modify(job_spec)
+        for index in sorted(self._selected(indices, pattern, handles)):
+            self.jobs[index].modify(job_spec)
+        if 'path' in job_spec:
+            self._path_index = None
 
     def merge(self, other):
         '''Merge :attr:`jobs` from another :class:`JobServer`.
@@ -348,11 +2112,19 @@ grouped together using a :class:`JobCache` instance).
                 if other_job.job_id == job.job_id:
                     found = True
                     if other_job.mtime() > job.mtime():
+                        if other_job.path != job.path:
+                            self._path_index = None
                         job.modify(other_job.job_spec())
                     break
             if not found:
                 # new job.  add.
-                self.jobs.append(copy.deepcopy(other_job))
+                new_job = copy.deepcopy(other_job)
+                # Not in the index of this server.
+                new_job.__dict__.pop('_text', None)
+                self.jobs.append(new_job)
+                self._new_handle(new_job)
+                if self._path_index is not None:
+                    self._path_index.update(self.jobs)
 
 class JobCache:
     '''Store, manipulate, load and save multiple :class:`JobServer` instances.
@@ -362,15 +2134,60 @@ By default a new (empty) :class:`JobServer` instance is created on localhost.
 :param string cache: path to a file in which the job data can be stored and
     retrieved.  Only one instance can manipulate job data stored in a cache at
     a time, so a lock is acquired when a cache is read and released only when the
-    cache dumped out to the cache.  The directory for the cache file is created if
-    it doesn't already exist.
+    cache dumped out to the cache.  Alternatively, use :meth:`transaction` to
+    hold the lock only whilst changes are saved.  The directory for the cache
+    file is created if it doesn't already exist.
 :param boolean load: load data from an existing cache file if true.  Not an attribute.
+:param string codec: compression codec used to store the cache file.  See
+    :data:`cache_codecs`.  If None, then the codec used by the existing cache
+    file (if any) is kept and the uncompressed pickle format is used for new
+    cache files.  The format of the cache file is always detected
+    automatically when it is loaded.
+:param integer protocol: pickle protocol used to store the cache file.
+    Default: the highest protocol available for compressed caches and the
+    default pickle protocol otherwise.
+:type archive_age: float
+:param archive_age: if not None, finished, failed and analysed jobs which
+    have not been modified for archive_age seconds are moved to the archive
+    (see :meth:`archive_jobs`) whenever the cache is dumped or a transaction
+    is committed.
+:type text_index: boolean
+:param text_index: if True, the jobs on each server are indexed (see
+    :meth:`JobServer.index_text`) whenever the cache is dumped.  If False, the
+    indices are removed.  If None, existing indices are kept.
+:type columnar: boolean
+:param columnar: if True, the jobs on each server are stored in columns (see
+    :meth:`JobServer.store_columns`) whenever the cache is dumped.  If False,
+    the jobs are stored as :class:`Job` instances.  If None, the existing
+    format of each server is kept.
+:type mapped: boolean
+:param mapped: if True, a read-only copy of the jobs is also written to
+    :attr:`mapped_cache` whenever the cache is dumped (see :meth:`open_mapped`).
+    If False, the copy is removed.  If None, the copy is kept up to date if it
+    exists.
 
 .. attribute:: job_servers
 
     List of :class:`JobServer` instances.
+
+.. attribute:: archive
+
+    path to the archive file, which contains jobs removed from the cache by
+    :meth:`archive_jobs`.  The archive is append-only and is never loaded by
+    :meth:`load`.  An index of the archive is kept in archive.idx and the
+    times at which archived jobs were submitted, started and ended are kept in
+    archive.times (see :meth:`job_times`).
+
+.. attribute:: mapped_cache
+
+    path to the mapped cache file (cache.map).  See :class:`MappedCache`.
 '''
-    def __init__(self, cache, load=False):
+    def __init__(self, cache, load=False, codec=None, protocol=None, archive_age=None, text_index=None, columnar=None, mapped=None):
+        if codec is not None and codec != 'pickle':
+            # Fail now rather than after all the work has been done.
+            _codec_module(codec)
+        self.codec = codec
+        self.protocol = protocol
         self.job_servers = dict(localhost=JobServer())
         cache = os.path.expanduser(cache)
         cache = os.path.expandvars(cache)
@@ -379,6 +2196,15 @@ By default a new (empty) :class:`JobServer` instance is created on localhost.
         if not os.path.isdir(os.path.dirname(self.cache)):
             os.makedirs(os.path.dirname(self.cache))
         self._lock = '%s.lock' % (self.cache)
+        self.archive = '%s.archive' % (self.cache)
+        self._archive_index = '%s.idx' % (self.archive)
+        self._archive_times = '%s.times' % (self.archive)
+        self._archive_names = '%s.names' % (self.archive)
+        self.mapped_cache = '%s.map' % (self.cache)
+        self.archive_age = archive_age
+        self.text_index = text_index
+        self.columnar = columnar
+        self.mapped = mapped
         self._has_lock = False
         if load:
             self.load()
@@ -389,24 +2215,35 @@ By default a new (empty) :class:`JobServer` instance is created on localhost.
     def __repr__(self):
         return (self.cache, self._lock, self._has_lock, self.job_servers).__repr__()
 
-    def _acquire_lock(self, max_attempts=30):
+    def _acquire_lock(self, max_attempts=30, interval=1):
         '''Acquire a lock on the cache file.
 
 Write the pid of the current instance to the lock file, which is only possible
 if the lock file doesn't already exist.  Manipulating the job cache must be
 atomic in order to avoid race conditions, so one should always acquire the lock
 when loading data from the cache file.
+
+The lock is tested max_attempts times, waiting interval seconds between
+attempts.
 '''
         for i in range(max_attempts):
-            if os.path.exists(self._lock):
-                lock_file = open(self._lock)
-                pid = lock_file.read().strip()
-                lock_file.close()
-                time.sleep(1)
+            try:
+                # Create the lock file only if it doesn't already exist.
+                lock_fd = os.open(self._lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except OSError:
+                if sys.exc_info()[1].errno != errno.EEXIST:
+                    raise
+                try:
+                    lock_file = open(self._lock)
+                    pid = lock_file.read().strip()
+                    lock_file.close()
+                except IOError:
+                    # lock released in the meantime.
+                    pid = None
+                time.sleep(interval)
             else:
-                lock_file = open(self._lock, 'w')
-                lock_file.write('%i' % os.getpid())
-                lock_file.close()
+                os.write(lock_fd, ('%i' % os.getpid()).encode('ascii'))
+                os.close(lock_fd)
                 self._has_lock = True
                 break
         if not self._has_lock:
@@ -431,21 +2268,95 @@ instance on the localhost.
 '''
         if not self._has_lock:
             self._acquire_lock()
-        cache_f = open(self.cache, 'wb')
-        pickle.dump(self.job_servers, cache_f)
-        cache_f.close()
+        if self.archive_age is not None:
+            self.archive_jobs(max_age=self.archive_age)
+        _assign_handles(self.job_servers)
+        _index_text(self.job_servers, self.text_index)
+        _store_columns(self.job_servers, self.columnar)
+        _dump_cache(self.cache, self.job_servers, self.codec or 'pickle', self.protocol)
+        _dump_mapped(self.cache, self.job_servers, self.mapped)
         self.job_servers = dict(localhost=JobServer())
         self._release_lock()
 
-    def load(self):
+    def load(self, lock=True):
         '''Read in the job_servers data from the cache file.
 
-Also acquires the lock.'''
-        self._acquire_lock()
-        if os.path.exists(self.cache):
-            cache_f = open(self.cache, 'rb')
-            self.job_servers = pickle.load(cache_f)
-            cache_f.close()
+:param boolean lock: acquire the lock.  The cache file is replaced atomically
+    when dumped, so a consistent snapshot of the cache can be read without the
+    lock (e.g. for printing jobs).  Changes made to a snapshot read without the
+    lock must not be dumped, as they can overwrite changes made by other
+    processes: use :meth:`transaction` instead.
+'''
+        if lock:
+            self._acquire_lock()
+        (job_servers, codec, version) = _load_cache(self.cache)
+        if job_servers is not None:
+            self.job_servers = job_servers
+            if self.codec is None:
+                self.codec = codec
+
+    def open_mapped(self):
+        '''Open the mapped cache file for reading, if it is up to date.
+
+The lock is not required.  Jobs appended to the cache file (see
+:meth:`append`) are only copied to the mapped cache file when the cache is next
+dumped, until which the mapped cache file is out of date.
+
+:rtype: :class:`MappedCache`
+:returns: the jobs in the mapped cache file or None if the mapped cache file
+    doesn't exist or is older than the cache file.
+'''
+        try:
+            mapped = MappedCache(self.mapped_cache)
+        except (IOError, OSError, ValueError, UserError):
+            return None
+        if mapped.version != self.version():
+            mapped.close()
+            return None
+        return mapped
+
+    def transaction(self):
+        '''Start an optimistic-concurrency transaction on the cache.
+
+The cache is read without acquiring the lock and changes are made to a private
+copy of the job servers.  The lock is only held whilst the changes are saved
+by :meth:`Transaction.commit`, so slow operations (e.g. querying queueing
+systems or copying files from remote servers) do not prevent other processes
+from using the cache.  The transaction can be used as a context manager, in
+which case it is committed if no exception is raised:
+
+.. code-block:: python
+
+    with job_cache.transaction():
+        job_cache.auto_update()
+
+:rtype: :class:`Transaction`
+'''
+        return Transaction(self)
+
+    def transact(self, function, retries=3, max_attempts=3000):
+        '''Apply function to the cache in a :class:`Transaction`.
+
+:param function: function which takes the dictionary of :class:`JobServer`
+    instances in the transaction (see :attr:`Transaction.job_servers`) and
+    modifies them.
+:param integer retries: number of times function is re-applied to a new
+    snapshot of the cache if the transaction conflicts with changes made by
+    another process.
+:param integer max_attempts: number of attempts to acquire the lock when
+    committing (see :meth:`Transaction.commit`).
+
+:returns: value returned by function.
+'''
+        for attempt in range(retries+1):
+            tx = self.transaction()
+            value = function(tx.job_servers)
+            try:
+                tx.commit(max_attempts)
+                return value
+            except TransactionConflict:
+                if attempt == retries:
+                    raise
 
     def add_server(self, hostname):
         '''Add a new :class:`JobServer` instance.
@@ -456,12 +2367,41 @@ Also acquires the lock.'''
             raise UserError('Cannot add new server.  Hostname already exists: %s.' % (hostname))
         self.job_servers[hostname] = JobServer(hostname)
 
-    def auto_update(self):
+    def append(self, job_spec, hostname='localhost'):
+        '''Add a job to the cache file without loading the cache.
+
+The job is appended to the cache file (see :func:`_append_job`) whilst holding
+the lock, so adding a job takes the same time however many jobs are in the
+cache.  The server is created if necessary.  If the cache file doesn't exist or
+was written by an older version of :mod:`job_manager` with a compressed codec,
+the cache is instead loaded, the job added and the cache dumped.
+
+:param dictionary job_spec: job to be added.  See :meth:`JobServer.add`.
+:param string hostname: server of the job.
+'''
+        job = _new_job(job_spec)
+        self._acquire_lock()
+        try:
+            if not _append_job(self.cache, hostname, job, self.protocol):
+                # Already hold the lock.
+                self.load(lock=False)
+                if hostname not in self.job_servers:
+                    self.add_server(hostname)
+                self.job_servers[hostname].add(job_spec)
+                self.dump()
+        finally:
+            self._release_lock()
+
+    def auto_update(self, snapshot=None):
         '''Auto-update the status of the jobs on the localhost :class:`JobServer`.
 
 See also :meth:`JobServer.auto_update`.
+
+:type snapshot: :class:`QueueSnapshot`
+:param snapshot: status of all jobs of the current user.  If None, the
+    queueing systems are queried.
 '''
-        self.job_servers['localhost'].auto_update()
+        self.job_servers['localhost'].auto_update(snapshot)
 
     def merge(self, other, other_hostname):
         '''Merge data from another :class:`JobCache`.
@@ -492,7 +2432,335 @@ with other_hostname to avoid unintended nameclashes.
         # undo local modification to localhost on the other cache.
         other.job_servers['localhost'].hostname = 'localhost'
 
-    def pretty_print(self, hosts=None, pattern=None, short=False):
+    def archive_jobs(self, hosts=None, statuses=(JobStatus.finished, JobStatus.failed, JobStatus.analysed), max_age=None):
+        '''Move jobs from :attr:`job_servers` to the archive.
+
+Archived jobs are appended to the :attr:`archive` file and removed from
+:attr:`job_servers`, so that the cache only grows with the number of jobs in
+progress rather than with the entire history of jobs.  The lock should be
+held (i.e. the cache loaded) when archiving jobs.  Archived jobs can be
+inspected using :meth:`archived_jobs`.
+
+:type hosts: list of strings
+:param hosts: list of hostnames.  If specified, only archive jobs on the
+    specified servers.
+:type statuses: iterable of strings
+:param statuses: only archive jobs with one of the specified statuses.  If
+    None, then jobs are archived regardless of status.
+:type max_age: float
+:param max_age: only archive jobs which have not been modified for max_age
+    seconds.  If None, then jobs are archived regardless of age.
+
+:rtype: integer
+:returns: number of jobs archived.
+'''
+        return self._archive_jobs(self.job_servers, hosts, statuses, max_age)
+
+    def _archive_jobs(self, job_servers, hosts=None, statuses=(JobStatus.finished, JobStatus.failed, JobStatus.analysed), max_age=None):
+        '''Move jobs from job_servers to the archive.
+
+See :meth:`archive_jobs` for the other arguments.
+
+:type job_servers: dictionary
+:param job_servers: :class:`JobServer` instances keyed by hostname.
+'''
+        import calendar
+        now = time.time()
+        narchived = 0
+        names = JobTimes.read_names(self._archive_names)
+        nnames = len(names.names)
+        archive_f = open(self.archive, 'ab')
+        index_f = open(self._archive_index, 'a')
+        times = JobTimes(names)
+        try:
+            for (host, job_server) in job_servers.items():
+                if hosts and host not in hosts:
+                    continue
+                keep = []
+                for job in job_server.jobs:
+                    mtime = calendar.timegm(job.mtime())
+                    if (statuses is None or job.status in statuses) and \
+                       (max_age is None or now - mtime > max_age):
+                        entry = job.job_spec()
+                        entry.update(hostname=host, mtime=mtime, offset=archive_f.tell())
+                        pickle.dump((host, job), archive_f, pickle.HIGHEST_PROTOCOL)
+                        index_f.write('%s\n' % (json.dumps(entry)))
+                        times.append(host, job)
+                        narchived += 1
+                    else:
+                        keep.append(job)
+                job_server.jobs = keep
+        finally:
+            archive_f.close()
+            index_f.close()
+            if len(times):
+                # Names first, so every name in the times file is known.
+                if len(names.names) > nnames:
+                    names_f = open(self._archive_names, 'a')
+                    try:
+                        for name in names.names[nnames:]:
+                            names_f.write('%s\n' % (json.dumps(name)))
+                    finally:
+                        names_f.close()
+                times_f = open(self._archive_times, 'ab')
+                try:
+                    times.data.tofile(times_f)
+                finally:
+                    times_f.close()
+        return narchived
+
+    def archived_jobs(self, hosts=None, pattern=None, under=None, tasks=False):
+        '''Search the archive.
+
+Only the index of the archive is read: the lock is not required and archived
+jobs are not loaded into :attr:`job_servers`.
+
+:type hosts: list of strings
+:param hosts: list of hostnames.  If specified, only return jobs archived from
+    the specified servers.
+:param string pattern: regular expression.  Only jobs with an attribute which
+    matches the supplied pattern (see :meth:`Job.match`) are returned.  If
+    pattern is None then all archived jobs are returned.
+:param string under: directory.  If specified, only jobs whose path is in the
+    directory tree (see :meth:`JobServer.select_under`) are returned.
+:param boolean tasks: return each task of job arrays (see :class:`JobArray`)
+    separately rather than the range-encoded status of the tasks.
+
+:rtype: iterator of (string, integer, dictionary) tuples
+:returns: hostname, index in the archive and job spec (see
+    :meth:`Job.job_spec`) of each archived job.  The job spec also contains
+    the modification time and the offset of the job in the :attr:`archive`
+    file (see :meth:`archived_job`).
+'''
+        if not os.path.exists(self._archive_index):
+            return
+        if under is not None:
+            prefix = _path_key(under)
+        attrs = ['job_id', 'program', 'path', 'input_fname', 'output_fname', 'status', 'submit', 'comment', 'depends', 'exit_status']
+        index_f = open(self._archive_index)
+        try:
+            for (index, line) in enumerate(index_f):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # partially written entry.
+                    continue
+                host = entry.pop('hostname')
+                if hosts and host not in hosts:
+                    continue
+                if pattern and not any(re.search(pattern, str(entry.get(attr))) for attr in attrs):
+                    continue
+                if under is not None and not _path_key(entry.get('path')).startswith(prefix):
+                    continue
+                if tasks and entry.get('tasks'):
+                    job_tasks = _parse_tasks(entry.pop('tasks'), entry['status'])
+                    for task_spec in _task_specs(entry, job_tasks):
+                        yield (host, index, task_spec)
+                else:
+                    yield (host, index, entry)
+        finally:
+            index_f.close()
+
+    def archived_job(self, offset):
+        '''Read a job from the archive.
+
+:param integer offset: offset of the job in the :attr:`archive` file, as given
+    in the job spec returned by :meth:`archived_jobs`.
+
+:rtype: (string, :class:`Job`)
+:returns: hostname and archived job.
+'''
+        archive_f = open(self.archive, 'rb')
+        try:
+            archive_f.seek(offset)
+            return pickle.load(archive_f)
+        finally:
+            archive_f.close()
+
+    def job_times(self, hosts=None, archive=True):
+        '''Collect when jobs were submitted, started and ended.
+
+:type hosts: list of strings
+:param hosts: list of hostnames.  If specified, only collect jobs on the
+    specified servers.
+:param boolean archive: also collect archived jobs.  Only the compact record
+    of times in archive.times is read, rather than the archived jobs
+    themselves.  Jobs archived before the times were recorded are not
+    included.
+
+:rtype: :class:`JobTimes`
+'''
+        if archive and os.path.exists(self._archive_times):
+            times = JobTimes.read(self._archive_times, self._archive_names)
+            if hosts:
+                times = times.select('hostname', hosts)
+        else:
+            times = JobTimes()
+        for (host, job_server) in self.job_servers.items():
+            if not hosts or host in hosts:
+                for job in job_server.jobs:
+                    times.append(host, job)
+        return times
+
+    def changes(self, since=None):
+        '''Find jobs in :attr:`job_servers` which have changed.
+
+:type since: integer
+:param since: time (in seconds since the epoch).  Only jobs modified at or
+    after this time (see :meth:`Job.mtime`) are returned.  All jobs are
+    returned if since is None.
+
+:rtype: iterator of (string, integer, :class:`Job`) tuples
+:returns: hostname, index and job of each job modified since the given time.
+'''
+        import calendar
+        for (host, job_server) in self.job_servers.items():
+            for (index, job) in enumerate(job_server.jobs):
+                if since is None or calendar.timegm(job.mtime()) >= since:
+                    yield (host, index, job)
+
+    def version(self):
+        '''Inspect the version of the cache file.
+
+:rtype: tuple
+:returns: identifier of the contents of the cache file, which changes
+    whenever the cache is dumped, or None if the cache file doesn't exist.
+'''
+        try:
+            return _cache_version(os.stat(self.cache))
+        except OSError:
+            return None
+
+    def wait(self, version=None, timeout=None, interval=1):
+        '''Wait for the cache file to change.
+
+inotify is used to wait for the cache file to be replaced where available
+(i.e. on Linux).  Otherwise the cache file is polled.  The lock is not
+required.
+
+:type version: tuple
+:param version: version of the cache file (see :meth:`version`) to compare
+    against.  Default: the current version.
+:param float timeout: maximum time (in seconds) to wait.  Wait indefinitely if
+    None.
+:param float interval: time (in seconds) between polling the cache file if
+    inotify is not available.
+
+:rtype: tuple
+:returns: version of the cache file, which is the same as the supplied version
+    only if the timeout expired.
+'''
+        if version is None:
+            version = self.version()
+        if timeout is not None:
+            end = time.time() + timeout
+        watcher = _Inotify(self.cache)
+        try:
+            while True:
+                current = self.version()
+                if current != version:
+                    return current
+                if timeout is None:
+                    wait = None
+                else:
+                    wait = end - time.time()
+                    if wait <= 0:
+                        return current
+                if watcher.fd is None:
+                    if wait is None or wait > interval:
+                        wait = interval
+                    time.sleep(wait)
+                else:
+                    watcher.wait(wait)
+        finally:
+            watcher.close()
+
+    def jobs(self, hosts=None, pattern=None, archive=False, tasks=False, under=None):
+        '''Find jobs in :attr:`job_servers`.
+
+See :meth:`pretty_print` for the arguments.
+
+:rtype: iterator of (string, integer, dictionary) tuples
+:returns: hostname, index and job spec (see :meth:`Job.job_spec`) of each
+    job.  The job spec also contains the handle of the job (see
+    :attr:`Job.handle`), if it has one.
+'''
+        if archive:
+            for row in self.archived_jobs(hosts, pattern, under, tasks):
+                yield row
+        else:
+            for (host, job_server) in self.job_servers.items():
+                if not hosts or job_server.hostname in hosts:
+                    for (index, job) in job_server.view(pattern, under):
+                        if tasks and isinstance(job, JobArray):
+                            specs = job.task_specs()
+                        else:
+                            specs = [job.job_spec()]
+                        for job_spec in specs:
+                            if job.handle is not None:
+                                job_spec['handle'] = job.handle
+                            yield (host, index, job_spec)
+
+    def records(self, hosts=None, pattern=None, archive=False, tasks=False):
+        '''Find jobs in :attr:`job_servers` as records for exporting.
+
+See :meth:`pretty_print` for the arguments and :func:`format_records` for
+writing the records.
+
+:rtype: iterator of dictionaries
+:returns: job spec (see :meth:`Job.job_spec`) and hostname of each job.  All
+    fields in :data:`record_fields` are present.
+'''
+        for (host, index, job_spec) in self.jobs(hosts, pattern, archive, tasks):
+            job_spec['hostname'] = host
+            yield dict((field, job_spec.get(field)) for field in record_fields)
+
+    def import_records(self, records, hostname=None):
+        '''Add jobs from records to the cache file.
+
+All records are added whilst holding the lock, with the cache file read and
+written only once.  Jobs are added even if a job with the same job_id exists.
+
+:type records: iterable of dictionaries
+:param records: records, e.g. as returned by :meth:`records` or
+    :func:`parse_records`.  Fields other than those in :data:`record_fields`
+    are ignored.
+:param string hostname: server to which the jobs are added.  If None, the
+    hostname field of each record is used (or localhost if it is not set).
+
+:rtype: integer
+:returns: number of jobs added.
+'''
+        self.load()
+        added = 0
+        try:
+            for record in records:
+                job_spec = dict((field, record.get(field)) for field in record_fields)
+                host = job_spec.pop('hostname')
+                host = hostname or host or 'localhost'
+                if host not in self.job_servers:
+                    self.job_servers[host] = JobServer(host)
+                self.job_servers[host].add(job_spec)
+                added += 1
+            self.dump()
+        finally:
+            if self._has_lock:
+                # Not dumped: leave the cache file unchanged.
+                self.job_servers = dict(localhost=JobServer())
+                self._release_lock()
+        return added
+
+    def format_jobs(self, hosts=None, pattern=None, short=False, archive=False, tasks=False, under=None):
+        '''Format :attr:`job_servers` as a table.
+
+See :meth:`pretty_print` for the arguments.
+
+:rtype: list of strings
+:returns: lines of the table.
+'''
+        return _format_jobs(self.jobs(hosts, pattern, archive, tasks, under), short)
+
+    def pretty_print(self, hosts=None, pattern=None, short=False, archive=False, tasks=False, under=None):
         '''Print out :attr:`job_servers`.
 
 :type hosts: list of strings
@@ -500,48 +2768,828 @@ with other_hostname to avoid unintended nameclashes.
     specified servers.
 :param string pattern: regular expression.  Only jobs which match the supplied
     pattern are printed.  If pattern is None then all jobs are printed.
-:param boolean short: print just the hostname, index, job_id and status.
+:param boolean short: print just the hostname, index, handle, job_id and
+    status.
+:param boolean archive: print jobs in the archive (see :meth:`archived_jobs`)
+    rather than in :attr:`job_servers`.  The index of an archived job is its
+    position in the archive.
+:param boolean tasks: list each task of job arrays (see :class:`JobArray`)
+    separately rather than the range-encoded status of the tasks.
+:param string under: directory.  If specified, print out only jobs whose path
+    is in the directory tree (see :meth:`JobServer.select_under`).
 '''
-        selected_jobs = {}
+        for line in self.format_jobs(hosts, pattern, short, archive, tasks, under):
+            print(line)
+
+class Transaction:
+    '''Optimistic-concurrency transaction on a :class:`JobCache`.
+
+Created by :meth:`JobCache.transaction`.
+
+:type job_cache: :class:`JobCache`
+:param job_cache: cache to be modified.
+
+.. attribute:: job_servers
+
+    private copy of :attr:`JobCache.job_servers` read without acquiring the
+    lock.  Changes to the job servers are saved by :meth:`commit`.  The
+    :attr:`JobCache.job_servers` attribute of job_cache refers to the same
+    copy until the transaction is committed, so :class:`JobCache` methods can
+    be used to modify the job servers within the transaction.
+
+.. attribute:: version
+
+    version of the cache file read.
+'''
+    def __init__(self, job_cache):
+        self.job_cache = job_cache
+        self.committed = False
+        (data, self.codec, self.version) = _read_cache(job_cache.cache)
+        # jobs in the snapshot and their identities keyed by (host, index).
+        self._base = {}
+        self._keys = {}
+        if data is None:
+            self._hosts = set()
+            self.job_servers = dict(localhost=JobServer())
+        else:
+            # Separate copies: one to record the snapshot and one to modify.
+            base = _loads_cache(data)
+            self._hosts = set(base.keys())
+            for (host, index, key, job) in _keyed_jobs(base):
+                self._base[(host, index)] = job
+                self._keys[(host, index)] = key
+            self.job_servers = _loads_cache(data)
+            for (host, job_server) in self.job_servers.items():
+                for (index, job) in enumerate(job_server.jobs):
+                    # Tag the job so it can be found in the snapshot, however
+                    # the job list is reordered.
+                    job._tx_key = (host, index)
+        job_cache.job_servers = self.job_servers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self._untag()
+        return False
+
+    def _untag(self):
+        '''Remove the tags which link jobs to the snapshot.'''
+        for job_server in self.job_servers.values():
+            for job in job_server.jobs:
+                job.__dict__.pop('_tx_key', None)
+
+    def commit(self, max_attempts=3000, interval=0.01):
+        '''Save the changes made to :attr:`job_servers` to the cache file.
+
+The lock is acquired (unless it is already held by the job cache) only for the
+duration of the commit.  If the cache file has not changed since it was read,
+then :attr:`job_servers` is saved directly.  Otherwise the changes made in
+the transaction are merged field-by-field into the current contents of the
+cache file.  Jobs are identified by their hostname, job_id and position
+amongst jobs with the same job_id.  Old jobs are archived if
+:attr:`JobCache.archive_age` is set, as when the cache is dumped.  If no
+changes were made and no jobs are archived, the cache file is not written.
+
+:param integer max_attempts: number of attempts to acquire the lock.
+:param float interval: time (in seconds) between attempts to acquire the lock.
+
+:raises: :class:`TransactionConflict` if a field of a job was changed to
+    different values both in the transaction and by another process.  The
+    cache file is left unchanged.
+'''
+        if self.committed:
+            raise UserError('Transaction has already been committed.')
+        job_cache = self.job_cache
+        unchanged = self._unchanged()
+        if not job_cache._has_lock:
+            job_cache._acquire_lock(max_attempts, interval)
+        try:
+            if unchanged and job_cache.archive_age is None:
+                # Nothing to save.
+                self._untag()
+                self._finish()
+                return
+            (data, codec, version) = _read_cache(job_cache.cache)
+            if version == self.version:
+                job_servers = self.job_servers
+                self._untag()
+            elif unchanged:
+                # Only archive jobs in the current cache.
+                self._untag()
+                job_servers = _loads_cache(data)
+            else:
+                job_servers = _loads_cache(data)
+                self._merge_into(job_servers)
+                self.codec = codec
+            if job_cache.archive_age is not None:
+                narchived = job_cache._archive_jobs(job_servers, max_age=job_cache.archive_age)
+                if unchanged and not narchived:
+                    self._finish()
+                    return
+            _assign_handles(job_servers)
+            _index_text(job_servers, job_cache.text_index)
+            _store_columns(job_servers, job_cache.columnar)
+            _dump_cache(job_cache.cache, job_servers, job_cache.codec or self.codec or 'pickle', job_cache.protocol)
+            _dump_mapped(job_cache.cache, job_servers, job_cache.mapped)
+            self._finish()
+        finally:
+            job_cache._release_lock()
+
+    def _finish(self):
+        '''Mark the transaction as committed.'''
+        self.committed = True
+        if self.job_cache.job_servers is self.job_servers:
+            self.job_cache.job_servers = dict(localhost=JobServer())
+
+    def _unchanged(self):
+        '''Check whether :attr:`job_servers` are the same as when they were read.
+
+:rtype: boolean
+:returns: True if no jobs or servers were added, removed, reordered or
+    modified in the transaction.
+'''
+        if set(self.job_servers) != self._hosts:
+            return False
+        njobs = 0
+        for (host, job_server) in self.job_servers.items():
+            for (index, job) in enumerate(job_server.jobs):
+                if job.__dict__.get('_tx_key') != (host, index):
+                    return False
+                base_job = self._base[(host, index)]
+                if job.__class__ is not base_job.__class__:
+                    return False
+                # The text index is not part of the job (see TextIndex).
+                attrs = dict(job.__dict__)
+                attrs.pop('_tx_key')
+                attrs.pop('_text', None)
+                base_attrs = dict(base_job.__dict__)
+                base_attrs.pop('_text', None)
+                if attrs != base_attrs:
+                    return False
+                njobs += 1
+        return njobs == len(self._base)
+
+    def _merge_into(self, current):
+        '''Apply the changes made in the transaction to current.
+
+:type current: dictionary
+:param current: :class:`JobServer` instances keyed by hostname, as currently
+    stored in the cache file.
+'''
+        current_jobs = dict((key, job) for (host, index, key, job) in _keyed_jobs(current))
+        kept = set()
         for (host, job_server) in self.job_servers.items():
-            if not hosts or job_server.hostname in hosts:
-                selected_jobs[host] = job_server.select(pattern)
-                # store only servers with jobs matching the pattern
-                if not selected_jobs[host]:
-                    selected_jobs.pop(host)
-
-        # want output to be ordered: use list.
-        attrs = ['hostname', 'index', 'job_id', 'program', 'path', 'input_fname', 'output_fname', 'submit', 'status', 'comment']
-        lengths = dict((attr, len(attr)) for attr in attrs)
-        used = dict((attr, None) for attr in attrs)
-        for (host, jobs) in selected_jobs.items():
-            lengths['hostname'] = max(lengths['hostname'], len(host))
-            for job in jobs:
-                for (attr, val) in job.job_spec().items():
-                    lengths[attr] = max(lengths[attr], len(str(val)))
-                    used[attr] = used[attr] or val
-
-        # don't output unused fields
-        # remove 'long' fields if requested
-        for (attr, val) in used.items():
-            if (attr not in ['hostname', 'index'] and not val) or \
-               (short and attr not in ['hostname', 'index', 'job_id', 'status']):
-                attrs.remove(attr)
-                lengths.pop(attr)
-
-        if selected_jobs:
-            # if not an empty dict, then we have jobs to print.
-            # want output in a specific order.
-            fmt = ''
-            for attr in attrs:
-                fmt = '%s%%(%s)-%is  ' % (fmt, attr, lengths[attr])
-            print(fmt % dict((attr, attr) for attr in attrs))
-            print(fmt % dict((attr, '-'*lengths[attr]) for attr in attrs))
-            for (host, jobs) in selected_jobs.items():
-                for job in jobs:
-                    output_dict = job.job_spec()
-                    output_dict.update((
-                        ('hostname', host),
-                        ('index', self.job_servers[host].jobs.index(job))
-                    ))
-                    print(fmt % output_dict)
+            if host not in current:
+                current[host] = JobServer(host)
+            for job in job_server.jobs:
+                tx_key = job.__dict__.pop('_tx_key', None)
+                if tx_key is None:
+                    # new job.  Its handle may have been given to a job added
+                    # by another process: a new one is assigned when dumped.
+                    job.__dict__.pop('_text', None)
+                    job.__dict__.pop('handle', None)
+                    current[host].jobs.append(job)
+                    continue
+                key = self._keys[tx_key]
+                kept.add(key)
+                current_job = current_jobs.get(key)
+                if current_job is None:
+                    # deleted by another process.
+                    continue
+                base_job = self._base[tx_key]
+                for (attr, val) in job.__dict__.items():
+                    base_val = base_job.__dict__.get(attr)
+                    if attr in ('_timestamp', '_text') or val == base_val:
+                        continue
+                    current_val = current_job.__dict__.get(attr)
+                    if current_val != base_val and current_val != val:
+                        raise TransactionConflict('Job %s on %s: %s changed to %s but is now %s.' % (key[1], host, attr, val, current_val))
+                    setattr(current_job, attr, val)
+                    current_job._changed()
+                    if attr == 'path':
+                        current[host]._path_index = None
+                    current_job._timestamp = max(current_job._timestamp, job._timestamp)
+        # Remove jobs deleted in the transaction.
+        deleted = set(id(current_jobs[key]) for key in self._keys.values() if key not in kept and key in current_jobs)
+        if deleted:
+            for job_server in current.values():
+                job_server.jobs = [job for job in job_server.jobs if id(job) not in deleted]
+                job_server._path_index = None
+        # Remove servers deleted in the transaction.
+        for host in self._hosts:
+            if host not in self.job_servers:
+                current.pop(host, None)
+
+def _keyed_jobs(job_servers):
+    '''Identify jobs independently of their position.
+
+:type job_servers: dictionary
+:param job_servers: :class:`JobServer` instances keyed by hostname.
+
+:rtype: iterator of (string, integer, tuple, :class:`Job`) tuples
+:returns: hostname, index, identity and job.  The identity of a job is the
+    hostname, job_id and number of jobs with the same job_id up to and
+    including the job.
+'''
+    for (host, job_server) in job_servers.items():
+        count = {}
+        for (index, job) in enumerate(job_server.jobs):
+            job_id = str(job.job_id)
+            count[job_id] = count.get(job_id, 0) + 1
+            yield (host, index, (host, job_id, count[job_id]), job)
+
+class JobCacheGroup:
+    '''Read-only view of several job caches.
+
+For example, the caches of all members of a group can be queried together
+without copying them into a single cache (cf. :meth:`JobCache.merge`).  Each
+cache file is read without acquiring its lock (see :meth:`JobCache.load`), so
+querying the group neither blocks nor is blocked by processes using the caches.
+Changes made to the job caches in the group must not be dumped.
+
+:type caches: list of strings
+:param caches: paths to cache files.  Each path may be a glob pattern (e.g.
+    /home/*/.cache/jm/jm.cache), which is replaced by the cache files it
+    matches.
+:param integer threads: number of cache files to read at once.
+
+.. attribute:: job_caches
+
+    list of :class:`JobCache` instances, in the order the cache files were
+    given.  Cache files matched by a glob pattern are sorted.
+
+.. attribute:: sources
+
+    list of paths to the cache files of :attr:`job_caches`.
+'''
+    def __init__(self, caches, load=False, threads=8):
+        import glob
+        self.threads = threads
+        self.sources = []
+        for pattern in caches:
+            pattern = os.path.expandvars(os.path.expanduser(pattern))
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise UserError('No cache files match: %s.' % (pattern))
+            for cache in matches:
+                cache = os.path.normpath(os.path.abspath(cache))
+                if cache not in self.sources:
+                    self.sources.append(cache)
+        self.job_caches = [JobCache(cache) for cache in self.sources]
+        if load:
+            self.load()
+
+    def load(self):
+        '''Read in the job_servers data of each job cache.
+
+The cache files are read concurrently and without acquiring their locks.
+'''
+        import multiprocessing.pool
+        if len(self.job_caches) > 1 and self.threads > 1:
+            pool = multiprocessing.pool.ThreadPool(min(self.threads, len(self.job_caches)))
+            try:
+                pool.map(lambda job_cache: job_cache.load(lock=False), self.job_caches)
+            finally:
+                pool.close()
+        else:
+            for job_cache in self.job_caches:
+                job_cache.load(lock=False)
+
+    def jobs(self, hosts=None, pattern=None, archive=False, tasks=False, under=None):
+        '''Find jobs in all job caches.
+
+See :meth:`JobCache.pretty_print` for the arguments.
+
+The jobs in each cache are merged as they are generated, ordered by hostname,
+then by cache file and then by index.  Archived jobs are ordered by cache file
+and then by index in the archive.
+
+:rtype: iterator of (string, string, integer, dictionary) tuples
+:returns: path to the cache file, hostname, index and job spec (see
+    :meth:`Job.job_spec`) of each job.
+'''
+        if archive:
+            for (source, job_cache) in zip(self.sources, self.job_caches):
+                for (host, index, job_spec) in job_cache.archived_jobs(hosts, pattern, under, tasks):
+                    yield (source, host, index, job_spec)
+        else:
+            # heapq.merge compares the leading items of each tuple only: the
+            # source number and row number break any ties before the job spec.
+            streams = [self._sorted_jobs(n, job_cache, hosts, pattern, tasks, under) for (n, job_cache) in enumerate(self.job_caches)]
+            for (host, n, index, row, job_spec) in heapq.merge(*streams):
+                yield (self.sources[n], host, index, job_spec)
+
+    def _sorted_jobs(self, n, job_cache, hosts, pattern, tasks, under):
+        '''Find jobs in a job cache ordered by hostname, as needed by :meth:`jobs`.'''
+        row = 0
+        for host in sorted(job_cache.job_servers):
+            if not hosts or host in hosts:
+                for (_, index, job_spec) in job_cache.jobs([host], pattern, tasks=tasks, under=under):
+                    yield (host, n, index, row, job_spec)
+                    row += 1
+
+    def version(self):
+        '''Inspect the versions of the cache files.
+
+:rtype: tuple
+:returns: versions of the cache files (see :meth:`JobCache.version`).
+'''
+        return tuple(job_cache.version() for job_cache in self.job_caches)
+
+    def wait(self, version=None, timeout=None, interval=1):
+        '''Wait for any of the cache files to change.
+
+The cache files are polled.  See :meth:`JobCache.wait` for the arguments.
+
+:rtype: tuple
+:returns: versions of the cache files, which are the same as the supplied
+    version only if the timeout expired.
+'''
+        if version is None:
+            version = self.version()
+        if timeout is not None:
+            end = time.time() + timeout
+        while True:
+            current = self.version()
+            if current != version:
+                return current
+            wait = interval
+            if timeout is not None:
+                wait = min(wait, end - time.time())
+                if wait <= 0:
+                    return current
+            time.sleep(wait)
+
+    def format_jobs(self, hosts=None, pattern=None, short=False, archive=False, tasks=False, under=None):
+        '''Format the jobs in all job caches as a table.
+
+See :meth:`JobCache.pretty_print` for the arguments.  The path to the cache
+file containing each job is given in the source column.
+
+:rtype: list of strings
+:returns: lines of the table.
+'''
+        rows = []
+        for (source, host, index, job_spec) in self.jobs(hosts, pattern, archive, tasks, under):
+            job_spec['source'] = source
+            rows.append((host, index, job_spec))
+        return _format_jobs(rows, short)
+
+    def pretty_print(self, hosts=None, pattern=None, short=False, archive=False, tasks=False, under=None):
+        '''Print out the jobs in all job caches.
+
+See :meth:`JobCache.pretty_print` for the arguments.
+'''
+        for line in self.format_jobs(hosts, pattern, short, archive, tasks, under):
+            print(line)
+
+### Completion hooks ###
+
+# Commands run when jobs of a program finish, keyed by program.  See
+# register_completion_hook.
+completion_hooks = {}
+
+def register_completion_hook(program, command):
+    '''Register a command to be run when a job of a program finishes.
+
+See :class:`HookRunner`.
+
+:param string program: name of the program (see :class:`Job`).
+:param string command: shell command.  The command is run in the directory of
+    the job with the environment variables JM_JOB_ID, JM_PROGRAM, JM_PATH,
+    JM_INPUT_FNAME and JM_OUTPUT_FNAME set to the corresponding attributes of
+    the job.
+'''
+    completion_hooks[program] = command
+
+### Statistics ###
+
+class JobTimes:
+    '''Columnar record of when jobs were submitted, started and ended.
+
+Each job is stored as a row of :attr:`columns` in a single array of doubles
+(the hostname, program and status as indices into :attr:`names`), so that
+records of millions of jobs can be stored compactly, read quickly from a file
+and analysed (using numpy, if available) without creating :class:`Job`
+instances.  Unknown times are stored as NaN.
+
+:type names: :class:`JobTimes`
+:param names: share the table of names with another instance.  Not an
+    attribute.
+
+.. attribute:: names
+
+    list of the hostnames, programs and statuses referred to in :attr:`data`.
+
+.. attribute:: data
+
+    array.array of doubles containing the rows of :attr:`columns` of each
+    job.
+'''
+    columns = ('hostname', 'program', 'status', 'submitted', 'started', 'ended')
+
+    def __init__(self, names=None):
+        if names is None:
+            self.names = []
+            self._ids = {}
+        else:
+            self.names = names.names
+            self._ids = names._ids
+        self.data = array.array('d')
+
+    def __len__(self):
+        return len(self.data) // len(self.columns)
+
+    def _id(self, name):
+        '''Find (or assign) the index of a name in :attr:`names`.'''
+        name = str(name)
+        if name not in self._ids:
+            self._ids[name] = len(self.names)
+            self.names.append(name)
+        return self._ids[name]
+
+    def append(self, hostname, job):
+        '''Add the times of a job (see :meth:`Job.times`).
+
+:param string hostname: name of the server of the job.
+:type job: :class:`Job`
+:param job: job.
+'''
+        nan = float('nan')
+        row = [self._id(hostname), self._id(job.program), self._id(job.status)]
+        row.extend(nan if job_time is None else job_time for job_time in job.times())
+        self.data.extend(row)
+
+    @classmethod
+    def read_names(cls, names_fname):
+        '''Create an empty instance with the names stored in names_fname.'''
+        times = cls()
+        if os.path.exists(names_fname):
+            names_f = open(names_fname)
+            try:
+                for line in names_f:
+                    times._id(json.loads(line))
+            finally:
+                names_f.close()
+        return times
+
+    @classmethod
+    def read(cls, fname, names_fname):
+        '''Read the times of jobs from a file.
+
+:param string fname: file containing the rows of :attr:`data`, as written by
+    :meth:`JobCache.archive_jobs`.
+:param string names_fname: file containing :attr:`names`, one (JSON-encoded)
+    name per line.
+'''
+        times = cls.read_names(names_fname)
+        times_f = open(fname, 'rb')
+        try:
+            nrows = os.fstat(times_f.fileno()).st_size // (times.data.itemsize*len(cls.columns))
+            # Ignore a partially written row.
+            times.data.fromfile(times_f, nrows*len(cls.columns))
+        finally:
+            times_f.close()
+        return times
+
+    def column(self, name):
+        '''Extract a column.
+
+:param string name: name of the column.  See :attr:`columns`.
+
+:rtype: numpy.ndarray or array.array
+:returns: the column as a numpy array, if numpy is available, or an array of
+    doubles otherwise.
+'''
+        index = self.columns.index(name)
+        if _numpy() is not None:
+            return numpy.frombuffer(self.data, dtype=float)[index::len(self.columns)]
+        else:
+            return self.data[index::len(self.columns)]
+
+    def select(self, column, names):
+        '''Select the jobs with one of the given names in a column.
+
+:param string column: hostname, program or status.
+:type names: list of strings
+:param names: names to select.
+
+:rtype: :class:`JobTimes`
+:returns: the selected jobs.  The table of names is shared.
+'''
+        selected = JobTimes(self)
+        ids = [self._ids[name] for name in names if name in self._ids]
+        ncolumns = len(self.columns)
+        if _numpy() is not None:
+            rows = numpy.frombuffer(self.data, dtype=float).reshape(-1, ncolumns)
+            rows = rows[numpy.isin(rows[:, self.columns.index(column)], ids)]
+            selected.data.frombytes(rows.tobytes())
+        else:
+            ids = set(ids)
+            index = self.columns.index(column)
+            for row in range(len(self)):
+                if self.data[row*ncolumns+index] in ids:
+                    selected.data.extend(self.data[row*ncolumns:(row+1)*ncolumns])
+        return selected
+
+    def statistics(self, group_by=('hostname', 'program', 'status'), percentiles=(50, 90, 99)):
+        '''Summarise the queue wait and run times of groups of jobs.
+
+The wait time of a job is the time between it being submitted and it starting
+and the run time is the time between it starting and ending.  Percentiles are
+computed by linear interpolation between the closest ranks.
+
+:type group_by: sequence of strings
+:param group_by: group jobs with the same values of these columns (hostname,
+    program and/or status).
+:type percentiles: sequence of numbers
+:param percentiles: percentiles of the wait and run times to compute.
+
+:rtype: list of dictionaries
+:returns: the statistics of each group, sorted by group: the values of the
+    group_by columns, the number of jobs (count), the number of jobs which
+    ended per day over the period in which the jobs ended (throughput) and
+    lists of the percentiles of the wait times (wait) and run times (run).
+    Statistics which cannot be computed (e.g. no run times are known) are
+    None.
+'''
+        columns = dict((name, self.column(name)) for name in self.columns)
+        if _numpy() is not None:
+            groups = self._numpy_groups(columns, group_by)
+        else:
+            groups = self._array_groups(columns, group_by)
+        stats = []
+        for (key, (submitted, started, ended)) in groups:
+            group = dict((name, self.names[int(key_id)]) for (name, key_id) in zip(group_by, key))
+            group.update(
+                          count=len(submitted),
+                          throughput=None,
+                          wait=_percentiles(_differences(started, submitted), percentiles),
+                          run=_percentiles(_differences(ended, started), percentiles),
+                        )
+            ended = _differences(ended, [0]*len(ended))
+            if len(ended) > 1 and ended[-1] > ended[0]:
+                group['throughput'] = float((len(ended)-1) * 86400.0 / (ended[-1] - ended[0]))
+            stats.append(group)
+        stats.sort(key=lambda group: tuple(group[name] for name in group_by))
+        return stats
+
+    def _numpy_groups(self, columns, group_by):
+        '''Split the times into groups using numpy.'''
+        times = [columns[name] for name in ('submitted', 'started', 'ended')]
+        if not group_by:
+            return [((), times)] if len(self) else []
+        # Combine the group_by columns into a single integer key: grouping by
+        # one key is much faster than by rows of keys.
+        base = max(len(self.names), 1)
+        keys = numpy.zeros(len(self), dtype=numpy.int64)
+        for name in group_by:
+            keys = keys*base + columns[name].astype(numpy.int64)
+        (unique, inverse) = numpy.unique(keys, return_inverse=True)
+        order = numpy.argsort(inverse, kind='stable')
+        bounds = numpy.cumsum(numpy.bincount(inverse, minlength=len(unique)))[:-1]
+        split = [numpy.split(column[order], bounds) for column in times]
+        groups = []
+        for (group, key) in enumerate(unique.tolist()):
+            key_ids = []
+            for name in group_by:
+                (key, key_id) = divmod(key, base)
+                key_ids.insert(0, key_id)
+            groups.append((tuple(key_ids), [column[group] for column in split]))
+        return groups
+
+    def _array_groups(self, columns, group_by):
+        '''Split the times into groups without numpy.'''
+        groups = {}
+        keys = list(zip(*[columns[name] for name in group_by])) if group_by else [()]*len(self)
+        for (row, key) in enumerate(keys):
+            if key not in groups:
+                groups[key] = (array.array('d'), array.array('d'), array.array('d'))
+            for (group_column, name) in zip(groups[key], ('submitted', 'started', 'ended')):
+                group_column.append(columns[name][row])
+        return list(groups.items())
+
+def _differences(end, start):
+    '''Subtract start from end, discarding unknown (NaN) values.
+
+:rtype: numpy.ndarray or list
+:returns: sorted differences.
+'''
+    if numpy is not None and isinstance(end, numpy.ndarray):
+        diff = end - numpy.asarray(start)
+        return numpy.sort(diff[~numpy.isnan(diff)])
+    else:
+        return sorted(e - s for (e, s) in zip(end, start) if e == e and s == s)
+
+def _percentiles(values, percentiles):
+    '''Compute percentiles of sorted values by linear interpolation.
+
+:rtype: list of floats
+:returns: the percentiles or None if there are no values.
+'''
+    if len(values) == 0:
+        return None
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return [float(val) for val in numpy.percentile(values, percentiles)]
+    result = []
+    for percentile in percentiles:
+        rank = (len(values) - 1) * percentile / 100.0
+        lower = int(rank)
+        upper = min(lower + 1, len(values) - 1)
+        result.append(values[lower] + (values[upper] - values[lower]) * (rank - lower))
+    return result
+
+### Export and import ###
+
+# Fields of the records of jobs (see JobCache.records).
+record_fields = ['hostname', 'job_id', 'program', 'path', 'input_fname', 'output_fname', 'status', 'submit', 'comment',
+                 'depends', 'tasks', 'exit_status', 'hook_status', 'hook_time', 'hook_output']
+# Fields which are not strings, converted when read from CSV.
+_RECORD_TYPES = dict(exit_status=int, hook_status=int, hook_time=float)
+
+def format_records(records, fmt='json'):
+    '''Convert records of jobs to lines of JSON or CSV.
+
+:type records: iterable of dictionaries
+:param records: records, as returned by :meth:`JobCache.records`.
+:param string fmt: json (one JSON object per line) or csv (a header line with
+    the :data:`record_fields` followed by one line per record).
+
+:rtype: iterator of strings
+:returns: lines, each including the newline.  Records are converted one at a
+    time, so the lines can be written as the records are found.
+'''
+    import csv
+    if fmt == 'json':
+        for record in records:
+            yield '%s\n' % (json.dumps(record, sort_keys=True))
+    elif fmt == 'csv':
+        buf = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        writer.writerow(record_fields)
+        for record in records:
+            writer.writerow([record.get(field) for field in record_fields])
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+        # Header only if there are no records.
+        if buf.getvalue():
+            yield buf.getvalue()
+    else:
+        raise UserError('Unknown format: %s.' % (fmt))
+
+def parse_records(lines, fmt='json'):
+    '''Read records of jobs from lines of JSON or CSV.
+
+:type lines: iterable of strings
+:param lines: lines (e.g. a file object) in the format written by
+    :func:`format_records`.  CSV files may contain any subset of
+    :data:`record_fields` as columns.
+:param string fmt: json or csv.  See :func:`format_records`.
+
+:rtype: iterator of dictionaries
+:returns: records.  Empty CSV fields are None.  Lines are read as the records
+    are consumed.
+'''
+    import csv
+    if fmt == 'json':
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    elif fmt == 'csv':
+        for row in csv.DictReader(lines):
+            record = {}
+            for (field, val) in row.items():
+                if val == '' or val is None:
+                    val = None
+                elif field in _RECORD_TYPES:
+                    val = _RECORD_TYPES[field](val)
+                record[field] = val
+            yield record
+    else:
+        raise UserError('Unknown format: %s.' % (fmt))
+
+### Output ###
+
+def _format_jobs(rows, short=False):
+    '''Format a table of jobs.
+
+:type rows: iterable of (string, integer, dictionary) tuples
+:param rows: hostname, index and job spec (see :meth:`Job.job_spec`) of each
+    job.
+:param boolean short: print just the source, hostname, index, handle, job_id
+    and status.  The source column is only present if the job specs contain the
+    cache file the job was read from (see :class:`JobCacheGroup`).
+
+:rtype: list of strings
+:returns: lines of the table.  Empty if there are no jobs.
+'''
+    rows = list(rows)
+    lines = []
+
+    # want output to be ordered: use list.
+    attrs = ['source', 'hostname', 'index', 'handle', 'job_id', 'program', 'path', 'input_fname', 'output_fname', 'submit', 'depends', 'status', 'tasks', 'exit_status', 'hook_status', 'comment']
+    lengths = dict((attr, len(attr)) for attr in attrs)
+    used = dict((attr, None) for attr in attrs)
+    for (host, index, job_spec) in rows:
+        lengths['hostname'] = max(lengths['hostname'], len(host))
+        lengths['index'] = max(lengths['index'], len(str(index)))
+        for (attr, val) in job_spec.items():
+            if attr in used:
+                lengths[attr] = max(lengths[attr], len(str(val)))
+                used[attr] = used[attr] or val
+
+    # don't output unused fields
+    # remove 'long' fields if requested
+    for (attr, val) in used.items():
+        if (attr not in ['hostname', 'index'] and not val) or \
+           (short and attr not in ['source', 'hostname', 'index', 'handle', 'job_id', 'status']):
+            attrs.remove(attr)
+            lengths.pop(attr)
+
+    if rows:
+        # if not an empty list, then we have jobs to print.
+        # want output in a specific order.
+        fmt = ''
+        for attr in attrs:
+            fmt = '%s%%(%s)-%is  ' % (fmt, attr, lengths[attr])
+        lines.append(fmt % dict((attr, attr) for attr in attrs))
+        lines.append(fmt % dict((attr, '-'*lengths[attr]) for attr in attrs))
+        for (host, index, job_spec) in rows:
+            # Not all jobs have all fields (e.g. only job arrays have tasks).
+            output_dict = dict((attr, None) for attr in attrs)
+            # Archived jobs have no handle.
+            output_dict['handle'] = ''
+            output_dict.update(job_spec)
+            output_dict.update((
+                ('hostname', host),
+                ('index', index)
+            ))
+            lines.append(fmt % output_dict)
+    return lines
+
+class _Inotify:
+    '''Wait for a file to be written or replaced using inotify.
+
+The directory containing the file is watched, as the file is replaced rather
+than modified.  If inotify is not available, :attr:`fd` is None.
+
+:param string path: path to the file.
+'''
+    # Flags from sys/inotify.h.
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+
+    def __init__(self, path):
+        self.fd = None
+        self.name = os.path.basename(path).encode()
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init()
+        except (ImportError, OSError, AttributeError, TypeError):
+            return
+        if fd < 0:
+            return
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(fd, os.path.dirname(path).encode(), mask) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def wait(self, timeout=None):
+        '''Wait until the file is written, replaced or timeout seconds pass.'''
+        if timeout is not None:
+            end = time.time() + timeout
+        while True:
+            if timeout is not None:
+                timeout = max(end - time.time(), 0)
+            if not select.select([self.fd], [], [], timeout)[0]:
+                return
+            events = os.read(self.fd, 65536)
+            # struct inotify_event: int wd; uint32 mask, cookie, len; char name[len]
+            offset = 0
+            while offset < len(events):
+                (wd, mask, cookie, length) = struct.unpack_from('iIII', events, offset)
+                offset += struct.calcsize('iIII')
+                name = events[offset:offset+length].rstrip(b'\0')
+                offset += length
+                if name == self.name:
+                    return
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+### Storage layers and daemon machinery ###
+
+# Kept in submodules, which use the classes above, and available from here.
+from job_manager.storage import JobTable, MappedCache, PathIndex, TextIndex, _dump_mapped, _path_key
+from job_manager.daemon import HookRunner, LocalExecutor, PollInterval, Scheduler
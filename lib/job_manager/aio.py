@@ -0,0 +1,207 @@
+'''asyncio interface to job caches and queueing systems.
+
+For use in applications built upon an asyncio event loop (e.g. web services
+which track many caches).  The methods of :class:`job_manager.JobCache` block
+whilst waiting for the lock on the cache file, reading and writing the cache
+file and querying queueing systems.  Here the lock is instead acquired by
+polling without blocking the event loop, reading and writing cache files is
+done in the default executor of the event loop and queueing systems are
+queried concurrently using asyncio subprocesses.
+
+Requires python 3.5 or later.
+'''
+
+import asyncio
+import time
+
+import job_manager
+
+async def query(backend, job_ids=None):
+    '''Query a queueing system without blocking the event loop.
+
+See :meth:`job_manager.QueueBackend.query`.
+
+:type backend: :class:`job_manager.QueueBackend`
+:param backend: queueing system.
+:type job_ids: list of strings
+:param job_ids: ids of the jobs of interest.  If None, then all jobs belonging
+    to the current user are of interest.
+
+:rtype: dictionary
+:returns: status of each job found, keyed by the job id reported by the
+    queueing system, or None if the queueing system is not available.
+'''
+    command = backend.command(job_ids)
+    if command is None:
+        return {}
+    try:
+        proc = await asyncio.create_subprocess_exec(*command,
+                                                    stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.DEVNULL)
+    except OSError:
+        # command doesn't exists on this server---skip.
+        return None
+    output = (await proc.communicate())[0].decode(errors='replace')
+    if not backend.success(proc.returncode):
+        return None
+    return dict((job_id, backend.status(stat)) for (job_id, stat) in backend.parse(output))
+
+async def queue_snapshot(job_ids=None, backends=None):
+    '''Query the queueing systems concurrently for the status of jobs.
+
+See :func:`job_manager.queue_snapshot`.
+
+:type job_ids: list of strings
+:param job_ids: ids of the jobs of interest.  If None, then all jobs belonging
+    to the current user are of interest.
+:type backends: list of :class:`job_manager.QueueBackend` instances
+:param backends: queueing systems to query.  Default: all registered backends.
+
+:rtype: :class:`job_manager.QueueSnapshot`
+'''
+    if backends is None:
+        backends = job_manager.queue_backends
+    snapshot = job_manager.QueueSnapshot()
+    statuses = await asyncio.gather(*[query(backend, job_ids) for backend in backends])
+    # Later queueing systems take precedence, as for the blocking version.
+    for found in statuses:
+        snapshot.update(found)
+    return snapshot
+
+
+class AsyncJobCache:
+    '''asyncio interface to a :class:`job_manager.JobCache`.
+
+Operations on the same instance are run one at a time.  The job servers of
+the job cache must not be modified whilst an operation is in progress.
+
+:type job_cache: :class:`job_manager.JobCache`
+:param job_cache: job cache.
+:param integer max_attempts: number of attempts to acquire the lock on the
+    cache file.
+:param float interval: time (in seconds) between attempts to acquire the lock.
+'''
+    def __init__(self, job_cache, max_attempts=3000, interval=0.01):
+        self.job_cache = job_cache
+        self.max_attempts = max_attempts
+        self.interval = interval
+        self._busy = asyncio.Lock()
+
+    async def _run(self, function, *args):
+        '''Run function in the default executor of the event loop.'''
+        return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+    async def _acquire_lock(self):
+        '''Acquire the lock on the cache file without blocking the event loop.
+
+:raises: :class:`job_manager.LockException` if the lock is not obtained
+    after :attr:`max_attempts` attempts.
+'''
+        for i in range(self.max_attempts):
+            try:
+                self.job_cache._acquire_lock(1, 0)
+                return
+            except job_manager.LockException:
+                await asyncio.sleep(self.interval)
+        raise job_manager.LockException('Cannot obtain lock file after %s attempts: %s.' % (self.max_attempts, self.job_cache._lock))
+
+    async def load(self, lock=True):
+        '''Read in the job_servers data from the cache file.
+
+See :meth:`job_manager.JobCache.load`.
+'''
+        async with self._busy:
+            if lock and not self.job_cache._has_lock:
+                await self._acquire_lock()
+            loaded = False
+            try:
+                await self._run(self.job_cache.load, False)
+                loaded = True
+            finally:
+                if not loaded:
+                    self.job_cache._release_lock()
+
+    async def dump(self):
+        '''Dump job_servers data to the cache file.
+
+See :meth:`job_manager.JobCache.dump`.
+'''
+        async with self._busy:
+            if not self.job_cache._has_lock:
+                await self._acquire_lock()
+            await self._run(self.job_cache.dump)
+
+    async def transact(self, function, retries=3):
+        '''Apply function to the cache in a :class:`job_manager.Transaction`.
+
+See :meth:`job_manager.JobCache.transact`.  The cache is read and the
+transaction committed in the default executor.
+
+:param function: function which takes the dictionary of job servers in the
+    transaction and modifies them.  If function returns an awaitable object
+    (e.g. function is a coroutine function), then it is awaited.
+:param integer retries: number of times function is re-applied to a new
+    snapshot of the cache if the transaction conflicts with changes made by
+    another process.
+
+:returns: value returned by function.
+'''
+        async with self._busy:
+            for attempt in range(retries+1):
+                tx = await self._run(self.job_cache.transaction)
+                value = function(tx.job_servers)
+                if hasattr(value, '__await__'):
+                    value = await value
+                await self._acquire_lock()
+                try:
+                    # Transaction.commit releases the lock.
+                    await self._run(tx.commit)
+                    return value
+                except job_manager.TransactionConflict:
+                    if attempt == retries:
+                        raise
+
+    async def auto_update(self, backends=None):
+        '''Auto-update the status of the jobs on the localhost server.
+
+The queueing systems are queried concurrently for the held, queueing and
+running jobs.  See :meth:`job_manager.JobServer.auto_update`.
+
+:type backends: list of :class:`job_manager.QueueBackend` instances
+:param backends: queueing systems to query.  Default: all registered backends.
+'''
+        async def update(job_servers):
+            job_server = job_servers['localhost']
+            active = [str(job.job_id) for job in job_server.jobs if job.status in job_manager._ACTIVE_STATUSES]
+            if active:
+                snapshot = await queue_snapshot(active, backends)
+            else:
+                snapshot = job_manager.QueueSnapshot()
+            # Output files and /proc are read in the executor.
+            await self._run(job_server.auto_update, snapshot)
+        await self.transact(update)
+
+    async def wait(self, version=None, timeout=None, interval=1):
+        '''Wait for the cache file to change.
+
+The cache file is polled.  See :meth:`job_manager.JobCache.wait` for the
+arguments.
+
+:rtype: tuple
+:returns: version of the cache file, which is the same as the supplied version
+    only if the timeout expired.
+'''
+        if version is None:
+            version = self.job_cache.version()
+        if timeout is not None:
+            end = time.time() + timeout
+        while True:
+            current = self.job_cache.version()
+            if current != version:
+                return current
+            wait = interval
+            if timeout is not None:
+                wait = min(wait, end - time.time())
+                if wait <= 0:
+                    return current
+            await asyncio.sleep(wait)
@@ -0,0 +1,857 @@
+'''Machinery of the jm.py daemon.
+
+Jobs are launched locally by :class:`LocalExecutor`, pending jobs submitted by
+:class:`Scheduler` and completion hooks run by :class:`HookRunner`, with the
+time between cycles set by :class:`PollInterval`.  All are also available from
+:mod:`job_manager`.
+'''
+
+import errno
+import os
+import sys
+import time
+
+from job_manager import JobStatus, UserError, completion_hooks
+
+### Local execution ###
+
+class LocalExecutor:
+    '''Launch and track jobs on the local computer.
+
+Jobs are launched by the executor, rather than by the user, and recorded in
+the cache as soon as they are started, with their pid as the job_id.  At most
+max_jobs jobs are run at a time: further jobs wait in a pending queue until a
+running job exits.  The exit status of each job is recorded in the cache as
+soon as the job exits, so the status of jobs launched by the executor does not
+rely on :meth:`JobServer.auto_update`.
+
+:type job_cache: :class:`JobCache`
+:param job_cache: cache in which to record the jobs.  Jobs are added to the
+    localhost :class:`JobServer` using transactions (see
+    :meth:`JobCache.transaction`), so the lock is not held whilst jobs run.
+:param integer max_jobs: maximum number of jobs to run simultaneously.
+    Default: number of processors available.
+
+.. attribute:: pending
+
+    list of (command, job spec) tuples of jobs waiting to be launched.
+
+.. attribute:: running
+
+    dictionary of the subprocess.Popen instances of running jobs, keyed by pid.
+'''
+    def __init__(self, job_cache, max_jobs=None):
+        import multiprocessing
+        self.job_cache = job_cache
+        if max_jobs is None:
+            try:
+                max_jobs = len(os.sched_getaffinity(0))
+            except AttributeError:
+                max_jobs = multiprocessing.cpu_count()
+        self.max_jobs = max_jobs
+        self.pending = []
+        self.running = {}
+
+    def submit(self, command, job_spec=None):
+        '''Add a job to the pending queue.
+
+:type command: list of strings or string
+:param command: command to run.  A string is run using the shell.
+:type job_spec: dictionary
+:param job_spec: description of the job.  See :class:`Job` and
+    :meth:`Job.job_spec` for possible fields and format.  The job_id is set to
+    the pid of the job.  The program defaults to the name of the command and
+    the path to the current working directory.  The job is run in path and, if
+    output_fname is set, its standard output and standard error are written to
+    output_fname in path.
+'''
+        job_spec = dict(job_spec or {})
+        if isinstance(command, str):
+            name = command.split()[0]
+        else:
+            name = command[0]
+        if not job_spec.get('program'):
+            job_spec['program'] = os.path.basename(name)
+        if not job_spec.get('path'):
+            job_spec['path'] = os.getcwd()
+        job_spec['status'] = JobStatus.running
+        self.pending.append((command, job_spec))
+
+    def launch(self):
+        '''Launch pending jobs until max_jobs jobs are running.
+
+Each job is only allowed to start executing once it has been recorded in the
+cache.  If the job cannot be recorded, then it is killed before it executes and
+the exception is raised.
+
+:rtype: integer
+:returns: number of jobs launched.
+'''
+        import subprocess
+        nlaunched = 0
+        while self.pending and len(self.running) < self.max_jobs:
+            (command, job_spec) = self.pending.pop(0)
+            if job_spec.get('output_fname'):
+                output = open(os.path.join(job_spec['path'], job_spec['output_fname']), 'ab')
+            else:
+                output = None
+            # The child waits (in a shell, which then execs the command and so
+            # keeps the same pid) until the job has been recorded before
+            # executing the command.
+            (gate_read, gate_write) = os.pipe()
+            if isinstance(command, str):
+                command = ['/bin/sh', '-c', command]
+            gate = 'read gate <&%i || exit 125; exec %i<&-; exec "$@"' % (gate_read, gate_read)
+            proc = None
+            try:
+                proc = subprocess.Popen(['/bin/sh', '-c', gate, 'jm'] + list(command),
+                                        cwd=job_spec['path'], stdout=output,
+                                        stderr=output, pass_fds=(gate_read,))
+            finally:
+                os.close(gate_read)
+                if output:
+                    output.close()
+                if proc is None:
+                    os.close(gate_write)
+            job_spec['job_id'] = str(proc.pid)
+            recorded = False
+            try:
+                self.job_cache.transact(lambda job_servers: job_servers['localhost'].add(job_spec))
+                recorded = True
+            finally:
+                if not recorded:
+                    # Never run the command of a job which is not recorded.
+                    os.close(gate_write)
+                    proc.kill()
+                    proc.wait()
+            os.write(gate_write, b'\n')
+            os.close(gate_write)
+            self.running[proc.pid] = proc
+            nlaunched += 1
+        return nlaunched
+
+    def start(self, command, path, output_fname=None):
+        '''Start a job immediately without recording it in the cache.
+
+For use when the job is already in the cache (e.g. by :class:`Scheduler`).
+The caller must record the pid of the job as its job_id.  The exit status is
+recorded by :meth:`wait`.
+
+:type command: list of strings or string
+:param command: command to run.  A string is run using the shell.
+:param string path: directory in which to run the command.
+:param string output_fname: file (in path) to which standard output and
+    standard error are appended.  Not used if None.
+
+:rtype: integer
+:returns: pid of the job.
+'''
+        import subprocess
+        if output_fname:
+            output = open(os.path.join(path, output_fname), 'ab')
+        else:
+            output = None
+        try:
+            proc = subprocess.Popen(command, cwd=path, shell=isinstance(command, str),
+                                    stdout=output, stderr=output)
+        finally:
+            if output:
+                output.close()
+        self.running[proc.pid] = proc
+        return proc.pid
+
+    def wait(self, block=True):
+        '''Wait for a running job to exit and record its exit status.
+
+The status of the job is set to finished if it exited successfully and to
+failed otherwise.
+
+:param boolean block: wait until a job exits.  If false, return immediately if
+    no job has exited.
+
+:rtype: (integer, integer)
+:returns: pid and exit status of the job or None if no jobs have exited.
+'''
+        if not self.running:
+            return None
+        # Poll, rather than waiting for any child, so that only jobs launched
+        # by the executor are reaped and other child processes (e.g. see
+        # HookRunner) can be waited for separately.
+        delay = 0.001
+        while True:
+            (pid, status) = (0, 0)
+            try:
+                for running_pid in self.running:
+                    (pid, status) = os.waitpid(running_pid, os.WNOHANG)
+                    if pid:
+                        break
+            except OSError:
+                if sys.exc_info()[1].errno != errno.EINTR:
+                    raise
+                continue
+            if pid:
+                break
+            if not block:
+                # no job has exited.
+                return None
+            time.sleep(delay)
+            delay = min(2*delay, 0.05)
+        if os.WIFSIGNALED(status):
+            exit_status = -os.WTERMSIG(status)
+        else:
+            exit_status = os.WEXITSTATUS(status)
+        # Popen no longer needs to wait for the child.
+        self.running.pop(pid).returncode = exit_status
+        def record(job_servers):
+            # pids are reused: the most recent job with the pid is this one.
+            for job in reversed(job_servers['localhost'].jobs):
+                if str(job.job_id) == str(pid):
+                    if exit_status == 0:
+                        job.set_status(JobStatus.finished)
+                    else:
+                        job.set_status(JobStatus.failed)
+                    job.exit_status = exit_status
+                    job._timestamp = time.gmtime()
+                    break
+        self.job_cache.transact(record)
+        return (pid, exit_status)
+
+    def reap(self):
+        '''Record the exit status of all jobs which have exited without waiting.
+
+:rtype: list of (integer, integer) tuples
+:returns: pid and exit status of each job which has exited.
+'''
+        exited = []
+        while True:
+            result = self.wait(block=False)
+            if result is None:
+                return exited
+            exited.append(result)
+
+    def run(self):
+        '''Run all pending jobs, keeping at most max_jobs jobs running at a time.
+
+Returns once all jobs have exited.
+
+:rtype: list of (integer, integer) tuples
+:returns: pid and exit status of each job in the order in which they exited.
+'''
+        exited = []
+        self.launch()
+        while self.running:
+            exited.append(self.wait())
+            self.launch()
+        return exited
+
+### Scheduling ###
+
+class Scheduler:
+    '''Submit pending jobs on the localhost server once their dependencies finish.
+
+Jobs with a pending status are submitted once all the jobs listed in their
+depends attribute (see :class:`Job`) have finished or been analysed.  Pending
+jobs without dependencies are submitted immediately.  If a dependency fails,
+then the pending job is also marked as failed.  The job_id of a pending job
+is a placeholder (which can be used in the depends attribute of other jobs)
+and is replaced by the job id from the queueing system (or the pid) when the
+job is submitted.  The depends attribute of other jobs is updated to match.
+
+Jobs are submitted using their submit script, either to a queueing system or,
+if no queueing system is used, by running the submit script locally.
+
+The scheduler is driven by :meth:`cycle`, which is designed to be called
+regularly (e.g. by the jm.py daemon).  The set of jobs which are ready to be
+submitted, and the number of jobs counted against the limits, are updated
+incrementally using the jobs which have changed since the previous cycle (see
+:meth:`update`), rather than by inspecting every job in the cache.
+
+Submission is throttled so that the limits imposed by queueing systems on
+the number of jobs per user are not exceeded: pending jobs are only submitted
+whilst the number of queueing (or held) and running jobs on the server is
+below the given limits, submissions are spaced by at least interval seconds
+and no further jobs are submitted in a cycle once a submission fails.  Pending
+jobs are submitted in the order in which they were added.
+
+:type job_cache: :class:`JobCache`
+:param job_cache: cache containing the jobs.
+:type backend: :class:`QueueBackend`
+:param backend: queueing system to which jobs are submitted.  If None, jobs
+    are run locally using executor.
+:type executor: :class:`LocalExecutor`
+:param executor: executor used to run jobs locally.  Default: a new
+    :class:`LocalExecutor` instance.
+:type max_jobs: integer
+:param max_jobs: maximum number of queueing, held and running jobs.  Default:
+    no limit.
+:type max_queued: integer
+:param max_queued: maximum number of queueing and held jobs.  Default: no
+    limit.
+:param float interval: minimum time (in seconds) between submissions.
+
+.. attribute:: active
+
+    number of pending, held, queueing and running jobs on the localhost server
+    at the end of the previous cycle.
+
+.. attribute:: transitions
+
+    number of jobs whose status changed (including jobs which were added or
+    submitted) during the previous cycle.
+
+.. attribute:: unresolved
+
+    set of the job_ids of the dependencies which could not be found, keyed by
+    the job_id of each pending job marked as failed because of them during the
+    previous cycle.
+'''
+    def __init__(self, job_cache, backend=None, executor=None, max_jobs=None, max_queued=None, interval=0):
+        self.job_cache = job_cache
+        self.backend = backend
+        if executor is None:
+            executor = LocalExecutor(job_cache)
+        self.executor = executor
+        self.max_jobs = max_jobs
+        self.max_queued = max_queued
+        self.interval = interval
+        # time of the previous submission.
+        self._submitted = 0
+        # time of the start of the previous cycle.
+        self._since = None
+        # (job id, status) of submitted jobs not yet recorded in the cache,
+        # keyed by placeholder job_id.
+        self._unrecorded = {}
+        # status of archived jobs (or None if not archived), keyed by job_id.
+        self._archived = {}
+        self.unresolved = {}
+        self.active = 0
+        self.transitions = 0
+        self._reset()
+
+    def _reset(self):
+        '''Forget the state of all jobs, so it is rebuilt from every job.'''
+        # status of each job, keyed by job_id.
+        self._statuses = {}
+        # (job_id, number of queueing and held tasks, number of running tasks,
+        # active) of each job, keyed by handle.
+        self._jobs = {}
+        self._queued = 0
+        self._running = 0
+        self._active = 0
+        # index of each pending job in the list of jobs, keyed by job_id.
+        self._positions = {}
+        # unfinished dependencies of each pending job, keyed by job_id.
+        self._waiting = {}
+        # pending jobs which depend upon each job, keyed by job_id.
+        self._dependents = {}
+        # pending jobs whose dependencies have all finished.
+        self._ready = set()
+
+    def update(self, job_server, since=None):
+        '''Update the set of jobs ready to be submitted.
+
+Only the jobs modified since the previous update are inspected: the state of
+the other jobs (their status, the dependencies of pending jobs and the number
+of jobs counted against the limits) is kept from previous updates.  All jobs
+are inspected again if jobs have been removed from the server.
+
+Jobs whose dependencies have failed are marked as failed.  Dependencies which
+are not on the server are looked up in the archive (see
+:meth:`JobCache.archived_jobs`).  Jobs which depend upon jobs which are in
+neither are also marked as failed and recorded in :attr:`unresolved`.
+
+:type job_server: :class:`JobServer`
+:param job_server: server containing the jobs.
+:type since: integer
+:param since: only inspect jobs modified since this time (in seconds since the
+    epoch).  If None, all jobs are inspected.
+
+:rtype: set of strings
+:returns: job_ids of the pending jobs which are ready to be submitted.
+'''
+        import calendar
+        jobs = job_server.jobs
+        self.unresolved = {}
+        if since is None or len(jobs) < len(self._jobs):
+            self._reset()
+            since = None
+        failed = []
+        deps = set()
+        for (index, job) in enumerate(jobs):
+            if since is None or calendar.timegm(job.mtime()) >= since:
+                self._observe(index, job, since is not None, failed, deps)
+        if since is not None and len(jobs) != len(self._jobs):
+            # Jobs have been replaced (e.g. deleted and others merged in):
+            # start again.
+            return self.update(job_server)
+        unknown = [dep for dep in deps if dep not in self._statuses]
+        if unknown:
+            self._resolve(unknown, failed)
+        if failed:
+            # Failures propagate to all jobs which (indirectly) depend upon the
+            # failed job.
+            while failed:
+                job_id = failed.pop()
+                (index, job) = self._find(jobs, job_id)
+                if job is not None and job.status == JobStatus.pending:
+                    job.modify(dict(status=JobStatus.failed))
+                    self._observe(index, job, False, failed, deps)
+        return set(self._ready)
+
+    def _observe(self, index, job, count, failed, deps):
+        '''Update the state of a job.
+
+:param integer index: index of the job on its server.
+:param job: :class:`Job` instance.
+:param boolean count: count a change in the status of the job as a transition.
+:param list failed: job_ids of the pending jobs to be marked as failed.
+:param set deps: job_ids of the new dependencies of pending jobs.
+'''
+        done = (JobStatus.finished, JobStatus.analysed)
+        active = (JobStatus.pending, JobStatus.held, JobStatus.queueing, JobStatus.running)
+        job_id = str(job.job_id)
+        if count and self._statuses.get(job_id) != job.status:
+            self.transitions += 1
+        self._statuses[job_id] = job.status
+        # Count the job against the limits.
+        key = job.handle
+        if key is None:
+            key = ('index', index)
+        old = self._jobs.get(key)
+        if old is not None:
+            self._queued -= old[1]
+            self._running -= old[2]
+            self._active -= old[3]
+        queued = 0
+        running = 0
+        for (status, ntasks) in job.task_counts().items():
+            if status in (JobStatus.queueing, JobStatus.held):
+                queued += ntasks
+            elif status == JobStatus.running:
+                running += ntasks
+        self._jobs[key] = (job_id, queued, running, int(job.status in active))
+        self._queued += queued
+        self._running += running
+        self._active += int(job.status in active)
+        # Update the dependencies.
+        if job.status == JobStatus.pending:
+            self._positions[job_id] = index
+            if job_id not in self._waiting:
+                unmet = set()
+                for dep in (job.depends or '').split():
+                    status = self._statuses.get(dep)
+                    if status == JobStatus.failed:
+                        failed.append(job_id)
+                    elif status not in done:
+                        unmet.add(dep)
+                        self._dependents.setdefault(dep, set()).add(job_id)
+                        deps.add(dep)
+                self._waiting[job_id] = unmet
+                if not unmet:
+                    self._ready.add(job_id)
+        elif job_id in self._waiting or job_id in self._positions:
+            # no longer pending (e.g. modified by the user).
+            self._forget(job_id)
+        self._finish(job_id, job.status, failed)
+
+    def _finish(self, job_id, status, failed):
+        '''Release (or fail) the jobs which depend upon a job which has finished (or failed).'''
+        if status in (JobStatus.finished, JobStatus.analysed):
+            for dependent in self._dependents.pop(job_id, ()):
+                if dependent in self._waiting:
+                    self._waiting[dependent].discard(job_id)
+                    if not self._waiting[dependent]:
+                        self._ready.add(dependent)
+        elif status == JobStatus.failed:
+            failed.extend(self._dependents.pop(job_id, ()))
+
+    def _resolve(self, deps, failed):
+        '''Resolve dependencies which are not on the server using the archive.
+
+:param list deps: job_ids of the dependencies.
+:param list failed: job_ids of the pending jobs to be marked as failed.
+'''
+        missing = set(dep for dep in deps if dep not in self._archived)
+        if missing:
+            # Read the archive once for all dependencies.
+            for dep in missing:
+                self._archived[dep] = None
+            for (host, index, job_spec) in self.job_cache.archived_jobs(['localhost']):
+                if str(job_spec['job_id']) in missing:
+                    self._archived[str(job_spec['job_id'])] = job_spec['status']
+        for dep in deps:
+            status = self._archived[dep]
+            if status is None:
+                for dependent in self._dependents.pop(dep, ()):
+                    self.unresolved.setdefault(dependent, set()).add(dep)
+                    failed.append(dependent)
+            else:
+                self._statuses[dep] = status
+                self._finish(dep, status, failed)
+
+    def _find(self, jobs, job_id):
+        '''Find a pending job by its job_id.
+
+:rtype: (integer, :class:`Job`)
+:returns: index and job of the most recent job with the job_id, or (None,
+    None) if there is none.
+'''
+        index = self._positions.get(job_id)
+        if index is not None and index < len(jobs) and str(jobs[index].job_id) == job_id:
+            return (index, jobs[index])
+        # The jobs have changed since they were indexed.
+        for index in range(len(jobs)-1, -1, -1):
+            if str(jobs[index].job_id) == job_id:
+                return (index, jobs[index])
+        return (None, None)
+
+    def _forget(self, job_id):
+        '''Remove a pending job from the set of jobs waiting to be submitted.'''
+        for dep in self._waiting.pop(job_id, ()):
+            self._dependents.get(dep, set()).discard(job_id)
+        self._ready.discard(job_id)
+        self._positions.pop(job_id, None)
+
+    def slots(self):
+        '''Find the number of jobs which can be submitted without exceeding the limits.
+
+The queueing, held and running jobs are counted as of the previous
+:meth:`update`.
+
+:rtype: integer
+:returns: number of jobs which can be submitted or None if there is no limit.
+'''
+        slots = None
+        for (limit, count) in ((self.max_jobs, self._queued+self._running), (self.max_queued, self._queued)):
+            if limit is not None and (slots is None or limit - count < slots):
+                slots = max(limit - count, 0)
+        return slots
+
+    def submit(self, job_spec):
+        '''Submit a job.
+
+:type job_spec: dictionary
+:param job_spec: description of the job.  See :meth:`Job.job_spec`.
+
+:rtype: (string, string)
+:returns: job id and status of the submitted job.
+'''
+        if not job_spec['submit']:
+            raise UserError('Job %s has no submit script.' % (job_spec['job_id']))
+        delay = self._submitted + self.interval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self._submitted = time.time()
+        if self.backend:
+            return (self.backend.submit(job_spec['submit'], job_spec['path']), JobStatus.queueing)
+        else:
+            pid = self.executor.start(['/bin/sh', job_spec['submit']], job_spec['path'], job_spec['output_fname'])
+            return (str(pid), JobStatus.running)
+
+    def record(self, job_server, submitted):
+        '''Record the job ids of submitted jobs.
+
+Only the jobs are changed, so the jobs can be recorded again (e.g. in a new
+snapshot if a transaction conflicts).  The state of the scheduler is updated
+by :meth:`recorded` once the jobs have been saved.
+
+:type job_server: :class:`JobServer`
+:param job_server: server containing the jobs.
+:type submitted: dictionary
+:param submitted: (job id, status) of each submitted job (see
+    :meth:`submit`), keyed by the placeholder job_id of the job.
+'''
+        jobs = job_server.jobs
+        for (old_id, (new_id, status)) in submitted.items():
+            (index, job) = self._find(jobs, old_id)
+            if job is not None and job.status == JobStatus.pending:
+                job.modify(dict(job_id=new_id, status=status))
+            # Only pending jobs can be waiting for the submitted job.
+            for dependent in self._dependents.get(old_id, ()):
+                (index, job) = self._find(jobs, dependent)
+                if job is not None and job.depends:
+                    depends = [submitted.get(dep, (dep,))[0] for dep in job.depends.split()]
+                    if depends != job.depends.split():
+                        job.depends = ' '.join(depends)
+                        job._changed()
+
+    def recorded(self, submitted):
+        '''Update the state of the scheduler once submitted jobs have been recorded.
+
+See :meth:`record` for the arguments.
+'''
+        for (old_id, (new_id, status)) in submitted.items():
+            self._forget(old_id)
+            self._statuses.pop(old_id, None)
+            self._statuses[new_id] = status
+            if old_id in self._dependents:
+                self._dependents[new_id] = self._dependents.pop(old_id)
+                for dependent in self._dependents[new_id]:
+                    if dependent in self._waiting:
+                        self._waiting[dependent].discard(old_id)
+                        self._waiting[dependent].add(new_id)
+
+    def cycle(self, auto_update=True, snapshot=None, max_attempts=3000):
+        '''Update the jobs and submit the jobs which are ready.
+
+The exit status of jobs run locally by the scheduler is recorded, the jobs on
+the localhost server are (optionally) auto-updated and the set of jobs ready to
+be submitted is updated in one transaction.  The ready jobs are then submitted
+(subject to the limits on the number of jobs) without holding the lock and
+their job ids recorded in a second transaction.  Jobs which were not submitted
+remain pending and are retried in the next cycle.  Jobs which were submitted
+but could not be recorded (e.g. as the cache was locked) are recorded in the
+first transaction of the next cycle and are never submitted again.
+
+If a transaction is retried or fails, the state of the scheduler is rebuilt
+from all jobs, so the jobs are updated in the same way in every attempt.
+
+:param boolean auto_update: update the status of jobs using
+    :meth:`JobServer.auto_update`.
+:type snapshot: :class:`QueueSnapshot`
+:param snapshot: status of all jobs of the current user used to update the
+    jobs (e.g. shared by the schedulers of several caches).  If None, the
+    queueing systems are queried.
+:param integer max_attempts: number of attempts to acquire the lock in each
+    transaction.  If 1, :class:`LockException` is raised at once if the cache
+    is locked by another process.
+
+:rtype: list of strings
+:returns: job ids of the submitted jobs.
+'''
+        self.executor.reap()
+        start = time.time()
+        since = self._since
+        # Rebuild the state from all jobs in the next cycle unless the
+        # transaction is committed.
+        self._since = None
+        attempts = []
+        def update(job_servers):
+            self.transitions = 0
+            if auto_update:
+                job_servers['localhost'].auto_update(snapshot)
+            jobs = job_servers['localhost'].jobs
+            if attempts:
+                # The previous attempt changed the state using another
+                # snapshot.
+                ready = self.update(job_servers['localhost'])
+            else:
+                ready = self.update(job_servers['localhost'], since)
+            attempts.append(True)
+            if self._unrecorded:
+                self.record(job_servers['localhost'], self._unrecorded)
+                self.recorded(self._unrecorded)
+                # Count the recorded jobs against the limits.
+                for (job_id, status) in self._unrecorded.values():
+                    (index, job) = self._find(jobs, job_id)
+                    if job is not None:
+                        self._observe(index, job, False, [], set())
+                ready = set(self._ready)
+            self.active = self._active
+            # Submit in the order in which the jobs were added.
+            ready = [jobs[self._positions[job_id]].job_spec() for job_id in sorted(ready, key=self._positions.get)]
+            slots = self.slots()
+            if slots is not None:
+                ready = ready[:slots]
+            return ready
+        ready = self.job_cache.transact(update, max_attempts=max_attempts)
+        self._unrecorded.clear()
+        # Times are only recorded to the second: include jobs modified in the
+        # same second as the start of this cycle in the next cycle.
+        self._since = int(start)
+        submitted = {}
+        for job_spec in ready:
+            try:
+                submitted[str(job_spec['job_id'])] = self.submit(job_spec)
+            except UserError:
+                # The queueing system might be refusing further jobs: try
+                # again next cycle.
+                break
+            # Never submit the job again, even if it cannot be recorded.
+            self._unrecorded[str(job_spec['job_id'])] = submitted[str(job_spec['job_id'])]
+        if submitted:
+            self.job_cache.transact(lambda job_servers: self.record(job_servers['localhost'], submitted), max_attempts=max_attempts)
+            self._unrecorded.clear()
+            self.recorded(submitted)
+            self.transitions += len(submitted)
+        return [job_id for (job_id, status) in submitted.values()]
+
+
+class PollInterval:
+    '''Adapt the time between cycles of a daemon to the activity of the jobs.
+
+The interval starts at base and is:
+
+* set to min_interval if the cache was changed by another process (e.g. new
+  jobs were added);
+* halved (down to min_interval) whilst jobs change status;
+* returned to base whilst there are active jobs but no jobs change status;
+* doubled (up to max_interval) whilst there are no active jobs.
+
+Hence an idle daemon rarely inspects the cache or queries the queueing system,
+whilst workflows of short jobs are advanced promptly.
+
+:param float min_interval: minimum time (in seconds) between cycles.
+:param float max_interval: maximum time (in seconds) between cycles.
+:param float base: time (in seconds) between cycles whilst jobs are active but
+    not changing status.  Limited to lie between min_interval and
+    max_interval.
+:param float factor: factor by which the interval is shortened or lengthened.
+'''
+    def __init__(self, min_interval=5, max_interval=600, base=60, factor=2):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.base = min(max(base, min_interval), max_interval)
+        self.factor = factor
+        self.interval = self.base
+
+    def update(self, active, transitions, changed=False):
+        '''Update the interval using the result of the previous cycle.
+
+:param integer active: number of active (e.g. pending, queueing or running)
+    jobs.
+:param integer transitions: number of jobs which changed status.
+:param boolean changed: true if the cache was modified by another process.
+
+:rtype: float
+:returns: time (in seconds) until the next cycle.
+'''
+        if changed:
+            self.interval = self.min_interval
+        elif transitions:
+            self.interval = max(self.min_interval, min(self.interval, self.base)/float(self.factor))
+        elif active:
+            if self.interval < self.base:
+                self.interval = min(self.base, self.interval*self.factor)
+            else:
+                self.interval = self.base
+        else:
+            self.interval = min(self.max_interval, max(self.interval, self.base)*self.factor)
+        return self.interval
+
+### Completion hooks ###
+
+class HookRunner:
+    '''Run the completion hooks of finished jobs on the localhost server.
+
+When a job finishes, the hook registered for its program (see
+:func:`register_completion_hook`) is run.  If the hook exits successfully, the
+status of the job is set to analysed.  The exit status of the hook, the time
+it took and the end of its output are recorded in the hook_status, hook_time
+and hook_output attributes of the job.  A hook is run only once for each job
+(unless the hook_status of the job is reset).
+
+Hooks are run in the background, at most max_hooks at once, so slow hooks do
+not delay updating the jobs.  The runner is driven by :meth:`cycle`, which is
+designed to be called regularly (e.g. by the jm.py daemon) and never waits for
+a hook to finish.
+
+:type job_cache: :class:`JobCache`
+:param job_cache: cache containing the jobs.  Jobs are updated using
+    transactions (see :meth:`JobCache.transaction`), so the lock is not held
+    whilst hooks run.
+:param integer max_hooks: maximum number of hooks to run simultaneously.
+    Default: number of processors available.
+:param integer output_size: number of bytes at the end of the output of a
+    hook which are recorded.
+
+.. attribute:: running
+
+    dictionary of (subprocess.Popen instance, output file, start time) of
+    each running hook, keyed by the (job_id, path) of the job.
+'''
+    def __init__(self, job_cache, max_hooks=None, output_size=1024):
+        import multiprocessing
+        self.job_cache = job_cache
+        if max_hooks is None:
+            try:
+                max_hooks = len(os.sched_getaffinity(0))
+            except AttributeError:
+                max_hooks = multiprocessing.cpu_count()
+        self.max_hooks = max_hooks
+        self.output_size = output_size
+        self.running = {}
+        # (exit status, time, output) of finished hooks not yet recorded in
+        # the cache, keyed by (job_id, path).
+        self._finished = {}
+
+    def start(self, job_spec):
+        '''Start the completion hook of a job.
+
+:type job_spec: dictionary
+:param job_spec: description of the job.  See :meth:`Job.job_spec`.
+'''
+        import subprocess
+        import tempfile
+        env = dict(os.environ)
+        for attr in ['job_id', 'program', 'path', 'input_fname', 'output_fname']:
+            env['JM_%s' % (attr.upper())] = str(job_spec[attr] or '')
+        output = tempfile.TemporaryFile()
+        devnull = open(os.devnull)
+        try:
+            proc = subprocess.Popen(completion_hooks[job_spec['program']], shell=True, cwd=job_spec['path'], env=env,
+                                    stdin=devnull, stdout=output, stderr=subprocess.STDOUT)
+        except OSError:
+            # e.g. the directory of the job no longer exists.
+            output.close()
+            self._finished[(str(job_spec['job_id']), job_spec['path'])] = (127, 0.0, str(sys.exc_info()[1]))
+            return
+        finally:
+            devnull.close()
+        self.running[(str(job_spec['job_id']), job_spec['path'])] = (proc, output, time.time())
+
+    def poll(self):
+        '''Collect the results of hooks which have finished without waiting.
+
+:rtype: integer
+:returns: number of hooks which have finished.
+'''
+        finished = 0
+        for (key, (proc, output, start)) in list(self.running.items()):
+            if proc.poll() is not None:
+                output.seek(max(output.tell() - self.output_size, 0))
+                text = output.read().decode('utf-8', 'replace').strip()
+                output.close()
+                self._finished[key] = (proc.returncode, round(time.time() - start, 2), text)
+                self.running.pop(key)
+                finished += 1
+        return finished
+
+    def cycle(self, max_attempts=3000):
+        '''Record the results of finished hooks and start hooks of finished jobs.
+
+Both are done in a single transaction.  Results which cannot be recorded (e.g.
+as the cache is locked) are recorded in the next cycle.  If no hooks have
+finished and none are registered, the cache is not read.
+
+:param integer max_attempts: number of attempts to acquire the lock.
+
+:rtype: list of strings
+:returns: job_ids of the jobs whose hooks were started.
+'''
+        self.poll()
+        finished = dict(self._finished)
+        if not finished and not completion_hooks:
+            return []
+        slots = self.max_hooks - len(self.running)
+        def update(job_servers):
+            start = []
+            for job in job_servers['localhost'].jobs:
+                key = (str(job.job_id), job.path)
+                if key in finished:
+                    (job.hook_status, job.hook_time, job.hook_output) = finished[key]
+                    job._changed()
+                    if job.hook_status == 0 and job.status == JobStatus.finished:
+                        job.set_status(JobStatus.analysed)
+                    job._timestamp = time.gmtime()
+                elif len(start) < slots and job.status == JobStatus.finished and \
+                     job.hook_status is None and job.program in completion_hooks and \
+                     key not in self.running and key not in self._finished:
+                    start.append(job.job_spec())
+            return start
+        start = self.job_cache.transact(update, max_attempts=max_attempts)
+        for key in finished:
+            self._finished.pop(key, None)
+        for job_spec in start:
+            self.start(job_spec)
+        return [job_spec['job_id'] for job_spec in start]
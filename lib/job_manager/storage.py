@@ -0,0 +1,770 @@
+'''Storage layers of job caches.
+
+The classes and functions used to store jobs compactly in the cache file
+(:class:`JobTable`), to search them without inspecting every job
+(:class:`TextIndex` and :class:`PathIndex`) and to read them without
+unpickling the cache (:class:`MappedCache`).  All are also available from
+:mod:`job_manager`.
+'''
+
+import array
+import bisect
+import copy
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+
+from job_manager import (Job, UserError, _cache_version, _format_jobs, _format_tasks, _numpy,
+                         _parse_tasks, _task_specs)
+
+### Indices ###
+
+def _trigrams(text):
+    '''Find the set of substrings of length 3 of a string.'''
+    return set(text[i:i+3] for i in range(len(text)-2))
+
+def _regex_end(pattern, start):
+    '''Find the end of a group or character class in a regular expression.
+
+:param string pattern: regular expression.
+:param integer start: position of the opening parenthesis or bracket.
+
+:rtype: integer
+:returns: position of the closing parenthesis or bracket.
+'''
+    i = start + 1
+    if pattern[start] == '[':
+        # ] is a literal character at the start of a character class.
+        if pattern[i:i+1] == '^':
+            i += 1
+        if pattern[i:i+1] == ']':
+            i += 1
+        while i < len(pattern) and pattern[i] != ']':
+            if pattern[i] == '\\':
+                i += 1
+            i += 1
+    else:
+        depth = 1
+        while i < len(pattern):
+            if pattern[i] == '\\':
+                i += 1
+            elif pattern[i] == '[':
+                i = _regex_end(pattern, i)
+            elif pattern[i] == '(':
+                depth += 1
+            elif pattern[i] == ')':
+                depth -= 1
+                if depth == 0:
+                    break
+            i += 1
+    return i
+
+def _regex_literals(pattern):
+    '''Find strings which every match of a regular expression contains.
+
+Only runs of literal characters outside groups and character classes are
+considered, which is sufficient for the patterns usually used to search for
+jobs (e.g. parts of paths).
+
+:param string pattern: regular expression.
+
+:rtype: list of strings
+:returns: literal strings which any match of the pattern must contain.  Empty
+    if there are none (e.g. if the pattern contains an alternation) or if the
+    pattern sets flags, which can make the literals case-insensitive.
+'''
+    if re.search(r'\(\?[aiLmsux-]', pattern):
+        return []
+    literals = []
+    current = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            escaped = pattern[i+1:i+2]
+            i += 2
+            if escaped and not escaped.isalnum():
+                current.append(escaped)
+            else:
+                # Character class (e.g. \d), assertion, back reference or
+                # special character (e.g. \n).
+                literals.append(''.join(current))
+                current = []
+            continue
+        quantifier = re.match(r'[*?]|{\d*,?\d*}', pattern[i:])
+        if quantifier:
+            # The preceding character is optional.
+            if current:
+                current.pop()
+            literals.append(''.join(current))
+            current = []
+            i += len(quantifier.group()) - 1
+        elif char == '+':
+            literals.append(''.join(current))
+            current = []
+        elif char == '|':
+            # Alternatives need not contain any of the literals.
+            return []
+        elif char in '([':
+            literals.append(''.join(current))
+            current = []
+            i = _regex_end(pattern, i)
+        elif char in '.^$':
+            literals.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+        i += 1
+    literals.append(''.join(current))
+    return [literal for literal in literals if literal]
+
+class TextIndex:
+    '''Trigram index of the text of jobs.
+
+Jobs are searched (see :meth:`Job.match`) by testing each value in the job
+spec.  The index maps each substring of length 3 (a trigram) to the values
+containing it, so that only jobs with a value containing every trigram of the
+literal parts of a pattern need to be tested.
+
+The values of each indexed job are stored in the job (in its _text attribute),
+which is reset by the methods which change the job spec (e.g.
+:meth:`Job.modify` and :meth:`Job.set_status`).  A job whose attributes are
+instead set directly is still found by its old values until it is next changed
+using one of these methods.  Values which are
+no longer used by any job are only removed when the index is rebuilt, which
+happens automatically once the index contains many such values.
+
+.. attribute:: trigrams
+
+    dictionary of the set of indexed values containing each trigram.
+
+.. attribute:: values
+
+    set of indexed values.
+'''
+    def __init__(self):
+        self.trigrams = {}
+        self.values = set()
+        self._live = 0
+
+    def add(self, job):
+        '''Add a job to the index.
+
+:param job: :class:`Job` instance.
+
+:rtype: tuple of strings
+:returns: the values of the job spec of the job, as tested by :meth:`Job.match`.
+'''
+        text = tuple(str(val) for val in job.job_spec().values())
+        for val in text:
+            if val not in self.values:
+                self.values.add(val)
+                for trigram in _trigrams(val):
+                    self.trigrams.setdefault(trigram, set()).add(val)
+        job._text = text
+        return text
+
+    def build(self, jobs):
+        '''Rebuild the index.
+
+:param jobs: list of :class:`Job` instances.
+'''
+        self.trigrams = {}
+        self.values = set()
+        for job in jobs:
+            self.add(job)
+        self._live = len(self.values)
+
+    def stale(self):
+        '''Test whether the index contains many values which are no longer used.
+
+:rtype: boolean
+'''
+        return len(self.values) > 2*self._live + 1024
+
+    def candidates(self, pattern):
+        '''Find the values which might match a regular expression.
+
+:param string pattern: regular expression.
+
+:rtype: set of strings
+:returns: indexed values which contain every trigram of the literal parts of
+    the pattern (see :func:`_regex_literals`), or None if the pattern has no
+    literal part of at least 3 characters.
+'''
+        trigrams = set()
+        for literal in _regex_literals(pattern):
+            trigrams.update(_trigrams(literal))
+        if not trigrams:
+            return None
+        # Intersect the smallest sets first.
+        postings = sorted((self.trigrams.get(trigram, ()) for trigram in trigrams), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(posting)
+        return candidates
+
+def _path_key(path):
+    '''Normalise a path for comparison by :class:`PathIndex`.
+
+:rtype: string
+:returns: normalised path, which ends in a single /.
+'''
+    return os.path.normpath(os.path.expanduser(str(path))).rstrip('/') + '/'
+
+class PathIndex:
+    '''Index of jobs by directory.
+
+The distinct (normalised) paths of the jobs are kept sorted, so the jobs in a
+directory tree are found using binary search in time proportional to the
+number of jobs found rather than to the number of jobs indexed.
+
+The index is only kept in memory.  Jobs appended to the list of jobs are
+indexed by :meth:`update`.  The index must be rebuilt if jobs are removed from
+the list or the path of any job is changed: :class:`JobServer` discards its
+index whenever it does either.
+
+:param jobs: list of :class:`Job` instances.
+
+.. attribute:: paths
+
+    sorted list of the distinct normalised paths of the jobs, each ending in /.
+
+.. attribute:: positions
+
+    dictionary of the list of indices in jobs of the jobs with each normalised
+    path.
+'''
+    def __init__(self, jobs):
+        self.paths = []
+        self.positions = {}
+        self._jobs = jobs
+        self._size = 0
+        self.update(jobs)
+
+    def update(self, jobs):
+        '''Index the jobs appended to the list of jobs since it was last indexed.
+
+:param jobs: list of :class:`Job` instances.
+
+:rtype: boolean
+:returns: False if the index cannot be updated, and must instead be rebuilt,
+    because jobs is not the list indexed or jobs have been removed from it.
+'''
+        if jobs is not self._jobs or len(jobs) < self._size:
+            return False
+        new_paths = []
+        for index in range(self._size, len(jobs)):
+            key = _path_key(jobs[index].path)
+            if key not in self.positions:
+                self.positions[key] = []
+                new_paths.append(key)
+            self.positions[key].append(index)
+        # Sort once rather than inserting many paths one at a time.
+        if len(new_paths) > 64:
+            self.paths = sorted(self.paths + new_paths)
+        else:
+            for key in new_paths:
+                bisect.insort(self.paths, key)
+        self._size = len(jobs)
+        return True
+
+    def under(self, directory):
+        '''Find the jobs in a directory tree.
+
+:param string directory: directory.  Paths are compared once normalised (see
+    os.path.normpath), so e.g. trailing slashes are ignored, but are not made
+    absolute.
+
+:rtype: list of integers
+:returns: indices of the jobs whose path is the directory or is inside it, in
+    order.
+'''
+        prefix = _path_key(directory)
+        start = bisect.bisect_left(self.paths, prefix)
+        # '0' follows '/': all paths from prefix up to (but not including)
+        # prefix with the trailing '/' replaced by '0' start with prefix.
+        end = bisect.bisect_left(self.paths, prefix[:-1] + '0', start)
+        found = []
+        for key in self.paths[start:end]:
+            found.extend(self.positions[key])
+        return sorted(found)
+
+### Columnar storage ###
+
+class JobTable:
+    '''Columnar store of jobs.
+
+Each field of the job spec (see :meth:`Job.job_spec`) is dictionary-encoded:
+the distinct values of the field are stored once in :attr:`values` and each
+job is stored as a row of integer codes, one array per field.  The status is
+stored in an array of bytes, the modification time in an array of doubles and
+the status transitions of all jobs in flat arrays.  Any other state of a job
+(e.g. its resource samples or the tasks of a job array) is stored separately
+for the jobs which have it.  Millions of jobs hence take far less memory, and
+are read from the cache file far more quickly, than as :class:`Job` instances.
+
+Jobs are searched column-wise (using numpy, if available), with each distinct
+value tested only once, and :class:`Job` instances are only created for the
+jobs requested (see :meth:`job`).
+
+:param jobs: iterable of :class:`Job` instances.  Not an attribute.
+
+.. attribute:: values
+
+    dictionary of the list of distinct values of each field in
+    :attr:`fields`.
+
+.. attribute:: codes
+
+    dictionary of the array of codes (i.e. indices into :attr:`values`) of
+    each field, with one element per job.
+'''
+    fields = ('job_id', 'program', 'path', 'input_fname', 'output_fname', 'status', 'submit', 'comment',
+              'depends', 'exit_status', 'hook_status', 'hook_time', 'hook_output')
+    # Tables in old caches store handles with the other attributes.
+    _handles = None
+
+    def __init__(self, jobs=()):
+        self.values = dict((field, []) for field in self.fields)
+        self.codes = dict((field, array.array('i')) for field in self.fields)
+        # Few distinct statuses: one byte each until there are too many.
+        self.codes['status'] = array.array('B')
+        self._mtimes = array.array('d')
+        # The transitions of job i are elements _transition_ends[i-1] to
+        # _transition_ends[i] of the transition arrays.
+        self._transition_ends = array.array('l')
+        self._transition_statuses = array.array('i')
+        self._transition_times = array.array('d')
+        # Handle of each job, or 0 if it has none.
+        self._handles = array.array('l')
+        # Remaining attributes of each job which has any, keyed by row.
+        self._extras = {}
+        self._lookup = None
+        for job in jobs:
+            self.append(job)
+
+    def __len__(self):
+        return len(self._mtimes)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_lookup'] = None
+        return state
+
+    def _code(self, field, val):
+        '''Find (or assign) the code of a value of a field.'''
+        if self._lookup is None:
+            self._lookup = dict((name, dict(((val.__class__, val), code) for (code, val) in enumerate(vals)))
+                                for (name, vals) in self.values.items())
+        # Distinguish e.g. 1 and '1'.
+        key = (val.__class__, val)
+        lookup = self._lookup[field]
+        if key not in lookup:
+            lookup[key] = len(self.values[field])
+            self.values[field].append(val)
+            if lookup[key] > 255 and self.codes[field].typecode == 'B':
+                self.codes[field] = array.array('i', self.codes[field])
+        return lookup[key]
+
+    def append(self, job):
+        '''Add a job.
+
+:param job: :class:`Job` instance.
+'''
+        attrs = dict(job.__dict__)
+        for field in self.fields:
+            self.codes[field].append(self._code(field, attrs.pop(field, None)))
+        import calendar
+        self._mtimes.append(calendar.timegm(attrs.pop('_timestamp')))
+        for (status, transition_time) in attrs.pop('transitions', ()):
+            self._transition_statuses.append(self._code('status', status))
+            self._transition_times.append(transition_time)
+        self._transition_ends.append(len(self._transition_times))
+        if self._handles is None:
+            self._handles = array.array('l', [0]*(len(self)-1))
+        self._handles.append(attrs.pop('handle', None) or 0)
+        # Not stored: see TextIndex and Transaction.
+        attrs.pop('_text', None)
+        attrs.pop('_tx_key', None)
+        if job.__class__ is not Job:
+            attrs['__class__'] = job.__class__
+        if attrs:
+            self._extras[len(self)-1] = attrs
+
+    def job(self, row):
+        '''Create the job stored in a row.
+
+:param integer row: index of the job.
+
+:rtype: :class:`Job`
+:returns: a new instance, which is not changed by (and does not change) the
+    jobs in the table.
+'''
+        extras = self._extras.get(row)
+        if extras:
+            extras = copy.deepcopy(extras)
+        return self._job(row, extras or ())
+
+    def _job(self, row, attrs):
+        '''Create the job stored in a row with the given extra attributes.'''
+        attrs = dict(attrs)
+        cls = attrs.pop('__class__', Job)
+        job = cls.__new__(cls)
+        for field in self.fields:
+            attrs[field] = self.values[field][self.codes[field][row]]
+        attrs['_timestamp'] = time.gmtime(self._mtimes[row])
+        if self._handles is not None and self._handles[row]:
+            attrs['handle'] = self._handles[row]
+        if row == 0:
+            start = 0
+        else:
+            start = self._transition_ends[row-1]
+        statuses = self.values['status']
+        attrs['transitions'] = tuple((statuses[self._transition_statuses[i]], int(self._transition_times[i]))
+                                     for i in range(start, self._transition_ends[row]))
+        job.__dict__.update(attrs)
+        return job
+
+    def jobs(self):
+        '''Create all the jobs.
+
+Unlike :meth:`job`, the jobs share mutable attributes (e.g. the tasks of job
+arrays) with the table, which should no longer be used.
+
+:rtype: list of :class:`Job` instances
+'''
+        return [self._job(row, self._extras.get(row, ())) for row in range(len(self))]
+
+    def search(self, pattern):
+        '''Find the jobs which match the supplied pattern.
+
+:param string pattern: regular expression.  Jobs are tested as in
+    :meth:`Job.match`.  If pattern is None then all jobs are returned.
+
+:rtype: list of integers
+:returns: rows of the jobs which match the pattern, in order.
+'''
+        if not pattern or not len(self):
+            return list(range(len(self)))
+        search = re.compile(pattern).search
+        numpy = _numpy()
+        if numpy is not None:
+            found = numpy.zeros(len(self), dtype=bool)
+        else:
+            found = set()
+        for field in self.fields:
+            matched = [code for (code, val) in enumerate(self.values[field]) if search(str(val))]
+            if not matched:
+                continue
+            column = self.codes[field]
+            if numpy is not None:
+                found |= numpy.isin(numpy.frombuffer(column, dtype=column.typecode), matched)
+            else:
+                matched = set(matched)
+                found.update(row for (row, code) in enumerate(column) if code in matched)
+        # The job spec of a job array also contains its tasks.
+        for (row, attrs) in self._extras.items():
+            if 'tasks' in attrs and search(_format_tasks(attrs['tasks'])):
+                if numpy is not None:
+                    found[row] = True
+                else:
+                    found.add(row)
+        if numpy is not None:
+            return numpy.flatnonzero(found).tolist()
+        else:
+            return sorted(found)
+
+    def under(self, directory):
+        '''Find the jobs in a directory tree.
+
+Each distinct path is tested once.  See :meth:`PathIndex.under`.
+
+:param string directory: directory.
+
+:rtype: list of integers
+:returns: rows of the jobs whose path is the directory or is inside it, in
+    order.
+'''
+        prefix = _path_key(directory)
+        matched = [code for (code, val) in enumerate(self.values['path']) if _path_key(val).startswith(prefix)]
+        if not matched:
+            return []
+        column = self.codes['path']
+        numpy = _numpy()
+        if numpy is not None:
+            return numpy.flatnonzero(numpy.isin(numpy.frombuffer(column, dtype=column.typecode), matched)).tolist()
+        else:
+            matched = set(matched)
+            return [row for (row, code) in enumerate(column) if code in matched]
+
+### Mapped cache files ###
+
+# Start of the header line of mapped cache files (see _dump_mapped).
+_MAPPED_MAGIC = b'#job_manager mapped cache 1 '
+
+# Heap offset of a field not present in the job spec of a job.
+_MAPPED_ABSENT = 0xffffffff
+
+def _dump_mapped(cache, job_servers, enable):
+    '''Write (or remove) the mapped cache file, cache.map.
+
+The mapped cache file is a read-only copy of the jobs in a fixed layout which
+can be read using mmap (see :class:`MappedCache`) without unpickling the jobs.
+It consists of a header line containing the JSON-encoded layout of the file
+and the version of the cache file (see :func:`_cache_version`) it was written
+with, followed (at the next multiple of 8 bytes) by the rows of each server and
+then the heap.  Each row contains a little-endian 32-bit offset into the heap
+for each field of the job spec and the handle of a job (or 0xffffffff if it has no
+such field).  The heap contains each distinct value once, as a 32-bit length
+followed by the JSON-encoded value.
+
+:param string cache: path to the cache file, which has just been written.
+:type job_servers: dictionary
+:param job_servers: :class:`JobServer` instances keyed by hostname.
+:param boolean enable: write the mapped cache file.  If False, the mapped cache
+    file is removed.  If None, it is only written if it already exists.
+'''
+    mapped = '%s.map' % (cache)
+    if enable is None:
+        enable = os.path.exists(mapped)
+    if not enable:
+        if os.path.exists(mapped):
+            os.remove(mapped)
+        return
+    fields = JobTable.fields + ('tasks', 'handle')
+    heap = bytearray()
+    offsets = {}
+    servers = []
+    rows = array.array('I')
+    for host in sorted(job_servers):
+        start = len(rows)
+        for (index, job) in job_servers[host].view():
+            job_spec = job.job_spec()
+            if job.handle is not None:
+                job_spec['handle'] = job.handle
+            for field in fields:
+                if field not in job_spec:
+                    rows.append(_MAPPED_ABSENT)
+                    continue
+                val = job_spec[field]
+                # Distinguish e.g. 1 and '1'.
+                key = (val.__class__, val)
+                if key not in offsets:
+                    data = json.dumps(val, default=str).encode('utf-8')
+                    if len(heap) >= _MAPPED_ABSENT:
+                        raise UserError('Too much data for a mapped cache file: %s.' % (mapped))
+                    offsets[key] = len(heap)
+                    heap.extend(struct.pack('<I', len(data)))
+                    heap.extend(data)
+                rows.append(offsets[key])
+        servers.append((host, (len(rows)-start)//len(fields), start*rows.itemsize))
+    if sys.byteorder == 'big':
+        rows.byteswap()
+    layout = dict(version=_cache_version(os.stat(cache)), fields=fields, servers=servers,
+                  heap=len(rows)*rows.itemsize, size=len(heap))
+    header = _MAPPED_MAGIC + json.dumps(layout).encode('ascii') + b'\n'
+    header += b' '*(-len(header) % 8)
+    tmp_mapped = '%s.%i.tmp' % (mapped, os.getpid())
+    mapped_f = open(tmp_mapped, 'wb')
+    try:
+        mapped_f.write(header)
+        rows.tofile(mapped_f)
+        mapped_f.write(heap)
+    finally:
+        mapped_f.close()
+    os.rename(tmp_mapped, mapped)
+
+class MappedCache:
+    '''Read-only view of the jobs in a mapped cache file.
+
+A mapped cache file is a copy of the jobs in a cache written in a fixed layout
+(see :func:`_dump_mapped` and the mapped parameter of :class:`JobCache`).  The
+file is read using mmap: only the rows of the jobs found and the fields
+requested are decoded, so listing jobs takes time (and memory) proportional to
+the number of jobs listed rather than to the size of the cache.  Each distinct
+value is decoded only once.
+
+:param string path: path to the mapped cache file.
+
+.. attribute:: version
+
+    version of the cache file (see :meth:`JobCache.version`) which the mapped
+    cache file copies.
+
+.. attribute:: fields
+
+    tuple of the fields of the job specs stored.
+
+.. attribute:: servers
+
+    list of (hostname, number of jobs, offset of the rows) of each server.
+'''
+    def __init__(self, path):
+        self.path = path
+        mapped_f = open(path, 'rb')
+        try:
+            header = mapped_f.readline()
+            if not header.startswith(_MAPPED_MAGIC):
+                raise UserError('Not a mapped cache file: %s.' % (path))
+            layout = json.loads(header[len(_MAPPED_MAGIC):].decode('ascii'))
+            self._map = mmap.mmap(mapped_f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            mapped_f.close()
+        # The rows start at the next multiple of 8 bytes after the header.
+        start = len(header) + (-len(header) % 8)
+        self.version = tuple(layout['version'])
+        self.fields = tuple(layout['fields'])
+        self.servers = [(host, nrows, start+offset) for (host, nrows, offset) in layout['servers']]
+        self._heap = start + layout['heap']
+        self._heap_size = layout['size']
+        self._values = {}
+
+    def close(self):
+        '''Unmap the mapped cache file.'''
+        self._map.close()
+
+    def _decode(self, offset):
+        '''Decode the value at an offset in the heap.'''
+        start = self._heap + offset
+        size = struct.unpack_from('<I', self._map, start)[0]
+        data = self._map[start+4:start+4+size]
+        if data[:1] == b'"' and b'\\' not in data:
+            # A string without escapes: no need to parse it.
+            return data[1:-1].decode('utf-8')
+        return json.loads(data.decode('utf-8'))
+
+    def _value(self, offset):
+        '''Decode the value at an offset in the heap, decoding each value once.'''
+        if offset not in self._values:
+            self._values[offset] = self._decode(offset)
+        return self._values[offset]
+
+    def _rows(self, nrows, start):
+        '''Read the heap offsets of the fields of each job on a server.
+
+:rtype: numpy.ndarray or array.array
+:returns: heap offsets as a 2D numpy array (one row per job), if numpy is
+    available, or a flat array of unsigned integers otherwise.
+'''
+        count = nrows*len(self.fields)
+        numpy = _numpy()
+        if numpy is not None:
+            if not count:
+                return numpy.zeros((0, len(self.fields)), dtype='<u4')
+            return numpy.frombuffer(self._map, dtype='<u4', count=count, offset=start).reshape(nrows, len(self.fields))
+        else:
+            rows = array.array('I')
+            rows.frombytes(self._map[start:start+count*rows.itemsize])
+            if sys.byteorder == 'big':
+                rows.byteswap()
+            return rows
+
+    def _matches(self, pattern):
+        '''Find the heap offsets of the values which match pattern.'''
+        search = re.compile(pattern).search
+        matched = []
+        offset = 0
+        while offset < self._heap_size:
+            if search(str(self._decode(offset))):
+                matched.append(offset)
+            offset += 4 + struct.unpack_from('<I', self._map, self._heap+offset)[0]
+        return matched
+
+    def jobs(self, hosts=None, pattern=None, tasks=False, fields=None, under=None):
+        '''Find jobs in the mapped cache file.
+
+See :meth:`JobCache.jobs`.  Jobs are matched against the pattern as in
+:meth:`Job.match`.
+
+:type fields: list of strings
+:param fields: fields to include in the job specs.  Default: all fields.
+:param string under: directory.  If specified, only jobs whose path is in the
+    directory tree (see :meth:`JobServer.select_under`) are found.  Each
+    distinct path is tested once.
+
+:rtype: iterator of (string, integer, dictionary) tuples
+:returns: hostname, index and job spec of each job.
+'''
+        if fields is None:
+            fields = self.fields
+        elif tasks:
+            # Needed to expand job arrays.
+            fields = list(fields) + ['job_id', 'status', 'tasks']
+        columns = [(field, self.fields.index(field)) for field in set(fields) if field in self.fields]
+        if pattern:
+            matched = self._matches(pattern)
+        numpy = _numpy()
+        nfields = len(self.fields)
+        # The handle is not part of the job spec matched by Job.match.
+        searched = [column for (column, field) in enumerate(self.fields) if field != 'handle']
+        if under is not None:
+            prefix = _path_key(under)
+            path_column = self.fields.index('path')
+            in_tree = {}
+        for (host, nrows, start) in self.servers:
+            if hosts and host not in hosts:
+                continue
+            offsets = self._rows(nrows, start)
+            if not pattern:
+                found = range(nrows)
+            elif not matched:
+                found = []
+            elif numpy is not None:
+                found = numpy.flatnonzero(numpy.isin(offsets[:, searched], matched).any(axis=1)).tolist()
+            else:
+                matched = set(matched)
+                found = [row for row in range(nrows) if any(offsets[row*nfields+column] in matched for column in searched)]
+            if under is not None:
+                if numpy is not None:
+                    paths = offsets[:, path_column].tolist()
+                else:
+                    paths = offsets[path_column::nfields]
+                for offset in set(paths[row] for row in found):
+                    if offset not in in_tree:
+                        in_tree[offset] = offset != _MAPPED_ABSENT and _path_key(self._value(offset)).startswith(prefix)
+                found = [row for row in found if in_tree[paths[row]]]
+            for row in found:
+                if numpy is not None:
+                    row_offsets = offsets[row].tolist()
+                else:
+                    row_offsets = offsets[row*nfields:(row+1)*nfields]
+                job_spec = {}
+                for (field, column) in columns:
+                    if row_offsets[column] != _MAPPED_ABSENT:
+                        job_spec[field] = self._value(row_offsets[column])
+                if tasks and job_spec.get('tasks'):
+                    job_tasks = _parse_tasks(job_spec.pop('tasks'), job_spec['status'])
+                    for task_spec in _task_specs(job_spec, job_tasks):
+                        yield (host, row, task_spec)
+                else:
+                    yield (host, row, job_spec)
+
+    def format_jobs(self, hosts=None, pattern=None, short=False, tasks=False, under=None):
+        '''Format the jobs as a table.
+
+See :meth:`JobCache.pretty_print` for the arguments.  Only the fields shown
+are decoded.
+
+:rtype: list of strings
+:returns: lines of the table.
+'''
+        if short:
+            fields = ['job_id', 'status', 'handle']
+        else:
+            fields = None
+        return _format_jobs(self.jobs(hosts, pattern, tasks, fields, under), short)
+
+    def pretty_print(self, hosts=None, pattern=None, short=False, tasks=False, under=None):
+        '''Print out the jobs.
+
+See :meth:`JobCache.pretty_print` for the arguments.
+'''
+        for line in self.format_jobs(hosts, pattern, short, tasks, under):
+            print(line)
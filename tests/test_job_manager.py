@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+'''Tests of job submission and transactions.
+
+Jobs are submitted to a fake PBS queueing system: qsub and qstat scripts,
+placed at the start of PATH, which keep the queue in a plain-text file.
+
+Usage: test_job_manager.py [unittest options]
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
+LIB_DIR = os.path.abspath(os.path.join(SCRIPT_DIR, '../lib'))
+
+try:
+    import job_manager
+except ImportError:
+    # Assume standard layout of source package.
+    sys.path.append(LIB_DIR)
+    import job_manager
+
+from job_manager import JobStatus
+
+# Each job is a line of the queue file containing the job id and PBS status.
+# Job ids start at 900001 so they are not mistaken for pids.
+FAKE_QSUB = '''#!/bin/sh
+n=$(($(cat "${JM_FAKE_QUEUE}.count" 2>/dev/null || echo 900000) + 1))
+echo ${n} > "${JM_FAKE_QUEUE}.count"
+echo "${n}.fake Q" >> "${JM_FAKE_QUEUE}"
+echo "${n}.fake"
+'''
+
+FAKE_QSTAT = '''#!/bin/sh
+echo "Job ID  S  Time"
+[ -f "${JM_FAKE_QUEUE}" ] && while read -r job_id status; do
+    echo "${job_id}  ${status}  00:00"
+done < "${JM_FAKE_QUEUE}"
+exit 0
+'''
+
+class FakeQueueTestCase(unittest.TestCase):
+    '''Provide a temporary cache and a fake PBS queueing system.'''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.tmp, 'bin')
+        os.mkdir(bin_dir)
+        for (name, script) in (('qsub', FAKE_QSUB), ('qstat', FAKE_QSTAT)):
+            fname = os.path.join(bin_dir, name)
+            script_f = open(fname, 'w')
+            script_f.write(script)
+            script_f.close()
+            os.chmod(fname, 0o755)
+        self.queue = os.path.join(self.tmp, 'queue')
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = os.pathsep.join([bin_dir, os.environ.get('PATH', '')])
+        os.environ['JM_FAKE_QUEUE'] = self.queue
+        self.submit = os.path.join(self.tmp, 'job.sh')
+        open(self.submit, 'w').close()
+        self.job_cache = job_manager.JobCache(os.path.join(self.tmp, 'jm.cache'))
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def add_jobs(self, *job_specs):
+        '''Add pending jobs to the localhost server.'''
+        for job_spec in job_specs:
+            job_spec = dict(job_spec)
+            job_spec.setdefault('program', 'test')
+            job_spec.setdefault('path', self.tmp)
+            job_spec.setdefault('submit', self.submit)
+            job_spec.setdefault('status', JobStatus.pending)
+            self.job_cache.append(job_spec)
+
+    def jobs(self):
+        '''Read the jobs on the localhost server.'''
+        job_cache = job_manager.JobCache(self.job_cache.cache)
+        job_cache.load(lock=False)
+        return job_cache.job_servers['localhost'].jobs
+
+    def statuses(self):
+        '''Find the status of each job, keyed by job_id.'''
+        return dict((str(job.job_id), job.status) for job in self.jobs())
+
+    def set_queue(self, statuses):
+        '''Replace the contents of the fake queue.
+
+:param dictionary statuses: PBS status of each job, keyed by job id.  Jobs not
+    included have finished.
+'''
+        queue_f = open(self.queue, 'w')
+        for (job_id, status) in sorted(statuses.items()):
+            queue_f.write('%s %s\n' % (job_id, status))
+        queue_f.close()
+
+    def scheduler(self, **kwargs):
+        return job_manager.Scheduler(self.job_cache, job_manager.PBSBackend(), **kwargs)
+
+
+class SchedulerTest(FakeQueueTestCase):
+
+    def test_find_submit_backend(self):
+        backend = job_manager.find_submit_backend([job_manager.PBSBackend()])
+        self.assertEqual(backend.name, 'pbs')
+
+    def test_max_jobs(self):
+        self.add_jobs(*[dict(job_id='job%i' % (i)) for i in range(5)])
+        scheduler = self.scheduler(max_jobs=2)
+        self.assertEqual(scheduler.cycle(), ['900001.fake', '900002.fake'])
+        # Submitted jobs are recorded with the id from qsub.
+        statuses = self.statuses()
+        self.assertEqual(statuses['900001.fake'], JobStatus.queueing)
+        self.assertEqual(statuses['job2'], JobStatus.pending)
+        # Full: nothing is submitted until a job finishes.
+        self.set_queue({'900001.fake': 'R', '900002.fake': 'Q'})
+        self.assertEqual(scheduler.cycle(), [])
+        self.assertEqual(self.statuses()['900001.fake'], JobStatus.running)
+        self.set_queue({'900002.fake': 'R'})
+        self.assertEqual(scheduler.cycle(), ['900003.fake'])
+        statuses = self.statuses()
+        self.assertEqual(statuses['900001.fake'], JobStatus.finished)
+        self.assertEqual(sorted(statuses.values()).count(JobStatus.pending), 2)
+
+    def test_max_queued(self):
+        self.add_jobs(*[dict(job_id='job%i' % (i)) for i in range(4)])
+        scheduler = self.scheduler(max_queued=1)
+        self.assertEqual(scheduler.cycle(), ['900001.fake'])
+        self.assertEqual(scheduler.cycle(), [])
+        # Running jobs don't count against max_queued.
+        self.set_queue({'900001.fake': 'R'})
+        self.assertEqual(scheduler.cycle(), ['900002.fake'])
+        self.set_queue({'900001.fake': 'R', '900002.fake': 'H'})
+        self.assertEqual(scheduler.cycle(), [])
+
+    def test_interval(self):
+        self.add_jobs(*[dict(job_id='job%i' % (i)) for i in range(3)])
+        scheduler = self.scheduler(interval=0.2)
+        start = time.time()
+        self.assertEqual(len(scheduler.cycle()), 3)
+        self.assertTrue(time.time() - start >= 0.4)
+
+    def test_dependencies(self):
+        self.add_jobs(dict(job_id='a'), dict(job_id='b', depends='a'), dict(job_id='c', depends='b'))
+        scheduler = self.scheduler()
+        self.assertEqual(scheduler.cycle(), ['900001.fake'])
+        # Dependencies are renamed with the job.
+        jobs = self.jobs()
+        self.assertEqual(jobs[1].depends, '900001.fake')
+        self.set_queue({'900001.fake': 'R'})
+        self.assertEqual(scheduler.cycle(), [])
+        # Released once the dependency finishes.
+        self.set_queue({})
+        self.assertEqual(scheduler.cycle(), ['900002.fake'])
+        self.assertEqual(self.jobs()[2].depends, '900002.fake')
+
+    def test_failed_dependency(self):
+        self.add_jobs(dict(job_id='a'), dict(job_id='b', depends='a'), dict(job_id='c', depends='b'))
+        scheduler = self.scheduler()
+        scheduler.cycle()
+        self.job_cache.transact(lambda job_servers: job_servers['localhost'].modify(dict(status=JobStatus.failed), [0]))
+        self.assertEqual(scheduler.cycle(), [])
+        statuses = self.statuses()
+        self.assertEqual(statuses['b'], JobStatus.failed)
+        self.assertEqual(statuses['c'], JobStatus.failed)
+
+    def test_unknown_dependency(self):
+        self.add_jobs(dict(job_id='a', depends='missing'))
+        scheduler = self.scheduler()
+        self.assertEqual(scheduler.cycle(), [])
+        self.assertEqual(scheduler.unresolved, dict(a=set(['missing'])))
+        self.assertEqual(self.statuses()['a'], JobStatus.failed)
+
+    def test_unrecorded(self):
+        # The cache is locked whilst the submitted job is recorded.
+        self.add_jobs(dict(job_id='a'), dict(job_id='b', depends='a'))
+        scheduler = self.scheduler()
+        submit = scheduler.submit
+        def submit_and_lock(job_spec):
+            job_id = submit(job_spec)
+            open(self.job_cache._lock, 'w').close()
+            return job_id
+        scheduler.submit = submit_and_lock
+        self.assertRaises(job_manager.LockException, scheduler.cycle, max_attempts=1)
+        os.remove(self.job_cache._lock)
+        scheduler.submit = submit
+        # Recorded in the next cycle rather than submitted again.
+        self.assertEqual(scheduler.cycle(), [])
+        jobs = self.jobs()
+        self.assertEqual([job.job_id for job in jobs], ['900001.fake', 'b'])
+        self.assertEqual(jobs[1].depends, '900001.fake')
+
+
+class TransactionTest(FakeQueueTestCase):
+
+    def setUp(self):
+        FakeQueueTestCase.setUp(self)
+        self.add_jobs(dict(job_id='a'), dict(job_id='b'))
+
+    def test_commit(self):
+        tx = self.job_cache.transaction()
+        tx.job_servers['localhost'].modify(dict(comment='x'), [0])
+        tx.commit()
+        self.assertEqual(self.jobs()[0].comment, 'x')
+        self.assertRaises(job_manager.UserError, tx.commit)
+
+    def test_merge(self):
+        tx1 = self.job_cache.transaction()
+        tx2 = job_manager.JobCache(self.job_cache.cache).transaction()
+        tx1.job_servers['localhost'].modify(dict(comment='x'), [0])
+        tx1.job_servers['localhost'].add(dict(job_id='c', program='test', path=self.tmp))
+        tx2.job_servers['localhost'].modify(dict(status=JobStatus.held), [0])
+        tx2.job_servers['localhost'].delete([1])
+        tx1.commit()
+        tx2.commit()
+        jobs = self.jobs()
+        self.assertEqual([job.job_id for job in jobs], ['a', 'c'])
+        self.assertEqual(jobs[0].comment, 'x')
+        self.assertEqual(jobs[0].status, JobStatus.held)
+        # Handles are never reused.
+        self.assertEqual([job.handle for job in jobs], [1, 3])
+
+    def test_merge_same_change(self):
+        tx1 = self.job_cache.transaction()
+        tx2 = job_manager.JobCache(self.job_cache.cache).transaction()
+        for tx in (tx1, tx2):
+            tx.job_servers['localhost'].modify(dict(comment='x'), [1])
+            tx.commit()
+        self.assertEqual(self.jobs()[1].comment, 'x')
+
+    def test_conflict(self):
+        tx1 = self.job_cache.transaction()
+        tx2 = job_manager.JobCache(self.job_cache.cache).transaction()
+        tx1.job_servers['localhost'].modify(dict(comment='x'), [0])
+        tx2.job_servers['localhost'].modify(dict(comment='y'), [0])
+        tx1.commit()
+        version = job_manager._cache_version(os.stat(self.job_cache.cache))
+        self.assertRaises(job_manager.TransactionConflict, tx2.commit)
+        self.assertEqual(job_manager._cache_version(os.stat(self.job_cache.cache)), version)
+        self.assertEqual(self.jobs()[0].comment, 'x')
+        self.assertFalse(os.path.exists(self.job_cache._lock))
+
+    def test_transact_retries(self):
+        other = job_manager.JobCache(self.job_cache.cache)
+        calls = []
+        def update(job_servers):
+            if not calls:
+                # Changed by another process before this is committed.
+                other.transact(lambda job_servers: job_servers['localhost'].modify(dict(comment='y'), [0]))
+            calls.append(True)
+            job_servers['localhost'].modify(dict(comment='x'), [0])
+        self.job_cache.transact(update)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.jobs()[0].comment, 'x')
+
+
+if __name__ == '__main__':
+    unittest.main()